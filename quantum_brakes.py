@@ -0,0 +1,158 @@
+"""
+
+Quantum Desktop Playback - brake application analysis
+
+Every brake application in the samples is found and measured:
+
+    automatic       the brake pipe pressure is reduced by at least cfg.brake_pipe_reduction_psi below the pressure it
+                    was charged to earlier in the trip (the highest pressure seen in the trip so far)
+    emergency       an automatic application in which the brake pipe pressure falls to cfg.brake_pipe_emergency_psi
+                    or below
+    independent     the brake cylinder pressure reaches cfg.brake_cylinder_application_psi with no reduction of the
+                    brake pipe pressure at any time during it (the loco brake cylinders also apply with the
+                    automatic brake, so cylinder pressure during an automatic application is not counted again)
+
+Trips are split as for the track sections - at a gap of more than cfg.track_trip_gap_seconds or a time reversal - so
+an application never spans two trips and the brake pipe is taken to be charged afresh in each trip.
+
+Each application is a run of consecutive samples. The runs, and the depth, duration, speed at application and release
+and the deceleration of each, are found with whole column operations (differences, running maxima, reductions over
+the runs) so the time taken grows linearly with the number of samples.
+
+"""
+
+import numpy as np
+import quantum_sections
+
+
+# Application types
+AUTOMATIC = 0
+EMERGENCY = 1
+INDEPENDENT = 2
+application_types = ["Automatic", "Emergency", "Independent"]
+
+
+def trip_numbers(epoch_seconds, gap_seconds):
+    """
+        Return the trip number of each sample (see quantum_sections.trip_starts)
+    """
+    numbers = np.zeros(len(epoch_seconds), dtype=np.int64)
+    numbers[quantum_sections.trip_starts(epoch_seconds, gap_seconds)[1:]] = 1
+    return np.cumsum(numbers)
+
+
+def sample_runs(mask, trips):
+    """
+        Return the first and last sample positions (arrays) of each run of consecutive samples where mask is set,
+        runs ending at the end of a trip
+    """
+    if len(mask) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    same_trip = np.concatenate(([False], trips[1:] == trips[:-1]))
+    previous_set = np.concatenate(([False], mask[:-1])) & same_trip
+    next_set = np.concatenate((mask[1:], [False])) & np.concatenate((same_trip[1:], [False]))
+    return np.flatnonzero(mask & ~previous_set), np.flatnonzero(mask & ~next_set)
+
+
+def run_reduce(ufunc, values, firsts, lasts):
+    """
+        Apply a numpy ufunc reduction (np.minimum, np.maximum, np.add) to the values of each run, first to last
+        inclusive
+    """
+    if len(firsts) == 0:
+        return np.array([], dtype=values.dtype)
+    # Reduce between the first of each run and the sample after its last, discarding the reductions between runs
+    padded = np.concatenate((values, values[-1:]))
+    bounds = np.empty(2 * len(firsts), dtype=np.int64)
+    bounds[0::2] = firsts
+    bounds[1::2] = lasts + 1
+    return ufunc.reduceat(padded, bounds)[0::2]
+
+
+def charged_pressures(bp, trips):
+    """
+        Return the highest brake pipe pressure of each sample's trip up to and including the sample
+    """
+    if len(bp) == 0:
+        return bp.copy()
+    # Trips are lifted clear of each other so one running maximum over the whole column restarts at each trip
+    offsets = trips * (int(bp.max()) - int(bp.min()) + 1)
+    return np.maximum.accumulate(bp + offsets) - offsets
+
+
+def brake_applications(epoch_seconds, bp, bc, gap_seconds, reduction_psi, emergency_psi, application_psi):
+    """
+        Find the brake applications in the samples, given their epoch seconds and the brake pipe and cylinder
+        pressures as logged (psi). Returns a dictionary of arrays, one entry per application in order of the first
+        sample - type, first and last sample positions, trip, brake pipe reduction (psi) and peak cylinder pressure.
+    """
+    epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64)
+    bp = np.asarray(bp, dtype=np.int64)
+    bc = np.asarray(bc, dtype=np.int64)
+    trips = trip_numbers(epoch_seconds, gap_seconds)
+    charged = charged_pressures(bp, trips)
+
+    reduced = charged - bp >= reduction_psi
+    automatic_firsts, automatic_lasts = sample_runs(reduced, trips)
+    lowest_bp = run_reduce(np.minimum, bp, automatic_firsts, automatic_lasts)
+    automatic_types = np.where(lowest_bp <= emergency_psi, EMERGENCY, AUTOMATIC)
+
+    cylinder_firsts, cylinder_lasts = sample_runs(bc >= application_psi, trips)
+    independent = run_reduce(np.add, reduced.astype(np.int64), cylinder_firsts, cylinder_lasts) == 0
+    independent_firsts = cylinder_firsts[independent]
+    independent_lasts = cylinder_lasts[independent]
+
+    firsts = np.concatenate((automatic_firsts, independent_firsts))
+    order = np.argsort(firsts, kind="stable")
+    lasts = np.concatenate((automatic_lasts, independent_lasts))[order]
+    firsts = firsts[order]
+    return {"type": np.concatenate((automatic_types,
+                                    np.full(len(independent_firsts), INDEPENDENT, dtype=np.int64)))[order],
+            "first": firsts,
+            "last": lasts,
+            "trip": trips[firsts],
+            "reduction": np.concatenate((charged[automatic_firsts] - lowest_bp,
+                                         np.zeros(len(independent_firsts), dtype=np.int64)))[order],
+            "peak_bc": run_reduce(np.maximum, bc, firsts, lasts)}
+
+
+def application_measures(applications, epoch_seconds, speed):
+    """
+        Return the duration (seconds), speed at application and release and the mean deceleration (speed units per
+        second, nan for applications of a single sample) of each application, given the sample speeds in the units
+        reported
+    """
+    epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64)
+    speed = np.asarray(speed, dtype=np.float64)
+    firsts = applications["first"]
+    lasts = applications["last"]
+    durations = epoch_seconds[lasts] - epoch_seconds[firsts]
+    applied_speeds = speed[firsts]
+    released_speeds = speed[lasts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        decelerations = np.where(durations > 0, (applied_speeds - released_speeds) / durations, np.nan)
+    return durations, applied_speeds, released_speeds, decelerations
+
+
+def trip_summary(applications, decelerations, epoch_seconds, gap_seconds):
+    """
+        Return, for each trip with samples, the first and last sample positions, the number of applications of
+        each type, the greatest brake pipe reduction (psi) and the mean deceleration of the applications (nan if
+        none could be measured)
+    """
+    epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64)
+    starts = quantum_sections.trip_starts(epoch_seconds, gap_seconds)
+    trip_count = len(starts)
+    ends = np.concatenate((starts[1:], [len(epoch_seconds)])) - 1
+    trips = applications["trip"]
+    counts = np.zeros((trip_count, len(application_types)), dtype=np.int64)
+    np.add.at(counts, (trips, applications["type"]), 1)
+    greatest_reduction = np.zeros(trip_count, dtype=np.int64)
+    np.maximum.at(greatest_reduction, trips, applications["reduction"])
+    measured = ~np.isnan(decelerations)
+    deceleration_totals = np.bincount(trips[measured], weights=decelerations[measured], minlength=trip_count)
+    deceleration_counts = np.bincount(trips[measured], minlength=trip_count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_decelerations = np.where(deceleration_counts > 0, deceleration_totals / deceleration_counts, np.nan)
+    return [(int(starts[trip]), int(ends[trip]), counts[trip].tolist(), int(greatest_reduction[trip]),
+             float(mean_decelerations[trip])) for trip in range(trip_count)]
@@ -0,0 +1,96 @@
+"""
+
+Quantum Desktop Playback - wheel calibration store
+
+The speed recorded by the logger is based on the wheel diameter programmed into it. The real wheel diameter changes
+when wheels are re-profiled, so the correction applied to a sample must use the diameter in force when the sample was
+recorded - not the current one - or historical files are corrected wrongly.
+
+The calibration store (cfg.wheel_calibration_file) is a CSV file holding the wheel diameter history of each loco:
+
+    loco,effective_from,wheel_dia_mm
+    844,2023/01/01,1000
+    844,2025/02/13,995
+
+Each diameter applies from its effective date (yyyy/mm/dd or "yyyy/mm/dd hh:mm:ss") until the next one for the loco.
+Samples earlier than the first entry use the first entry. Locos not in the store use their cfg.wheel_dia_actual_mm
+entry for all samples.
+
+The store is read once per run, and the history of each loco is kept as a pair of arrays, so the factors for a whole
+batch of samples are resolved at once with a binary search of the effective dates.
+
+"""
+
+import os
+import csv
+import numpy as np
+from datetime import datetime
+import quantum_extraction_cfg as cfg
+
+
+calibration_store = None        # Loco number: list of (effective epoch seconds, wheel diameter mm), read once
+calibration_histories = dict()  # Loco number: (effective epoch seconds array, wheel diameter mm array)
+
+
+def parse_effective_date(text):
+    """
+        Return the epoch seconds of an effective date, yyyy/mm/dd or yyyy/mm/dd hh:mm:ss
+    """
+    text = text.strip()
+    timestamp_format = "%Y/%m/%d %H:%M:%S" if " " in text else "%Y/%m/%d"
+    return int(datetime.strptime(text, timestamp_format).timestamp())
+
+
+def load_calibration_store(path):
+    """
+        Read the calibration store. Returns a dictionary, keyed by loco number, of lists of
+        (effective epoch seconds, wheel diameter mm) tuples. Lines starting with # are comments.
+    """
+    store = dict()
+    if not path or not os.path.isfile(path):
+        return store
+    with open(path, newline="") as file:
+        rows = csv.reader(line for line in file if line.strip() and not line.lstrip().startswith("#"))
+        for line_number, row in enumerate(rows, 1):
+            if line_number == 1 and row[0].strip().lower() == "loco":
+                continue            # Column headings
+            try:
+                loco_number, effective_from, wheel_dia_mm = [field.strip() for field in row]
+                store.setdefault(loco_number, list()).append((parse_effective_date(effective_from),
+                                                              float(wheel_dia_mm)))
+            except ValueError:
+                raise ValueError("Invalid wheel calibration entry " + ",".join(row) + " in " + path)
+    return store
+
+
+def calibration_history(loco_number):
+    """
+        Return the wheel diameter history of a loco as a pair of arrays - effective epoch seconds (ascending) and
+        wheel diameters in mm - or None if the loco has no calibration in the store or the configuration file
+    """
+    global calibration_store
+
+    history = calibration_histories.get(loco_number)
+    if history is not None:
+        return history
+    if calibration_store is None:
+        calibration_store = load_calibration_store(cfg.wheel_calibration_file)
+    entries = sorted(calibration_store.get(loco_number, []))
+    if not entries:
+        if loco_number not in cfg.wheel_dia_actual_mm:
+            return None
+        entries = [(0, float(cfg.wheel_dia_actual_mm[loco_number]))]
+    history = (np.array([entry[0] for entry in entries], dtype=np.int64),
+               np.array([entry[1] for entry in entries], dtype=np.float64))
+    calibration_histories[loco_number] = history
+    return history
+
+
+def speed_adjustment_factors(history, wheel_diameter_qdp_inches, epoch_seconds):
+    """
+        Return the speed adjustment factor (actual wheel diameter / QDP wheel diameter) in force at each of the
+        sample timestamps
+    """
+    effective_seconds, wheel_dia_mm = history
+    entries = np.searchsorted(effective_seconds, np.asarray(epoch_seconds, dtype=np.int64), side="right") - 1
+    return wheel_dia_mm[np.clip(entries, 0, None)] / (wheel_diameter_qdp_inches * 25.4)
@@ -0,0 +1,209 @@
+"""
+
+Quantum Desktop Playback - safety input compliance
+
+The safety related digital inputs are checked against a few rules as each sample is written, so nothing more than
+the state of the rules need be kept for them however long the report is. This does not reduce the memory used by a
+run - the sample columns are kept for the whole run whether or not the checks are made, for the other analyses and
+the dataset.
+
+    headlight       while moving at least one of cfg.compliance_headlight_inputs must be on - runs of samples with
+                    none on lasting cfg.compliance_headlight_grace_seconds or more are exceptions
+    vigilance       while moving the vigilance must be acknowledged (cfg.vigilance_ack_input on) at least every
+                    cfg.vigilance_ack_interval_seconds - the timer restarts when the loco stops
+    horn            the horn (cfg.horn_input) must have been sounded within cfg.horn_warning_seconds before each
+                    level crossing in cfg.level_crossings is passed. The position of the loco on the line is found
+                    from its odometer reading and the start point of its trip, as for the track sections.
+    EIE             each EIE (cfg.eie_input) occurrence is an exception, with the speed it occurred at
+
+The exceptions are returned by check_sample as they close, for the caller to write out at once, and the count of
+exceptions and the samples (crossings for the horn rule) checked and failed are kept for each rule for the summary.
+A gap in the samples of more than cfg.sampling_gap_threshold_seconds, or a time reversal, closes any open exceptions
+and restarts the vigilance and horn timers.
+
+"""
+
+import bisect
+import numpy as np
+import quantum_extraction_cfg as cfg
+import quantum_dataset
+import quantum_sections
+import quantum_units
+
+
+# Rules, in the order reported
+HEADLIGHT = "Headlight off while moving"
+VIGILANCE = "Vigilance not acknowledged"
+HORN = "No horn before level crossing"
+EIE = "EIE occurrence"
+rules = [HEADLIGHT, VIGILANCE, HORN, EIE]
+
+rule_statistics = dict()        # Rule: [exceptions, exception seconds, samples checked, samples failed]
+open_exceptions = dict()        # Rule: [first seconds, last seconds, first index, first row, speed, max speed, detail]
+input_bits = dict()             # Rule: bit mask of its inputs in the packed flags, 0 if not logged
+crossing_posts = list()         # Level crossing km posts, sorted, and their names
+crossing_names = list()
+trip_points = None              # Trip start points (see quantum_sections.start_points)
+previous_seconds = None
+previous_position = None
+trip_odometer_km = 0.0          # Odometer reading, km post and direction at the start of the trip
+trip_start_km = 0.0
+trip_direction = 1.0
+last_ack_seconds = None
+last_horn_seconds = None
+
+
+def input_mask(names):
+    """
+        Return the bit mask of the named digital inputs in the packed flags, ignoring names not in cfg.headers
+    """
+    header_names = [header[0] for header in cfg.headers[quantum_dataset.first_flag_column:]]
+    return sum(1 << header_names.index(name) for name in names if name in header_names)
+
+
+def start_compliance():
+    """
+        Clear the state of the rules, before the first sample is checked
+    """
+    global trip_points
+    global previous_seconds
+    global previous_position
+    global last_ack_seconds
+    global last_horn_seconds
+
+    rule_statistics.clear()
+    rule_statistics.update((rule, [0, 0, 0, 0]) for rule in rules)
+    open_exceptions.clear()
+    input_bits.clear()
+    input_bits.update({HEADLIGHT: input_mask(cfg.compliance_headlight_inputs),
+                       VIGILANCE: input_mask([cfg.vigilance_ack_input]),
+                       HORN: input_mask([cfg.horn_input]),
+                       EIE: input_mask([cfg.eie_input])})
+    crossings = sorted((float(km_post), name) for name, km_post in cfg.level_crossings)
+    crossing_posts[:] = [crossing[0] for crossing in crossings]
+    crossing_names[:] = [crossing[1] for crossing in crossings]
+    trip_points = quantum_sections.start_points(cfg.track_trip_starts, cfg.track_default_start_km)
+    previous_seconds = None
+    previous_position = None
+    last_ack_seconds = None
+    last_horn_seconds = None
+
+
+def update_exception(rule, failing, closed, epoch_seconds, index, row, speed, detail="", minimum_seconds=0):
+    """
+        Open or extend the rule's exception if the sample fails it, otherwise close the exception if one is open -
+        adding it to closed if it lasted minimum_seconds or more
+    """
+    statistics = rule_statistics[rule]
+    statistics[2] += 1
+    exception = open_exceptions.get(rule)
+    if failing:
+        statistics[3] += 1
+        if exception is None:
+            open_exceptions[rule] = [epoch_seconds, epoch_seconds, index, row, speed, speed, detail]
+        else:
+            exception[1] = epoch_seconds
+            exception[5] = max(exception[5], speed)
+    elif exception is not None:
+        close_exception(rule, closed, minimum_seconds)
+
+
+def close_exception(rule, closed, minimum_seconds=0):
+    """
+        Close the rule's open exception, adding it to closed if it lasted minimum_seconds or more
+    """
+    first_seconds, last_seconds, index, row, speed, maximum_speed, detail = open_exceptions.pop(rule)
+    if last_seconds - first_seconds < minimum_seconds:
+        return
+    rule_statistics[rule][0] += 1
+    rule_statistics[rule][1] += last_seconds - first_seconds
+    closed.append((rule, first_seconds, last_seconds, index, row, speed, maximum_speed, detail))
+
+
+def check_sample(epoch_seconds, mileage, speed, flags, index, row):
+    """
+        Check a sample (odometer in miles, speed in mph and packed flags as logged, with its position in the sample
+        columns and its data sheet row) against the rules. Returns a list of the exceptions closed by the sample,
+        each (rule, first seconds, last seconds, first index, first row, speed, max speed, detail).
+    """
+    global previous_seconds
+    global previous_position
+    global trip_odometer_km
+    global trip_start_km
+    global trip_direction
+    global last_ack_seconds
+    global last_horn_seconds
+
+    closed = []
+    if previous_seconds is not None and not 0 <= epoch_seconds - previous_seconds <= cfg.sampling_gap_threshold_seconds:
+        for rule in list(open_exceptions):
+            close_exception(rule, closed, cfg.compliance_headlight_grace_seconds if rule == HEADLIGHT else 0)
+        last_ack_seconds = None
+        last_horn_seconds = None
+    km = mileage * quantum_units.km_per_mile
+    new_trip = previous_seconds is None or not 0 <= epoch_seconds - previous_seconds <= cfg.track_trip_gap_seconds
+    previous_seconds = epoch_seconds
+    moving = speed > 0
+
+    if input_bits[HEADLIGHT] and moving:
+        update_exception(HEADLIGHT, not flags & input_bits[HEADLIGHT], closed, epoch_seconds, index, row, speed,
+                         minimum_seconds=cfg.compliance_headlight_grace_seconds)
+    elif HEADLIGHT in open_exceptions:
+        close_exception(HEADLIGHT, closed, cfg.compliance_headlight_grace_seconds)
+
+    if input_bits[VIGILANCE]:
+        if flags & input_bits[VIGILANCE] or not moving or last_ack_seconds is None:
+            last_ack_seconds = epoch_seconds
+        if moving:
+            overdue = epoch_seconds - last_ack_seconds > cfg.vigilance_ack_interval_seconds
+            update_exception(VIGILANCE, overdue, closed, epoch_seconds, index, row, speed,
+                             "Last acknowledged " + str(epoch_seconds - last_ack_seconds) + " s before")
+        elif VIGILANCE in open_exceptions:
+            close_exception(VIGILANCE, closed)
+
+    if input_bits[HORN] and flags & input_bits[HORN]:
+        last_horn_seconds = epoch_seconds
+    if new_trip:
+        point = np.searchsorted(trip_points[0], epoch_seconds, side="right")
+        trip_odometer_km = km
+        trip_start_km = trip_points[1][point]
+        trip_direction = trip_points[2][point]
+        previous_position = None
+    position = trip_start_km + trip_direction * (km - trip_odometer_km)
+    if input_bits[HORN] and crossing_posts and previous_position is not None and moving:
+        low, high = min(previous_position, position), max(previous_position, position)
+        for crossing in range(bisect.bisect_right(crossing_posts, low), bisect.bisect_right(crossing_posts, high)):
+            statistics = rule_statistics[HORN]
+            statistics[2] += 1
+            if last_horn_seconds is None or epoch_seconds - last_horn_seconds > cfg.horn_warning_seconds:
+                statistics[3] += 1
+                open_exceptions[HORN] = [epoch_seconds, epoch_seconds, index, row, speed, speed,
+                                         crossing_names[crossing] + " (km " + "{:g}".format(crossing_posts[crossing]) +
+                                         ")" + ("" if last_horn_seconds is None else ", horn last sounded " +
+                                                str(epoch_seconds - last_horn_seconds) + " s before")]
+                close_exception(HORN, closed)
+    previous_position = position
+
+    if input_bits[EIE]:
+        update_exception(EIE, flags & input_bits[EIE], closed, epoch_seconds, index, row, speed,
+                         "Moving" if moving else "Stationary")
+    return closed
+
+
+def finish_compliance():
+    """
+        Close the exceptions still open at the last sample. Returns them as check_sample does.
+    """
+    closed = []
+    for rule in list(open_exceptions):
+        close_exception(rule, closed, cfg.compliance_headlight_grace_seconds if rule == HEADLIGHT else 0)
+    return closed
+
+
+def compliance_summary():
+    """
+        Return, for each rule, the rule, the number of exceptions, their total seconds, the samples (crossings for
+        the horn rule) checked and the percentage of them that passed (None if none were checked)
+    """
+    return [(rule, exceptions, seconds, checked, None if checked == 0 else 100.0 * (checked - failed) / checked)
+            for rule, (exceptions, seconds, checked, failed) in rule_statistics.items()]
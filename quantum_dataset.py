@@ -0,0 +1,388 @@
+"""
+
+Quantum Desktop Playback - columnar dataset store and query tool
+
+When enabled in the configuration file (save_dataset) or with -d, each run of quantum_txt_extraction.py stores the
+data samples it wrote to the workbook as a columnar dataset - a directory holding one numpy .npy file per column plus a
+meta.json file describing the run. Values are stored as logged (miles, mph, psi) so any unit can be reported later.
+
+A time index (the sample positions sorted by timestamp) is stored alongside the columns so that date range queries
+only touch the samples within the range.
+
+The query tool answers questions such as "max TMC in idle on 844 in March" without re-running the extraction:
+
+    quantum_txt_extraction.py query -l 844 -b 2025/03/01 -e 2025/03/31 -w "throttle == idle" -a "max(tmc)"
+    quantum_txt_extraction.py query -l 844 -b 2024/01/01 -e 2024/12/31 -w "eie == 1"
+
+Command line arguments
+----------------------
+Switches                    Details
+-d --dataset_directory      directory holding the datasets, over-rides cfg.dataset_directory
+-l --loco                   only query datasets for this locomotive
+-b --begin_timestamp        yyyy/mm/dd or "yyyy/mm/dd hh:mm:ss" - only samples from this time
+-e --end_timestamp          yyyy/mm/dd or "yyyy/mm/dd hh:mm:ss" - only samples up to this time (a bare date includes
+                            the whole day)
+-w --where                  filter expression - clauses of the form <column> <op> <value> joined with "and" or "or"
+                            ("and" binds tighter). Ops are == != < <= > >=
+                            Throttle values may be given as a notch number or idle, dyn, stop, fault
+                            Date values are yyyy/mm/dd or "yyyy/mm/dd hh:mm:ss" (quoted) - a bare date stands for
+                            the whole day, eg: date == 2025/07/09, date > 2025/03/31
+-a --aggregate              count, min(col), max(col), mean(col) or sum(col). Several may be given, comma separated.
+                            If omitted the matching samples are listed.
+-n --limit                  maximum number of samples listed (default 50)
+-k --kpa_pressures          report pressures in kpa
+-p --psi_pressures          report pressures in psi
+                            (by default pressures are reported in the units used by the run that saved the dataset)
+
+Columns are date, km, speed (kph, wheel corrected), tmc, bp, bc, throttle and the digital inputs named after their
+worksheet column headers (reverse, eie, pcs, light_s, forward, light_l, horn, ds1, ds2, vs_ack, axle_drive). The digital
+inputs are stored packed into a single integer column, flags, the first input in bit 0.
+
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+import numpy as np
+from datetime import datetime, timedelta
+import quantum_extraction_cfg as cfg
+import quantum_units
+import quantum_calibration
+
+
+# Throttle positions are stored as small integers. Notches are stored as their number, the lettered positions
+# as the codes below.
+throttle_codes = {"ID": 0, "I": 0, "F": -1, "D": -2, "S": -3}
+throttle_code_unknown = -9
+throttle_names = {"idle": 0, "fault": -1, "dyn": -2, "stop": -3}
+
+first_flag_column = 8           # Digital inputs follow the throttle column in cfg.headers
+
+query_ops = {"==": np.equal, "!=": np.not_equal, "<=": np.less_equal, ">=": np.greater_equal,
+             "<": np.less, ">": np.greater}
+clause_re = re.compile(r"^\s*([a-z0-9_]+)\s*(==|!=|<=|>=|<|>)\s*(\"[^\"]*\"|'[^']*'|[a-z0-9_.:/\-]+)\s*$")
+aggregate_re = re.compile(r"^\s*(count|min|max|mean|sum)\s*(?:\(\s*([a-z0-9_]+)\s*\))?\s*$")
+
+
+def column_name(header):
+    """
+        Turn a worksheet column header into a dataset column name - "Light (S)" becomes light_s
+    """
+    return re.sub(r"[^a-z0-9]+", "_", header.lower()).strip("_")
+
+
+def flag_column_names():
+    """
+        Return the dataset column names of the digital inputs, in logger order
+    """
+    return [column_name(header[0]) for header in cfg.headers[first_flag_column:]]
+
+
+def encode_throttle(throttle_position):
+    """
+        Return the integer code stored in the dataset for a throttle position string
+    """
+    if throttle_position.isnumeric():
+        return int(throttle_position)
+    return throttle_codes.get(throttle_position.upper(), throttle_code_unknown)
+
+
+def save_dataset(columns, meta, directory):
+    """
+        Write the columns (a dictionary of name: array) to a new dataset directory, together with the time index and
+        a meta.json file holding the meta dictionary. Returns the dataset path. The directory is named after the loco
+        and the time saved, with a suffix (-2, -3 etc.) if a dataset for the loco was already saved in that second.
+    """
+    epoch_seconds = np.asarray(columns["epoch_seconds"], dtype=np.int64)
+    time_index = np.argsort(epoch_seconds, kind="stable")
+
+    name = meta["loco_number"] + " " + datetime.now().strftime("%Y%m%d%H%M%S")
+    os.makedirs(directory, exist_ok=True)
+    suffix = 1
+    while True:
+        path = os.path.join(directory, name if suffix == 1 else name + "-" + str(suffix))
+        try:
+            os.mkdir(path)
+            break
+        except FileExistsError:
+            suffix += 1
+
+    for column, values in columns.items():
+        np.save(os.path.join(path, column + ".npy"), np.asarray(values))
+    np.save(os.path.join(path, "time_index.npy"), time_index)
+    np.save(os.path.join(path, "time_index_seconds.npy"), epoch_seconds[time_index])
+
+    meta = dict(meta)
+    meta["columns"] = list(columns.keys())
+    meta["samples"] = len(epoch_seconds)
+    with open(os.path.join(path, "meta.json"), "w") as file:
+        json.dump(meta, file, indent=4)
+    return path
+
+
+def load_dataset(path):
+    """
+        Load a dataset directory. The columns are memory mapped so only the parts of them used by a query are read.
+        Returns a (meta, columns) tuple.
+    """
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+    columns = dict()
+    for column in meta["columns"] + ["time_index", "time_index_seconds"]:
+        columns[column] = np.load(os.path.join(path, column + ".npy"), mmap_mode="r")
+    return meta, columns
+
+
+def find_datasets(directory, loco_number=None):
+    """
+        Return the paths of the datasets in directory, optionally only those for one locomotive
+    """
+    if not os.path.isdir(directory):
+        return []
+    paths = list()
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            continue
+        if loco_number is not None and name.split()[0] != loco_number:
+            continue
+        paths.append(path)
+    return paths
+
+
+def select_time_range(columns, start_seconds, end_seconds):
+    """
+        Use the time index to return the sample positions (in time order) between the two timestamps inclusive.
+        Either bound may be None.
+    """
+    time_index_seconds = columns["time_index_seconds"]
+    low = 0 if start_seconds is None else np.searchsorted(time_index_seconds, start_seconds, side="left")
+    high = len(time_index_seconds) if end_seconds is None else \
+        np.searchsorted(time_index_seconds, end_seconds, side="right")
+    return np.asarray(columns["time_index"][low:high])
+
+
+def column_values(meta, columns, name, positions, kpa_pressures):
+    """
+        Return the values of a query column for the sample positions, converted to the units shown in the workbook.
+        Pressures are in kpa or psi as kpa_pressures is True or False, or as reported by the original run if it is None.
+    """
+    if name == "date":
+        return np.asarray(columns["epoch_seconds"][positions])
+    if name == "km":
+        return quantum_units.miles_to_km(columns["mileage"][positions])
+    if name == "speed":
+        factors = meta["speed_adjustment_factor"]
+        if meta.get("wheel_calibration"):
+            history = (np.array([entry[0] for entry in meta["wheel_calibration"]], dtype=np.int64),
+                       np.array([entry[1] for entry in meta["wheel_calibration"]], dtype=np.float64))
+            factors = quantum_calibration.speed_adjustment_factors(history, meta["wheel_diameter_qdp_inches"],
+                                                                   columns["epoch_seconds"][positions])
+        return quantum_units.mph_to_kph(columns["speed"][positions], factors)
+    if name in ("bp", "bc"):
+        if kpa_pressures is None:
+            kpa_pressures = meta.get("kpa_pressures", False)
+        return quantum_units.psi_to_pressure(columns[name][positions], kpa_pressures)
+    if name in ("tmc", "throttle"):
+        return np.asarray(columns[name][positions])
+    if name in meta["flag_columns"]:
+        return flag_values(meta, columns, name, positions)
+    raise ValueError("Unknown column " + name)
+
+
+def flag_values(meta, columns, name, positions):
+    """
+        Return the 0/1 values of a digital input for the sample positions. The flags are stored packed into an integer
+        per sample (first flag in bit 0). Datasets saved before the flags were packed hold a column per flag.
+    """
+    if "flags" not in columns:
+        return np.asarray(columns[name][positions])
+    return (np.asarray(columns["flags"][positions]) >> meta["flag_columns"].index(name)) & 1
+
+
+def query_value(name, op, value):
+    """
+        Convert the value of a where clause to a number. A bare date compared with == or != is converted to the
+        (first, last) seconds of the day, and with < or >= to the start of the day, <= or > the end of it.
+    """
+    if name == "throttle" and value in throttle_names:
+        return throttle_names[value]
+    if name == "date":
+        try:
+            if ":" not in value and op in ("==", "!="):
+                return parse_query_timestamp(value, False), parse_query_timestamp(value, True)
+            return parse_query_timestamp(value, op in ("<=", ">"))
+        except ValueError:
+            raise ValueError("Invalid date " + value + " - must be yyyy/mm/dd or yyyy/mm/dd hh:mm:ss")
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError("Invalid value " + value + " for column " + name)
+
+
+def parse_where(expression):
+    """
+        Parse a where expression into a list of lists of (column, op, value) clauses. The inner lists are and'ed
+        together, the outer list or'ed.
+    """
+    if expression is None or expression.strip() == "":
+        return []
+    alternatives = list()
+    for alternative in re.split(r"\s+or\s+", expression.lower()):
+        clauses = list()
+        for clause in re.split(r"\s+and\s+", alternative):
+            match = clause_re.match(clause)
+            if match is None:
+                raise ValueError("Cannot parse where clause [" + clause + "]")
+            name, op, value = match.groups()
+            clauses.append((name, op, query_value(name, op, value.strip("\"'"))))
+        alternatives.append(clauses)
+    return alternatives
+
+
+def apply_where(meta, columns, positions, alternatives, kpa_pressures):
+    """
+        Return the sample positions matching the parsed where expression
+    """
+    if not alternatives:
+        return positions
+    matched = np.zeros(len(positions), dtype=bool)
+    for clauses in alternatives:
+        mask = np.ones(len(positions), dtype=bool)
+        for name, op, value in clauses:
+            values = column_values(meta, columns, name, positions, kpa_pressures)
+            if isinstance(value, tuple):
+                # A whole day
+                within = (values >= value[0]) & (values <= value[1])
+                mask &= within if op == "==" else ~within
+            else:
+                mask &= query_ops[op](values, value)
+        matched |= mask
+    return positions[matched]
+
+
+def parse_aggregates(expression):
+    """
+        Parse the aggregate expression into a list of (function, column) tuples
+    """
+    if expression is None or expression.strip() == "":
+        return []
+    aggregates = list()
+    for term in expression.lower().split(","):
+        match = aggregate_re.match(term)
+        if match is None or (match.group(1) != "count" and match.group(2) is None):
+            raise ValueError("Cannot parse aggregate [" + term + "]")
+        aggregates.append(match.groups())
+    return aggregates
+
+
+def parse_query_timestamp(timestamp, end_of_day):
+    """
+        Convert a yyyy/mm/dd or yyyy/mm/dd hh:mm:ss timestamp to epoch seconds. A bare date is taken as the start of
+        that day, or the end of it if end_of_day is set.
+    """
+    try:
+        return int(datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S").timestamp())
+    except ValueError:
+        try:
+            day = datetime.strptime(timestamp, "%Y/%m/%d")
+        except ValueError:
+            raise ValueError("Invalid timestamp " + timestamp + " - must be yyyy/mm/dd or yyyy/mm/dd hh:mm:ss")
+        if end_of_day:
+            day += timedelta(days=1, seconds=-1)
+        return int(day.timestamp())
+
+
+def format_sample(meta, columns, position, kpa_pressures):
+    """
+        Format one sample for listing on the console
+    """
+    positions = np.array([position])
+    when = datetime.fromtimestamp(int(columns["epoch_seconds"][position])).strftime("%Y/%m/%d %H:%M:%S")
+    values = [when]
+    values.append("{:.2f}".format(column_values(meta, columns, "km", positions, kpa_pressures)[0]))
+    for name in ("speed", "tmc", "bp", "bc", "throttle"):
+        values.append(str(int(column_values(meta, columns, name, positions, kpa_pressures)[0])))
+    flags_set = [name for name in meta["flag_columns"] if flag_values(meta, columns, name, positions)[0]]
+    return meta["loco_number"] + " " + " ".join(values) + " " + ",".join(flags_set)
+
+
+def run_query(directory, loco_number, start_seconds, end_seconds, where, aggregates, limit, kpa_pressures):
+    """
+        Run a query over every matching dataset in directory, printing the results. Returns the number of
+        matching samples.
+    """
+    alternatives = parse_where(where)
+    aggregate_terms = parse_aggregates(aggregates)
+
+    matched = list()        # (meta, columns, positions) per dataset
+    for path in find_datasets(directory, loco_number):
+        meta, columns = load_dataset(path)
+        positions = select_time_range(columns, start_seconds, end_seconds)
+        positions = apply_where(meta, columns, positions, alternatives, kpa_pressures)
+        if len(positions):
+            matched.append((meta, columns, positions))
+    count = sum(len(positions) for meta, columns, positions in matched)
+
+    if not aggregate_terms:
+        listed = 0
+        for meta, columns, positions in matched:
+            for position in positions:
+                if listed == limit:
+                    print("... " + str(count - listed) + " more samples not listed")
+                    return count
+                print(format_sample(meta, columns, position, kpa_pressures))
+                listed += 1
+        print(str(count) + " samples matched")
+        return count
+
+    for function, name in aggregate_terms:
+        if function == "count":
+            print("count = " + str(count))
+            continue
+        if count == 0:
+            print(function + "(" + name + ") = N/A")
+            continue
+        values = np.concatenate([column_values(meta, columns, name, positions, kpa_pressures)
+                                 for meta, columns, positions in matched])
+        result = getattr(np, function)(values)
+        if name == "date" and function in ("min", "max"):
+            result = datetime.fromtimestamp(int(result)).strftime("%Y/%m/%d %H:%M:%S")
+        print(function + "(" + name + ") = " + str(result))
+    return count
+
+
+def query_main(argv):
+    """
+        Entry point for the query sub command
+    """
+    parser = argparse.ArgumentParser(prog="quantum_txt_extraction.py query")
+    parser.add_argument('-d', '--dataset_directory', default=cfg.dataset_directory,
+                        help='directory holding the datasets, over-rides the entry in the configuration file')
+    parser.add_argument('-l', '--loco', help='only query datasets for this locomotive')
+    parser.add_argument('-b', '--begin_timestamp', help='only samples from this time - yyyy/mm/dd [hh:mm:ss]')
+    parser.add_argument('-e', '--end_timestamp', help='only samples up to this time - yyyy/mm/dd [hh:mm:ss]')
+    parser.add_argument('-w', '--where', help='filter expression, eg "throttle == idle and tmc > 0"')
+    parser.add_argument('-a', '--aggregate', help='count, min(col), max(col), mean(col), sum(col) - comma separated')
+    parser.add_argument('-n', '--limit', type=int, default=50, help='maximum number of samples listed')
+    parser.add_argument('-k', '--kpa_pressures', help='if set, pressures are reported in metric units',
+                        action='store_true')
+    parser.add_argument('-p', '--psi_pressures', help='if set, pressures are reported in imperial units',
+                        action='store_true')
+    args = parser.parse_args(argv)
+    kpa_pressures = None
+    if args.kpa_pressures:
+        kpa_pressures = True
+    if args.psi_pressures:
+        kpa_pressures = False
+
+    try:
+        start_seconds = None if args.begin_timestamp is None else parse_query_timestamp(args.begin_timestamp, False)
+        end_seconds = None if args.end_timestamp is None else parse_query_timestamp(args.end_timestamp, True)
+        run_query(args.dataset_directory, args.loco, start_seconds, end_seconds, args.where, args.aggregate,
+                  args.limit, kpa_pressures)
+    except ValueError as e:
+        print("Error: " + str(e))
+        sys.exit(-1)
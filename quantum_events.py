@@ -0,0 +1,168 @@
+"""
+
+Quantum Desktop Playback - logger event catalog
+
+Annotations in the report (power on/off, laptop connected, downloads, settings changes) and the events derived while
+processing the samples (brake pipe transitions, suppressed stationary events) are kept in a catalog, each with its
+kind, epoch seconds, date, time and text. The kind is recognised from how the text starts, using the patterns in
+cfg.logger_event_kinds (first match wins, anything else is "other").
+
+The catalog is appended to as the report is read. Once it is complete, build_event_index sorts it by time and keeps
+the positions of the events of each kind in time order, so that
+
+    event_intervals         the intervals between successive events of a kind - one array difference
+    daily_event_counts      the number of events of each kind per day
+
+are cheap however many events there are. The intervals are between the times as reported (naive seconds, worked out
+once as each event is added) rather than the epoch seconds, which are local time and so put out by daylight saving.
+
+nearest_samples joins the events to the data samples - the samples at or before and after each event - with one
+binary search per event over the sorted sample times.
+
+"""
+
+import re
+import calendar
+import numpy as np
+from array import array
+import quantum_extraction_cfg as cfg
+
+
+OTHER = "other"
+
+event_seconds = array('q')      # Epoch seconds of each event, in the order added
+event_naive_seconds = array('q')  # Seconds of each event as reported, see naive_seconds
+event_kinds = list()            # Kind of each event
+event_dates = list()            # Date (yyyy/mm/dd) and time (hh:mm:ss) of each event, as reported
+event_times = list()
+event_texts = list()
+event_epoch_dated = list()      # True for events dated in the epoch year (logger clock reset)
+event_sheet_rows = array('q')   # Logger Events sheet row of each event, -1 if not written to the sheet
+
+event_kind_pattern = None       # Compiled from cfg.logger_event_kinds on first use
+event_index = None              # Catalog positions in time order, built by build_event_index
+kind_index = dict()             # Kind: catalog positions array, in time order
+
+
+def clear_catalog():
+    """
+        Empty the catalog, before the events are added again for another output profile
+    """
+    global event_index
+
+    for events in (event_seconds, event_naive_seconds, event_kinds, event_dates, event_times, event_texts, event_epoch_dated,
+                   event_sheet_rows):
+        del events[:]
+    event_index = None
+    kind_index.clear()
+
+
+def event_kind(text):
+    """
+        Return the kind of an event from its text
+    """
+    global event_kind_pattern
+
+    if event_kind_pattern is None:
+        event_kind_pattern = re.compile("|".join("(?P<" + kind + ">" + pattern + ")"
+                                                 for kind, pattern in cfg.logger_event_kinds))
+    match = event_kind_pattern.match(text)
+    return match.lastgroup if match else OTHER
+
+
+def add_event(epoch_seconds, record_date, record_time, text, epoch_dated=False, sheet_row=-1):
+    """
+        Add an event to the catalog, with the Logger Events sheet row it is written to (if any). Returns its kind.
+    """
+    global event_index
+
+    kind = event_kind(text)
+    event_seconds.append(epoch_seconds)
+    event_naive_seconds.append(naive_seconds(record_date, record_time))
+    event_kinds.append(kind)
+    event_dates.append(record_date)
+    event_times.append(record_time)
+    event_texts.append(text)
+    event_epoch_dated.append(epoch_dated)
+    event_sheet_rows.append(sheet_row)
+    event_index = None
+    return kind
+
+
+def build_event_index():
+    """
+        Sort the catalog by time (events at the same time stay in the order added) and index each kind
+    """
+    global event_index
+
+    seconds = np.asarray(event_seconds, dtype=np.int64)
+    event_index = np.argsort(seconds, kind="stable")
+    kinds = np.asarray(event_kinds, dtype=object)[event_index] if len(event_index) else np.array([], dtype=object)
+    kind_index.clear()
+    for kind in dict.fromkeys(event_kinds):
+        kind_index[kind] = event_index[kinds == kind]
+    return event_index
+
+
+def naive_seconds(date, time):
+    """
+        Return the seconds since the epoch of a date (yyyy/mm/dd) and time (hh:mm:ss) taken as they are reported,
+        without converting them from local time, so that the difference between two is the same across a daylight
+        saving change as on any other day. The fields are taken from their positions rather than parsed.
+    """
+    return calendar.timegm((int(date[:4]), int(date[5:7]), int(date[8:10]), int(time[:2]), int(time[3:5]),
+                            int(time[6:8])))
+
+
+def event_intervals(kind):
+    """
+        Return an array of the seconds between successive events of a kind (as reported), ignoring epoch dated events
+    """
+    if event_index is None:
+        build_event_index()
+    if kind not in kind_index:
+        return np.array([], dtype=np.int64)
+    positions = kind_index[kind]
+    positions = positions[~np.asarray(event_epoch_dated, dtype=bool)[positions]]
+    return np.diff(np.asarray(event_naive_seconds, dtype=np.int64)[positions])
+
+
+def daily_event_counts():
+    """
+        Return the days (in order), the kinds (in order of first appearance) and a days x kinds array of the number
+        of events of each kind on each day
+    """
+    days = sorted(set(event_dates))
+    kinds = list(dict.fromkeys(event_kinds))
+    counts = np.zeros((len(days), len(kinds)), dtype=np.int64)
+    if days:
+        day_numbers = np.searchsorted(np.array(days), np.array(event_dates))
+        kind_number = dict((kind, number) for number, kind in enumerate(kinds))
+        kind_numbers = np.array([kind_number[kind] for kind in event_kinds])
+        np.add.at(counts, (day_numbers, kind_numbers), 1)
+    return days, kinds, counts
+
+
+def nearest_samples(sample_seconds, sample_epoch_dated):
+    """
+        Return, for each event in the catalog, the index of the nearest sample at or before it and of the nearest
+        sample after it (-1 if there is none) given the epoch seconds of the samples in the order written. Epoch
+        dated events are only joined to epoch dated samples and the others only to samples that are not. Samples
+        with the same time are taken in the order written.
+    """
+    sample_seconds = np.asarray(sample_seconds, dtype=np.int64)
+    sample_epoch_dated = np.asarray(sample_epoch_dated, dtype=bool)
+    seconds = np.asarray(event_seconds, dtype=np.int64)
+    epoch_dated = np.asarray(event_epoch_dated, dtype=bool)
+    preceding = np.full(len(seconds), -1, dtype=np.int64)
+    following = np.full(len(seconds), -1, dtype=np.int64)
+    for group in (False, True):
+        events = np.flatnonzero(epoch_dated == group)
+        samples = np.flatnonzero(sample_epoch_dated == group)
+        if len(events) == 0 or len(samples) == 0:
+            continue
+        order = samples[np.argsort(sample_seconds[samples], kind="stable")]
+        positions = np.searchsorted(sample_seconds[order], seconds[events], side="right")
+        preceding[events] = np.where(positions > 0, order[np.maximum(positions - 1, 0)], -1)
+        following[events] = np.where(positions < len(order), order[np.minimum(positions, len(order) - 1)], -1)
+    return preceding, following
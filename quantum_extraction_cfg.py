@@ -5,6 +5,7 @@ source_file = 'input files/JULY2025.prn'
 #source_file = 'input files/test_input.txt'
 # source_file='sample1.pdf'
 # source_file='sample2.pdf'
+# Compressed (gzip, bzip2, xz, zstd) and PDF files are recognised and read directly
 
 # The logger realtime clock can vary from the actual time so the timestamps
 # are not accurate. A function will normalise the timestamps based on the
@@ -24,16 +25,23 @@ ts_adjustment = 0
 wheel_dia_actual_mm = {"844": 995, "845": 995}
 #wheel_dia_actual_mm = 995 - old version prior to 2025/02/13 change
 
+# Wheel calibration store.
+# A CSV file (loco,effective_from,wheel_dia_mm) holding the history of each loco's wheel diameter, an entry per
+# re-profile. The diameter in force when a sample was recorded is used to correct its speed. Locos with no entries
+# in the store use their wheel_dia_actual_mm entry above. See quantum_calibration.py.
+wheel_calibration_file = 'wheel_calibration.csv'
+
 # Speed adjustment factor.
 # This will be the actual wheel diameter divided by the QDP reported diameter (converted to mm)
 # If this sis set to 0 then the calculation has not yet been made and the code will assume a 1:1 ratio
 # The QDP wheel size is generally reported on Page 0 of the printout with a pair of lines as follows:
 # "Wheel size used by program" followed immediately by the line
 # Circumference = xxx.x Diameter = xx.x
-# NB: This will be calculated in the code, any non-zero setting made manually is overwritten.
+# NB: If this is 0 the factor is calculated in the code, for each sample, from the wheel calibration. A non-zero
+# setting made manually is applied to all samples.
 speed_adjustment_factor = 0
 
-# Any line containing one of these phrases in omitted from processing
+# Any line starting with one of these phrases in omitted from processing
 # (as are all lines on Page 0 - except for the wheel diameter line)
 skip_list_words = ["Quantum Desktop Playback",
                    "Report Date",
@@ -43,6 +51,19 @@ skip_list_words = ["Quantum Desktop Playback",
 # Workbook name - including path if required - no xlsx suffix, that is added by the code
 # 				  as is the loco name and the date
 workbook_name = 'output/qdp_output'
+# Exact workbook path - if set, used as given instead of the name built from workbook_name (-o on the command line)
+workbook_path = None
+
+# Output profiles
+# Several versions of the workbook (psi and kpa, text and digit idle, suppressed and unsuppressed, different date
+# windows) can be written from one parse of the input. Each profile is a dictionary holding its name, which is
+# appended to the workbook name, and any of the settings in output_profile_settings - those not given keep the values
+# set above. Giving a start or end timestamp turns on date filtering for the profile. Empty = one workbook as set above.
+# eg: output_profiles = [{"name": "psi", "report_kpa_pressures": False},
+#                        {"name": "kpa", "report_kpa_pressures": True, "suppress_stationary_events": False}]
+output_profiles = []
+output_profile_settings = ["report_kpa_pressures", "idle_as_digit", "suppress_stationary_events", "filter_dates",
+                           "start_timestamp", "end_timestamp"]
 worksheet_name = "Data Extract"
 
 # Required date range.
@@ -60,6 +81,16 @@ end_timestamp = "2025/07/09 23:59:59"
 epoch_timestamps_allowed = True
 epoch_year = 1990
 
+# Incident windows
+# If set, the data incident_window_minutes either side of each incident listed in incident_file (CSV:
+# timestamp,incident - the incident name is optional) is written to a workbook of its own, named after the incident,
+# from one parse of the input. Each window is an output profile, added after any in output_profiles, and replaces the
+# workbook as set above if there are none. The timestamps may be in any of incident_timestamp_formats. Epoch dated
+# records within a window are reported as for the date range above. See quantum_incidents.py.
+incident_file = ''
+incident_window_minutes = 10
+incident_timestamp_formats = ["%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M", "%Y-%m-%d %H:%M"]
+
 # This dictionary translates the throttle position value to a meaningful text.
 # Note that Idle is stored in the logger output as "ID" but I modify it to "I"
 # for parsing reasons
@@ -106,6 +137,20 @@ in_flight_analysis_enabled = True
 ifa_deque_maxlen = 10               # Number of events to store in the queue
 ifa_tmc_threshold = 0               # Extract records with TMC values exceeding this value
 ifa_in_event_of_interest = False    # Set to true when we are in a run of records to be logged to the output file - flag is maintained by the code, not user set
+# Event streams are buffered and written to the workbook once all records have been processed. When the buffer holds
+# ifa_buffer_items items it is spilled to a temporary file, so memory use is bounded.
+# On a bad dataset (or with a zero TMC threshold) there can be tens of thousands of streams, so:
+#   ifa_max_streams             - maximum number of streams written (0 = no limit)
+#   ifa_stream_sample_every     - only write every nth stream (1 = all streams)
+#   ifa_max_records_per_stream  - records written per stream after the lead in records (0 = no limit). Beyond this
+#                                 only the last ifa_stream_tail_records records of the stream are written.
+#   ifa_separate_workbook       - write the event analysis sheet to its own workbook rather than the main one
+ifa_buffer_items = 100000
+ifa_max_streams = 0
+ifa_stream_sample_every = 1
+ifa_max_records_per_stream = 0
+ifa_stream_tail_records = 20
+ifa_separate_workbook = False
 
 # Hide stationary loco events
 # If set to True, events with a speed of 0 kph and tmc - 0 amps and throttle position in idle are hidden - the 0 speed event leading into and exiting from
@@ -116,7 +161,10 @@ suppress_stationary_events=True
 
 # If set, brake pressures will be reported in kPa rather than the default psi values
 report_kpa_pressures=False
-psi_to_kpa_factor=6.89476
+psi_to_kpa_factor=6.894757293168
+
+# Samples are converted to the reported units (km, kph, psi or kpa) and written to the data sheet in batches of this size
+conversion_batch_samples = 8192
 
 # If this flag is set to False then IDLE throttle position will show as Idle in the spreadsheet, which
 # improves readability but does not facilitate chart generation
@@ -130,4 +178,198 @@ idle_as_digit=True
 #   0   - show all
 #   1   - suppress page numbers being processed
 #   2   - suppress page numbers and inflight analysis indications
-quiet=0
\ No newline at end of file
+quiet=0
+
+# Progress reporting
+# If progress_display is set, progress through the source file (with pages/s, samples/s and the estimated time
+# remaining) is shown on a console progress bar - when quiet is 0 - rather than a line per page. If progress_file is
+# set, progress is also written to that file as JSON, for a batch scheduler. Progress is reported at most once per
+# progress_interval_seconds. If no bar can be shown (the progress module is not installed, or the output is piped or
+# logged) a line of text is printed every progress_text_interval_seconds instead. The -g switch over-rides
+# progress_file.
+progress_display = True
+progress_file = None
+progress_interval_seconds = 0.25
+progress_text_interval_seconds = 5
+
+# Sampling anomaly detection
+# Power cycles, laptop connects and TOD resets leave gaps and backward jumps in the sample stream. Once all the
+# records have been processed the sample timestamps and odometer readings are checked and any anomalies are written
+# to a separate sheet in the workbook, along with the data sheet row numbers of the samples concerned.
+# Anomalies reported are:
+#   Gap             - time between consecutive samples exceeds sampling_gap_threshold_seconds
+#   Duplicate       - consecutive samples share the same timestamp
+#   Time reversal   - sample timestamp is earlier than that of the previous sample
+#   Odometer jump   - the distance travelled between samples differs from that expected from the recorded speed
+#                     by more than odometer_jump_tolerance_miles (logger units)
+# Off by default, as it adds a sheet to the workbook.
+sampling_anomaly_detection_enabled = False
+sampling_gap_threshold_seconds = 60
+odometer_jump_tolerance_miles = 0.1
+
+# Columnar dataset
+# If set, the data samples written to the workbook are also saved as a columnar dataset in dataset_directory so they
+# can be queried later without re-running the extraction (quantum_txt_extraction.py query ...). Each run saves a new
+# dataset, so this is off unless asked for (-d on the command line).
+save_dataset = False
+dataset_directory = 'output/datasets'
+
+# Logger event catalog
+# Logger events (annotations, brake pipe transitions and suppressed stationary event markers) are catalogued by kind.
+# The kind is that of the first entry in logger_event_kinds whose pattern (a regular expression) matches the start of
+# the event text - events matching none are of kind "other". The inter-event offset is shown on the Logger Events
+# sheet for the kinds in logger_event_offset_kinds. If logger_event_summary_enabled is set the number of events of
+# each kind per day, and the intervals between events of each kind, are written to an "Event Summary" sheet (off by
+# default).
+logger_event_kinds = [("power_on", "Power On"),
+                      ("power_off", "Power Off"),
+                      ("power_other", "Power"),
+                      ("laptop_connected", "Laptop Connected"),
+                      ("laptop_disconnected", "Laptop Disconnected"),
+                      ("download", "Download|Data Download"),
+                      ("settings_change", "Setting|Configuration|Clock|Time Set|Date Set|Wheel"),
+                      ("bp_transition", "Brake pipe pressure transitioned"),
+                      ("suppression", "Suppressed ")]
+logger_event_offset_kinds = ["power_on", "power_off", "power_other"]
+logger_event_summary_enabled = False
+# If logger_event_sample_join_enabled is set, each event on the Logger Events sheet is given the data sheet row and
+# time of the nearest sample at or before it and after it, the rows as links to the data sheet. Excel allows at most
+# 65530 links on a sheet - rows beyond logger_event_link_limit are written as plain numbers. Off by default.
+logger_event_sample_join_enabled = False
+logger_event_link_limit = 65530
+
+# Track sections
+# If enabled, each sample is placed on the line by its odometer reading and the section of the line it is in is shown
+# on the data sheet. A trip is a run of samples with no gap longer than track_trip_gap_seconds. Each trip starts at
+# the km post of the latest entry in track_trip_starts at or before its first sample - entries are
+# ("yyyy/mm/dd hh:mm:ss", start km post, direction), direction 1 running towards higher km posts and -1 lower - or at
+# track_default_start_km, running towards higher km posts, if there is none. The sections and their speed limits are
+# read from track_sections_file (CSV: section,start_km,end_km,speed_limit_kph). A "Track Sections" sheet gives the
+# maximum speed in each section and lists the occasions the speed limit was exceeded by more than
+# overspeed_tolerance_kph. Nothing is done if the file holds no sections. Off by default. See quantum_sections.py.
+track_sections_enabled = False
+track_sections_file = 'track_sections.csv'
+track_trip_gap_seconds = 1800
+track_trip_starts = []
+track_default_start_km = 0.0
+overspeed_tolerance_kph = 0
+
+# Brake application analysis
+# If enabled, every brake application is found and written, with its depth, duration, speed at application and
+# release and the resulting deceleration, to a "Brake Applications" sheet, with a summary per trip (trips are split as
+# for the track sections, at gaps over track_trip_gap_seconds). Pressures here are as logged (psi). Off by default.
+#   automatic   - brake pipe reduced by at least brake_pipe_reduction_psi below the pressure it was charged to
+#   emergency   - an automatic application in which the brake pipe falls to brake_pipe_emergency_psi or below
+#   independent - brake cylinder at brake_cylinder_application_psi or more with no brake pipe reduction
+# See quantum_brakes.py.
+brake_analysis_enabled = False
+brake_pipe_reduction_psi = 5
+brake_pipe_emergency_psi = 0
+brake_cylinder_application_psi = 10
+
+# Safety input compliance
+# If enabled, the safety related digital inputs (named by their column headers) are checked against the rules below as
+# each sample is written, and a "Compliance" sheet gives a summary per rule and lists the exceptions. Off by default.
+# See quantum_compliance.py.
+#   headlight - while moving at least one of compliance_headlight_inputs must be on. Exceptions shorter than
+#               compliance_headlight_grace_seconds are ignored.
+#   vigilance - while moving vigilance_ack_input must come on at least every vigilance_ack_interval_seconds
+#   horn      - horn_input must have been on within horn_warning_seconds before each level crossing is passed.
+#               level_crossings entries are ("name", km post) - positions on the line are found as for the track
+#               sections (track_trip_starts etc.)
+#   EIE       - every occurrence of eie_input is listed, with the speed at the time
+compliance_enabled = False
+compliance_headlight_inputs = ["Light (S)", "Light (L)"]
+compliance_headlight_grace_seconds = 5
+vigilance_ack_input = "VS Ack"
+vigilance_ack_interval_seconds = 90
+horn_input = "Horn"
+horn_warning_seconds = 20
+level_crossings = []
+eie_input = "EIE"
+
+# TMC anomaly detection
+# If enabled, the TMC expected in each notch and speed band (tmc_anomaly_speed_band_mph wide, logger units) is learnt
+# as the samples are written, and samples whose TMC is tmc_anomaly_score_threshold or more standard deviations from it
+# (the deviation taken as at least tmc_anomaly_min_std_amps) are listed, with their score, on a "TMC Anomalies" sheet.
+# Samples are scored once their notch and speed band has been seen tmc_anomaly_min_samples times. The statistics
+# follow the latest tmc_anomaly_window_samples samples of each notch and speed band. Off by default.
+# See quantum_tmc.py.
+tmc_anomaly_detection_enabled = False
+tmc_anomaly_speed_band_mph = 10
+tmc_anomaly_score_threshold = 4.0
+tmc_anomaly_min_std_amps = 20
+tmc_anomaly_min_samples = 30
+tmc_anomaly_window_samples = 1000
+
+# Background writer
+# If enabled, the workbook is written, and closed, by a background process so that the writing overlaps with reading
+# and parsing the input. The calls to the workbook and its sheets are sent to it in batches of writer_batch_calls, at
+# most writer_queue_batches batches waiting - if the writer falls behind the parser waits. The writer is only started
+# if there are at least background_writer_min_cpus CPUs. Off by default - the workbook is written by the main process.
+# See quantum_writer.py.
+background_writer_enabled = False
+background_writer_min_cpus = 2
+writer_batch_calls = 10000
+writer_queue_batches = 8
+
+# Digital input transition analysis
+# If set, the on/off edges of each digital input (reverser changes, horn use, EIE, PCS, vigilance acknowledgements
+# etc.) are written to a separate sheet together with per input duty cycles and edge counts.
+# Inputs named (by column header) in the ignore list are included in the statistics but their edges are not listed.
+# Off by default.
+flag_transition_analysis_enabled = False
+flag_transition_ignore = ["DS1", "DS2", "Axle Drive"]
+
+# Parse error policy
+# "abort"    - processing stops at the first line that cannot be parsed (eg the wrong number of flags because the
+#              print setup in the QDP software was wrong, or a corrupt line)
+# "tolerant" - such lines are written, with their page number, line offset and the reason, to a "Rejected Lines" sheet
+#              (and a text file alongside the workbook if write_rejected_lines_file is set) and processing continues.
+# If more than max_reject_rate_percent of the lines processed are rejected the run fails once the outputs are written.
+parse_error_policy = "abort"
+max_reject_rate_percent = 1.0
+write_rejected_lines_file = True
+
+# PDF input
+# The text of PDF input files is extracted page by page. pdf_worker_processes sets the number of processes used for
+# the extraction (1 = extract in a single background thread). Each worker has at most pdf_pages_in_flight_per_worker
+# pages queued at a time. Extracted pages are cached in pdf_cache_directory (set to None to disable the cache).
+pdf_worker_processes = 4
+pdf_pages_in_flight_per_worker = 4
+pdf_cache_directory = 'output/pdf_cache'
+
+# Sample line layout detection
+# The speed and TMC fields are taken from fixed column positions as they run together when the TMC exceeds 3 digits.
+# The positions differ between QDP versions and print widths so, if enabled, they are derived from the column header
+# line (the line starting with layout_header_word) at the top of each page - the numeric fields are right aligned with
+# their header labels. The speed and TMC labels are recognised from the lists below. If the header cannot be
+# interpreted the default layout is used. A derived layout is only given up for the default once it has failed to
+# fit layout_failure_lines sample lines in a row - until then each line it does not fit is rejected on its own (with
+# the tolerant parse_error_policy - otherwise the default layout is tried on the first line that does not fit).
+layout_detection_enabled = True
+layout_failure_lines = 5
+layout_header_word = 'TIME'
+layout_speed_labels = ["SPEED", "SPD", "MPH"]
+layout_tmc_labels = ["TMC", "AMPS"]
+
+# Charts
+# If set, line charts of the channels listed in chart_channels (any of "Speed", "TMC", "BP", "BC", "Notch") against
+# time are added to a "Charts" sheet, one chart per channel for each period. chart_period is "day" (calendar day) or
+# "trip" (a run of samples with no gap longer than chart_trip_gap_seconds). The charted series are reduced to at most
+# chart_points_per_period points, kept on a hidden "Chart Data" sheet, so Excel stays responsive on long extracts.
+# No more than chart_max_periods periods are charted (0 = no limit). Off by default.
+charts_enabled = False
+chart_channels = ["Speed", "TMC", "BP", "BC", "Notch"]
+chart_period = "day"
+chart_trip_gap_seconds = 1800
+chart_points_per_period = 500
+chart_max_periods = 31
+
+# HTML report
+# If set, a static HTML report (no scripts or external references) is written alongside the workbook with trend plots
+# of the chart_channels, the logger events and the event analysis streams. Plots are report_plot_width pixels wide,
+# each pixel column showing the range of the samples falling in it, and report_plot_height pixels high.
+html_report_enabled = False
+report_plot_width = 1200
+report_plot_height = 200
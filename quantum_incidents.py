@@ -0,0 +1,135 @@
+"""
+
+Quantum Desktop Playback - incident windows
+
+Incident investigations start from a list of the times reported by the crew. The data either side of each time
+(cfg.incident_window_minutes before and after) is extracted to a workbook of its own, as if the input had been run
+with -b/-e set to the window, but from one parse of the input: each window is an output profile, and the records
+parsed are replayed for it.
+
+The incidents are read from cfg.incident_file, a CSV file:
+
+    timestamp,incident
+    2025/07/09 08:12:30,Rough handling reported at Mount Barker
+
+The timestamp is in one of the cfg.incident_timestamp_formats, the incident (a short name for it) is optional.
+
+Replaying every record parsed for each window would make the work grow with the number of incidents times the length
+of the input. Instead the records are indexed once by time - the non epoch dated samples sorted by their timestamp -
+and the records to replay for a window are found by binary search. The records written for a window are:
+
+    samples         the non epoch dated samples in the window
+    epoch samples   the epoch dated samples following a sample in the window (up to the next non epoch dated sample)
+                    or before the first non epoch dated sample, as for a -b/-e run - whether they are written is
+                    then decided by cfg.epoch_timestamps_allowed as usual
+    annotations     the annotations timed in the window
+
+The records are replayed in the order they were read, so a window that the logger clock passes through more than once
+(the clock is reset) gets all of its samples. An incident reported at a time the input does not cover gets a workbook
+with no records, and the other incidents are written as usual.
+
+"""
+
+import os
+import csv
+import numpy as np
+from datetime import datetime, timedelta
+
+
+# Kinds of records parsed
+SAMPLE = 0
+EPOCH_SAMPLE = 1
+ANNOTATION = 2
+
+
+def load_incidents(path, window_minutes, timestamp_formats):
+    """
+        Read the incidents file. Returns an output profile for each incident - its name and the start and end
+        timestamps of its window - in the order listed. Lines starting with # are comments.
+    """
+    incidents = []
+    if not os.path.isfile(path):
+        raise ValueError("Incident file " + path + " not found")
+    with open(path, newline="") as file:
+        rows = csv.reader(line for line in file if line.strip() and not line.lstrip().startswith("#"))
+        for line_number, row in enumerate(rows, 1):
+            if line_number == 1 and row[0].strip().lower() == "timestamp":
+                continue            # Column headings
+            incident_time = None
+            for timestamp_format in timestamp_formats:
+                try:
+                    incident_time = datetime.strptime(row[0].strip(), timestamp_format)
+                    break
+                except ValueError:
+                    pass
+            if incident_time is None or len(row) > 2:
+                raise ValueError("Invalid incident entry " + ",".join(row) + " in " + path)
+            incidents.append((incident_time, row[1].strip() if len(row) > 1 else ""))
+
+    window = timedelta(minutes=window_minutes)
+    digits = len(str(len(incidents)))
+    profiles = []
+    for number, (incident_time, incident) in enumerate(incidents, 1):
+        name = "incident_" + str(number).zfill(digits)
+        if incident:
+            name += "_" + "".join(character if character.isalnum() or character in "-_" else "_"
+                                  for character in incident)
+        profiles.append({"name": name,
+                         "filter_dates": True,
+                         "start_timestamp": (incident_time - window).strftime("%Y/%m/%d %H:%M:%S"),
+                         "end_timestamp": (incident_time + window).strftime("%Y/%m/%d %H:%M:%S")})
+    return profiles
+
+
+def record_index(kinds, seconds):
+    """
+        Index the records parsed, given the kind (SAMPLE, EPOCH_SAMPLE or ANNOTATION) and epoch seconds of each.
+        Returns a dictionary of arrays used by window_records.
+    """
+    kinds = np.asarray(kinds, dtype=np.int8)
+    seconds = np.asarray(seconds, dtype=np.int64)
+    positions = np.arange(len(kinds))
+    samples = np.flatnonzero(kinds == SAMPLE)
+    sample_order = samples[np.argsort(seconds[samples], kind="stable")]
+    annotations = np.flatnonzero(kinds == ANNOTATION)
+    annotation_order = annotations[np.argsort(seconds[annotations], kind="stable")]
+
+    # Position of the next non epoch dated sample after each record (the number of records if none), and of the
+    # latest sample and non epoch dated sample before it (-1 if none)
+    next_sample = np.full(len(kinds) + 1, len(kinds), dtype=np.int64)
+    next_sample[samples] = samples
+    next_sample = np.minimum.accumulate(next_sample[::-1])[::-1]
+    any_sample = np.where(kinds != ANNOTATION, positions, -1)
+    non_epoch = np.where(kinds == SAMPLE, positions, -1)
+    return {"kinds": kinds,
+            "seconds": seconds,
+            "sample_order": sample_order,
+            "sample_seconds": seconds[sample_order],
+            "annotation_order": annotation_order,
+            "annotation_seconds": seconds[annotation_order],
+            "next_sample": next_sample[1:],
+            "previous_sample": np.concatenate(([-1], np.maximum.accumulate(any_sample)[:-1])),
+            "previous_non_epoch": np.concatenate(([-1], np.maximum.accumulate(non_epoch)[:-1])),
+            "first_sample": next_sample[0]}
+
+
+def window_records(index, start_seconds, end_seconds):
+    """
+        Return the positions, in the order read, of the records to replay for a date window (inclusive)
+    """
+    sample_order = index["sample_order"]
+    low, high = np.searchsorted(index["sample_seconds"], [start_seconds, end_seconds + 1])
+    samples = sample_order[low:high]
+    low, high = np.searchsorted(index["annotation_seconds"], [start_seconds, end_seconds + 1])
+    annotations = index["annotation_order"][low:high]
+
+    # Each sample in the window is followed by the records up to the next non epoch dated sample, as are the records
+    # before the first non epoch dated sample
+    run_bounds = np.zeros(len(index["kinds"]) + 1, dtype=np.int64)
+    np.add.at(run_bounds, samples, 1)
+    np.add.at(run_bounds, index["next_sample"][samples], -1)
+    run_bounds[0] += 1
+    run_bounds[index["first_sample"]] -= 1
+    selected = np.cumsum(run_bounds[:-1]) > 0
+    selected[annotations] = True
+    return np.flatnonzero(selected)
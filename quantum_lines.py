@@ -0,0 +1,162 @@
+"""
+
+Quantum Desktop Playback - line classifier
+
+Each line of the report is one of a few kinds, recognised by how it starts:
+
+    page header     "Quantum Desktop Playback Page n     Report Date ..."
+    loco number     "Locomotive Number is   -   844"                        (page 1)
+    wheel size      "Circumference = 125.6 Diameter = 40.0"                 (page 1)
+    column header   "TIME      DATE         MILES SPD TMC ..."              (cfg.layout_header_word)
+    skipped         any other line starting with one of cfg.skip_list_words
+    sample          a line starting with a digit (the sample timestamp)
+    annotation      anything else - logger events such as "Power On 07:59:00- 07/09/2025"
+
+The kind is decided by a single anchored match of one compiled pattern, with an alternative per kind, and returned as
+one of the tags below for the dispatcher to switch on. Only the start of the line (after any indentation) is examined,
+so an annotation that happens to contain "Page" (or a skip word) further along is still an annotation - previously any
+line containing "Page" was taken as a page header. A sample must start at the beginning of the line.
+
+Run as a script to compare the time taken to classify the lines of a file with the substring checks used before:
+
+    quantum_lines.py "input files/JULY2025.prn" [-r repeats]
+
+"""
+
+import re
+import sys
+import time
+import argparse
+
+
+# Line kind tags - the names of the pattern groups
+PAGE_HEADER = "page_header"
+LOCO_NUMBER = "loco_number"
+WHEEL_SIZE = "wheel_size"
+COLUMN_HEADER = "column_header"
+SKIPPED = "skipped"
+SAMPLE = "sample"
+ANNOTATION = "annotation"
+
+page_header_pattern = re.compile(r"\s*Quantum Desktop Playback\s+Page\s+(\d+)")
+
+
+def compile_line_classifier(skip_words, header_word):
+    """
+        Build the function returning the kind of a (non empty) line. Lines starting with the header word are column
+        headers, other lines starting with any of the skip words are skipped. Leading whitespace is allowed before
+        all but a sample, whose fields are taken from fixed positions.
+    """
+    words = sorted((word for word in skip_words if word != header_word), key=len, reverse=True)
+    headings = "|".join([r"(?P<" + PAGE_HEADER + r">" + page_header_pattern.pattern + r")",
+                         r"(?P<" + LOCO_NUMBER + r">Locomotive Number)",
+                         r"(?P<" + WHEEL_SIZE + r">Circumference\b.*\bDiameter\b)",
+                         r"(?P<" + COLUMN_HEADER + r">" + re.escape(header_word) + r")"] +
+                        ([r"(?P<" + SKIPPED + r">" + "|".join(re.escape(word) for word in words) + r")"]
+                         if words else []))
+    pattern = re.compile(r"(?P<" + SAMPLE + r">\d)|\s*(?:" + headings + r")|(?P<" + ANNOTATION + r">)")
+    match = pattern.match
+
+    def classify_line(line):
+        return match(line).lastgroup
+
+    return classify_line
+
+
+def get_page_number(line):
+    """
+        Return the page number of a page header line
+    """
+    return int(page_header_pattern.match(line).group(1))
+
+
+def substring_classify_line(line, skip_words, header_word, page_1):
+    """
+        The checks made before the classifier - substring searches in turn - for comparison
+    """
+    if 'Page' in line:
+        return PAGE_HEADER
+    if not page_1:
+        for word in skip_words:
+            if word in line:
+                return COLUMN_HEADER if line.startswith(header_word) else SKIPPED
+        return SAMPLE if line[0].isnumeric() else ANNOTATION
+    if "Locomotive Number" in line:
+        return LOCO_NUMBER
+    if "Circumference" in line and "Diameter" in line:
+        return WHEEL_SIZE
+    return SKIPPED
+
+
+def benchmark_main(argv):
+    """
+        Time the classifier against the substring checks over the lines of a report file
+    """
+    import quantum_extraction_cfg as cfg
+
+    parser = argparse.ArgumentParser(prog="quantum_lines.py")
+    parser.add_argument('filename', help='report file (text) whose lines are classified')
+    parser.add_argument('-r', '--repeats', type=int, default=5, help='number of passes over the lines (default 5)')
+    args = parser.parse_args(argv)
+
+    with open(args.filename, errors="replace") as file:
+        lines = [line for raw_line in file for line in raw_line.rstrip().split('\x0c') if line]
+    page_1 = [True] * len(lines)
+    for index, line in enumerate(lines):
+        if page_header_pattern.match(line) and get_page_number(line) > 1:
+            page_1[index:] = [False] * (len(lines) - index)
+            break
+
+    classify_line = compile_line_classifier(cfg.skip_list_words, cfg.layout_header_word)
+    skip_words = cfg.skip_list_words
+    header_word = cfg.layout_header_word
+
+    timings = []
+    for name, classify in (("substring checks", lambda line, page: substring_classify_line(line, skip_words,
+                                                                                           header_word, page)),
+                           ("compiled classifier", lambda line, page: classify_line(line))):
+        best = None
+        for repeat in range(args.repeats):
+            started = time.perf_counter()
+            for line, page in zip(lines, page_1):
+                classify(line, page)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append((name, best))
+
+    # The overhead of the loop and the call, common to both, is taken from the time of a call doing nothing
+    best = None
+    for repeat in range(args.repeats):
+        started = time.perf_counter()
+        for line, page in zip(lines, page_1):
+            (lambda line, page: None)(line, page)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    overhead = best
+
+    kinds = dict()
+    differences = 0
+    for line, page in zip(lines, page_1):
+        kind = classify_line(line)
+        kinds[kind] = kinds.get(kind, 0) + 1
+        previous_kind = substring_classify_line(line, skip_words, header_word, page)
+        if page and kind not in (PAGE_HEADER, LOCO_NUMBER, WHEEL_SIZE):
+            kind = SKIPPED          # Nothing else is taken from page 1
+        if kind == WHEEL_SIZE and not page:
+            kind = ANNOTATION       # As the dispatcher treats it after page 1
+        if kind != previous_kind:
+            differences += 1
+            if differences <= 10:
+                print("Classified as " + kind + ", previously " + previous_kind + ": " + line)
+
+    print(str(len(lines)) + " lines: " + ", ".join(kind + " " + str(count) for kind, count in sorted(kinds.items())))
+    print(str(differences) + " lines classified differently")
+    print("{:<24} {:>12} {:>14}".format("Method", "Time (ms)", "ns per line"))
+    for name, elapsed in timings:
+        print("{:<24} {:>12.1f} {:>14.0f}".format(name, 1000 * elapsed,
+                                                  1e9 * (elapsed - overhead) / max(len(lines), 1)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(benchmark_main(sys.argv[1:]))
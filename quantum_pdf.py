@@ -0,0 +1,96 @@
+"""
+
+Quantum Desktop Playback - PDF input
+
+Reports received from other depots are often PDF prints of the QDP output rather than Generic Text prints. This module
+extracts the text of such a PDF so it can be fed, line by line, through the same processing as a text file.
+
+pdfplumber proved too slow on large reports so pypdf is used, in layout mode which preserves the fixed column positions
+the sample parser relies on. Pages are extracted lazily, in order, and can be spread over a pool of worker processes.
+Only a limited number of pages are in flight at any time so memory use does not grow with the size of the document.
+
+Extracted page text is cached on disk (cfg.pdf_cache_directory) keyed on the file path, size and modification time,
+so re-running a report over the same PDF - with a different date range for instance - skips the extraction.
+
+"""
+
+import os
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import quantum_extraction_cfg as cfg
+try:
+    import pypdf            # Optional - only needed for PDF input files
+except ImportError:
+    pypdf = None
+
+
+pdf_readers = dict()        # Open PdfReader objects in this process, keyed by path
+
+
+def pdf_cache_directory(path):
+    """
+        Return the page cache directory for a PDF file, or None if caching is disabled
+    """
+    if not cfg.pdf_cache_directory:
+        return None
+    status = os.stat(path)
+    key = os.path.abspath(path) + "|" + str(status.st_size) + "|" + str(status.st_mtime_ns)
+    return os.path.join(cfg.pdf_cache_directory, hashlib.sha1(key.encode()).hexdigest())
+
+
+def extract_pdf_page(path, page_index, cache_directory):
+    """
+        Return the text of one page of the PDF, from the cache if it is there. Runs in the worker processes.
+    """
+    cache_file = None
+    if cache_directory is not None:
+        cache_file = os.path.join(cache_directory, "page {:0>6d}.txt".format(page_index + 1))
+        if os.path.isfile(cache_file):
+            with open(cache_file, encoding="utf-8") as file:
+                return file.read()
+
+    reader = pdf_readers.get(path)
+    if reader is None:
+        reader = pypdf.PdfReader(path)
+        pdf_readers[path] = reader
+    text = reader.pages[page_index].extract_text(extraction_mode="layout")
+
+    if cache_file is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+        with open(cache_file + ".part", "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(cache_file + ".part", cache_file)
+    return text
+
+
+def pdf_page_count(path):
+    """
+        Return the number of pages in the PDF
+    """
+    return len(pypdf.PdfReader(path).pages)
+
+
+def extract_pdf_pages(path):
+    """
+        Generator - yield the text of each page of the PDF in page order, each followed by a form feed as the
+        Generic Text print driver does.
+    """
+    page_count = pdf_page_count(path)
+    cache_directory = pdf_cache_directory(path)
+
+    if cfg.pdf_worker_processes <= 1:
+        for page_index in range(page_count):
+            yield extract_pdf_page(path, page_index, cache_directory) + "\n\x0c"
+        return
+
+    # Spawned rather than forked workers as the pool is started from the input reader thread
+    in_flight = deque()
+    with ProcessPoolExecutor(cfg.pdf_worker_processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for page_index in range(page_count):
+            in_flight.append(pool.submit(extract_pdf_page, path, page_index, cache_directory))
+            if len(in_flight) >= cfg.pdf_worker_processes * cfg.pdf_pages_in_flight_per_worker:
+                yield in_flight.popleft().result() + "\n\x0c"
+        while in_flight:
+            yield in_flight.popleft().result() + "\n\x0c"
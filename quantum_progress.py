@@ -0,0 +1,127 @@
+"""
+
+Quantum Desktop Playback - progress reporting
+
+Progress is measured by the bytes of the source file read against its size (for compressed files, the compressed
+bytes; for PDF files, the pages extracted) rather than by lines, so it is known how far through a run is from the
+start. The reporter is called at each page of the report but only does anything when cfg.progress_interval_seconds
+has passed since it last reported, so its cost is negligible however many pages there are.
+
+Progress is shown on the console as a bar (if the progress module is installed and the console is a terminal) with
+the pages/s and samples/s rates and the estimated time remaining. Otherwise - output piped or logged - the same figures
+are printed as a line of text every cfg.progress_text_interval_seconds. It can also be written, as JSON, to a file for a
+batch scheduler to poll - the file is replaced as a whole each time so it can be read at any moment.
+
+"""
+
+import os
+import sys
+import json
+import time
+import quantum_extraction_cfg as cfg
+try:
+    from progress.bar import Bar        # Optional - only needed for the console progress bar
+except ImportError:
+    Bar = None
+
+
+progress_state = {}             # The latest progress figures, as written to the progress file
+progress_bar = None
+progress_text = False           # Progress is printed as text lines, as no bar can be shown
+progress_file = None
+progress_started = 0.0
+progress_reported = 0.0
+progress_printed = 0.0
+
+
+def start_progress(source_file, total_bytes, display, file_name):
+    """
+        Start reporting progress through the source file. The bar is displayed on the console if display is set,
+        the progress file is written if a file name is given.
+    """
+    global progress_bar
+    global progress_text
+    global progress_file
+    global progress_started
+    global progress_reported
+    global progress_printed
+
+    progress_started = progress_reported = progress_printed = time.monotonic()
+    progress_file = file_name
+    progress_state.clear()
+    progress_state.update({"source_file": source_file, "state": "running", "total_bytes": total_bytes,
+                           "bytes_read": 0, "percent": 0.0, "pages": 0, "samples": 0, "elapsed_seconds": 0.0,
+                           "pages_per_second": 0.0, "samples_per_second": 0.0, "eta_seconds": None})
+    progress_bar = None
+    if display and Bar is not None and sys.stderr.isatty():
+        progress_bar = Bar("Processing", max=max(total_bytes, 1),
+                           suffix="%(percent).1f%% page %(pages)d, %(pages_per_second).1f pages/s, "
+                                  "%(samples_per_second).0f samples/s, ETA %(eta_text)s")
+    progress_text = display and progress_bar is None
+    write_progress_file()
+
+
+def update_progress(bytes_read, pages, samples, force=False):
+    """
+        Report progress, if the reporting interval has passed since the last report (or force is set)
+    """
+    global progress_reported
+    global progress_printed
+
+    now = time.monotonic()
+    if not force and now - progress_reported < cfg.progress_interval_seconds:
+        return
+    progress_reported = now
+
+    elapsed = now - progress_started
+    total_bytes = progress_state["total_bytes"]
+    bytes_read = min(bytes_read, total_bytes)
+    eta_seconds = None
+    if bytes_read > 0 and elapsed > 0:
+        eta_seconds = round(elapsed * (total_bytes - bytes_read) / bytes_read, 1)
+    progress_state.update({"bytes_read": bytes_read,
+                           "percent": round(100.0 * bytes_read / total_bytes, 1) if total_bytes else 100.0,
+                           "pages": pages,
+                           "samples": samples,
+                           "elapsed_seconds": round(elapsed, 1),
+                           "pages_per_second": round(pages / elapsed, 2) if elapsed > 0 else 0.0,
+                           "samples_per_second": round(samples / elapsed, 1) if elapsed > 0 else 0.0,
+                           "eta_seconds": eta_seconds})
+
+    if progress_bar is not None:
+        progress_bar.pages = pages
+        progress_bar.pages_per_second = progress_state["pages_per_second"]
+        progress_bar.samples_per_second = progress_state["samples_per_second"]
+        progress_bar.eta_text = "--:--:--" if eta_seconds is None else time.strftime("%H:%M:%S",
+                                                                                     time.gmtime(eta_seconds))
+        progress_bar.goto(bytes_read)
+    elif progress_text and (force or now - progress_printed >= cfg.progress_text_interval_seconds):
+        progress_printed = now
+        print("Processing page " + str(pages) + " - {:.1f}%, {:.1f} pages/s, {:.0f} samples/s, ETA ".format(
+              progress_state["percent"], progress_state["pages_per_second"], progress_state["samples_per_second"]) +
+              ("--:--:--" if eta_seconds is None else time.strftime("%H:%M:%S", time.gmtime(eta_seconds))))
+    write_progress_file()
+
+
+def finish_progress(bytes_read, pages, samples, state="finished"):
+    """
+        Make the final progress report and close the console bar
+    """
+    global progress_bar
+
+    progress_state["state"] = state
+    update_progress(bytes_read, pages, samples, True)
+    if progress_bar is not None:
+        progress_bar.finish()
+        progress_bar = None
+
+
+def write_progress_file():
+    """
+        Replace the progress file, if there is one, with the latest progress figures
+    """
+    if not progress_file:
+        return
+    with open(progress_file + ".part", "w") as file:
+        json.dump(progress_state, file)
+    os.replace(progress_file + ".part", progress_file)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+
+Quantum Desktop Playback - regression harness
+
+Runs quantum_txt_extraction.py over the same input in the reference mode and in one or more alternative modes
+(different batch sizes, buffering, layout handling, background writing etc.) and compares the workbooks produced cell
+by cell - values, hidden rows (the suppressed stationary events), hidden columns and the sheets present - so that any
+change to the output made by a faster path shows up. The differences and the run times of each mode are reported side
+by side.
+
+Two existing workbooks can also be compared directly.
+
+The same comparison is run as a pytest suite, over the small report test_report.txt, by test_regression.py. The
+results of the analyses themselves are checked against that report by test_features.py.
+
+The workbooks are read with openpyxl, which is only needed for this harness.
+
+Command line arguments
+----------------------
+Switches                    Details
+-f --filename               input file to process
+-m --modes                  alternative modes to compare with the reference mode, comma separated (default all).
+                            Modes are listed by -l
+-l --list_modes             list the modes and exit
+-w --workbooks              compare these two workbooks rather than running the extraction
+-d --directory              directory for the workbooks produced (default a temporary directory, removed afterwards)
+-n --max_diffs              maximum number of differences listed per sheet (default 10)
+
+eg: quantum_regression.py -f "input files/JULY2025.prn" -m batch_1,ifa_spill
+
+The exit status is 1 if any differences were found.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+try:
+    import openpyxl         # Optional - only needed for the regression harness
+except ImportError:
+    openpyxl = None
+
+
+extraction_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "quantum_txt_extraction.py")
+
+# The reference mode and the alternative modes - each is a list of cfg overrides (name=value) applied on the command
+# line. Settings that write outside the workbook or vary from run to run are fixed for all modes, and the analyses
+# that are off by default are turned on so that their sheets are compared too.
+reference_mode = "reference"
+common_overrides = ["save_dataset=False", "progress_display=False", "progress_file=None", "html_report_enabled=False",
+                    "sampling_anomaly_detection_enabled=True", "flag_transition_analysis_enabled=True",
+                    "charts_enabled=True", "logger_event_summary_enabled=True",
+                    "logger_event_sample_join_enabled=True",
+                    "track_sections_enabled=True", "brake_analysis_enabled=True",
+                    "compliance_enabled=True", "tmc_anomaly_detection_enabled=True"]
+modes = {reference_mode: [],
+         "batch_1": ["conversion_batch_samples=1"],
+         "batch_large": ["conversion_batch_samples=1000000"],
+         "ifa_spill": ["ifa_buffer_items=1"],
+         "no_layout_detection": ["layout_detection_enabled=False"],
+         "background_writer": ["background_writer_enabled=True", "background_writer_min_cpus=1"],
+         "writer_small_batches": ["background_writer_enabled=True", "background_writer_min_cpus=1",
+                                  "writer_batch_calls=1", "writer_queue_batches=1"]}
+
+
+def run_mode(source_file, mode, directory):
+    """
+        Run the extraction in a mode. Returns the workbook path, the run time in seconds and the exit status.
+    """
+    workbook = os.path.join(directory, mode + ".xlsx")
+    started = time.perf_counter()
+    result = run_extraction(source_file, workbook, common_overrides + modes[mode])
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        print("Mode " + mode + " failed (exit status " + str(result.returncode) + "):")
+        print(result.stdout)
+    return workbook, elapsed, result.returncode
+
+
+def run_extraction(source_file, workbook, overrides, arguments=()):
+    """
+        Run the extraction writing the workbook, with the cfg overrides (name=value) and any other arguments.
+        Returns the completed process, its output (stdout and stderr together) as text.
+    """
+    command = [sys.executable, extraction_script, "-qq", "-f", source_file, "-o", workbook] + list(arguments)
+    for override in overrides:
+        command += ["-c", override]
+    return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+def sheet_cells(ws):
+    """
+        Return a dictionary of the non empty cell values of a sheet keyed by cell reference
+    """
+    cells = dict()
+    for row in ws.iter_rows():
+        for cell in row:
+            if cell.value is not None:
+                cells[cell.coordinate] = cell.value
+    return cells
+
+
+def compare_workbooks(reference_path, other_path, max_diffs):
+    """
+        Compare two workbooks sheet by sheet. Returns a list of (sheet, number of differences, listed differences).
+    """
+    reference = openpyxl.load_workbook(reference_path)
+    other = openpyxl.load_workbook(other_path)
+    results = []
+    for name in sorted(set(reference.sheetnames) | set(other.sheetnames), key=lambda name: (
+            name not in reference.sheetnames, reference.sheetnames.index(name) if name in reference.sheetnames else 0)):
+        if name not in other.sheetnames or name not in reference.sheetnames:
+            results.append((name, 1, ["sheet only in " + ("reference" if name in reference.sheetnames else "other")]))
+            continue
+        ws_reference = reference[name]
+        ws_other = other[name]
+        differences = []
+
+        cells_reference = sheet_cells(ws_reference)
+        cells_other = sheet_cells(ws_other)
+        for coordinate in sorted(set(cells_reference) | set(cells_other), key=cell_sort_key):
+            if cells_reference.get(coordinate) != cells_other.get(coordinate):
+                differences.append(coordinate + ": " + repr(cells_reference.get(coordinate)) + " != " +
+                                   repr(cells_other.get(coordinate)))
+
+        for kind, dimensions_reference, dimensions_other in (
+                ("hidden rows", ws_reference.row_dimensions, ws_other.row_dimensions),
+                ("hidden columns", ws_reference.column_dimensions, ws_other.column_dimensions)):
+            hidden_reference = {key for key, dimension in dimensions_reference.items() if dimension.hidden}
+            hidden_other = {key for key, dimension in dimensions_other.items() if dimension.hidden}
+            for key in sorted(hidden_reference ^ hidden_other, key=str):
+                differences.append(kind + ": " + str(key) + " hidden only in " +
+                                   ("reference" if key in hidden_reference else "other"))
+        if ws_reference.sheet_state != ws_other.sheet_state:
+            differences.append("sheet state " + ws_reference.sheet_state + " != " + ws_other.sheet_state)
+        results.append((name, len(differences), differences[:max_diffs]))
+    return results
+
+
+def cell_sort_key(coordinate):
+    """
+        Sort key putting cell references in row then column order
+    """
+    letters = coordinate.rstrip("0123456789")
+    return int(coordinate[len(letters):]), len(letters), letters
+
+
+def report_comparison(title, results):
+    """
+        Print the comparison results. Returns the total number of differences.
+    """
+    total = sum(count for name, count, listed in results)
+    print(title + ": " + ("no differences" if total == 0 else str(total) + " differences"))
+    for name, count, listed in results:
+        print("    {:<24} {:>8}".format(name, count))
+        for difference in listed:
+            print("        " + difference)
+        if count > len(listed):
+            print("        ... " + str(count - len(listed)) + " more")
+    return total
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="quantum_regression.py")
+    parser.add_argument('-f', '--filename', help='input file to process')
+    parser.add_argument('-m', '--modes', help='alternative modes to compare, comma separated (default all)')
+    parser.add_argument('-l', '--list_modes', help='list the modes and exit', action='store_true')
+    parser.add_argument('-w', '--workbooks', nargs=2, help='compare these two workbooks')
+    parser.add_argument('-d', '--directory', help='directory for the workbooks produced')
+    parser.add_argument('-n', '--max_diffs', type=int, default=10, help='maximum differences listed per sheet')
+    args = parser.parse_args(argv)
+
+    if args.list_modes:
+        for mode, overrides in modes.items():
+            print("{:<24} {}".format(mode, " ".join(overrides) if overrides else "(defaults)"))
+        return 0
+    if openpyxl is None:
+        print("Error: the openpyxl module is needed to compare workbooks")
+        return -1
+
+    if args.workbooks:
+        total = report_comparison(args.workbooks[0] + " v " + args.workbooks[1],
+                                  compare_workbooks(args.workbooks[0], args.workbooks[1], args.max_diffs))
+        return 1 if total else 0
+
+    if not args.filename:
+        parser.error("an input file (-f) or two workbooks (-w) are required")
+    selected = [mode for mode in modes if mode != reference_mode] if not args.modes else args.modes.split(",")
+    for mode in selected:
+        if mode not in modes:
+            parser.error("unknown mode " + mode)
+
+    directory = args.directory or tempfile.mkdtemp(prefix="quantum_regression_")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        reference_workbook, reference_time, status = run_mode(args.filename, reference_mode, directory)
+        if status != 0:
+            return -1
+        timings = [(reference_mode, reference_time, "")]
+        total = 0
+        for mode in selected:
+            workbook, elapsed, status = run_mode(args.filename, mode, directory)
+            if status != 0:
+                timings.append((mode, elapsed, "failed"))
+                total += 1
+                continue
+            differences = report_comparison(mode + " v " + reference_mode,
+                                            compare_workbooks(reference_workbook, workbook, args.max_diffs))
+            timings.append((mode, elapsed, "identical" if differences == 0 else str(differences) + " differences"))
+            total += differences
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print("")
+    print("{:<24} {:>10} {:>10}  {}".format("Mode", "Time (s)", "Relative", "Result"))
+    for mode, elapsed, result in timings:
+        print("{:<24} {:>10.2f} {:>10.2f}  {}".format(mode, elapsed, elapsed / reference_time, result))
+    return 1 if total else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,152 @@
+"""
+
+Quantum Desktop Playback - HTML report
+
+An alternative to the workbook for large extracts - the protected million row workbooks are slow to open on the depot
+laptops. The report is a single static HTML file, with no scripts and no external references, containing:
+
+    SVG trend plots of the key channels
+    The logger events table
+    The in flight analysis event streams
+
+The plots are decimated to a min/max envelope per pixel column - each column of the plot shows the lowest and highest
+values of the samples falling in it - so the size of the plot does not depend on the number of samples yet no peak is
+lost. The file is written sequentially, section by section, so the complete document is never held in memory.
+
+"""
+
+import html
+import numpy as np
+from datetime import datetime
+
+
+page_style = """body {font-family: Arial, Helvetica, sans-serif; font-size: 13px; margin: 20px;}
+h1 {font-size: 20px;} h2 {font-size: 16px; margin-top: 30px;}
+table {border-collapse: collapse;} th, td {border: 1px solid #ccc; padding: 2px 6px; text-align: right;}
+th {background: #eee;} td.text {text-align: left;} tr.fill td.fill {background: yellow;}
+tr.note td {text-align: left; font-weight: bold; border: none; padding-top: 10px;}
+svg {display: block; margin-bottom: 10px;} .envelope {fill: steelblue; stroke: steelblue; stroke-width: 1;}
+.axis {stroke: #999; stroke-width: 1;} .grid {stroke: #ddd; stroke-width: 1;} text {font-size: 11px;}
+"""
+
+plot_margin_left = 60
+plot_margin_bottom = 20
+plot_margin_top = 20
+
+
+def envelope(seconds, values, width):
+    """
+        Reduce the samples to the lowest and highest value in each of the width pixel columns of the plot. Columns
+        with no samples are NaN. Returns the minimum and maximum arrays.
+    """
+    start = seconds.min()
+    span = max(int(seconds.max()) - int(start), 1)
+    pixel_columns = ((seconds - start) * (width - 1) // span).astype(np.int64)
+    minimums = np.full(width, np.inf)
+    maximums = np.full(width, -np.inf)
+    np.minimum.at(minimums, pixel_columns, values)
+    np.maximum.at(maximums, pixel_columns, values)
+    empty = np.isinf(minimums)
+    minimums[empty] = np.nan
+    maximums[empty] = np.nan
+    return minimums, maximums
+
+
+def svg_trend_plot(title, seconds, values, width, height):
+    """
+        Return the SVG markup for a trend plot of the values against time, the envelope drawn as a filled polygon
+        for each run of pixel columns holding samples
+    """
+    plot_height = height - plot_margin_top - plot_margin_bottom
+    minimums, maximums = envelope(seconds, values, width)
+    low = float(np.nanmin(minimums))
+    high = float(np.nanmax(maximums))
+    if high == low:
+        high = low + 1
+
+    def y(value):
+        return plot_margin_top + plot_height - (value - low) * plot_height / (high - low)
+
+    parts = ['<svg width="' + str(width + plot_margin_left + 10) + '" height="' + str(height) + '">',
+             '<text x="' + str(plot_margin_left) + '" y="12" font-weight="bold">' + html.escape(title) + '</text>']
+    for value in np.linspace(low, high, 5):
+        parts.append('<line class="grid" x1="' + str(plot_margin_left) + '" x2="' + str(plot_margin_left + width) +
+                     '" y1="{0:.1f}" y2="{0:.1f}"/>'.format(y(value)))
+        parts.append('<text x="' + str(plot_margin_left - 5) + '" y="{:.1f}" text-anchor="end">{:g}</text>'
+                     .format(y(value) + 4, round(value, 1)))
+    parts.append('<line class="axis" x1="' + str(plot_margin_left) + '" x2="' + str(plot_margin_left) + '" y1="' +
+                 str(plot_margin_top) + '" y2="' + str(plot_margin_top + plot_height) + '"/>')
+
+    filled = ~np.isnan(minimums)
+    run_starts = np.flatnonzero(filled & ~np.concatenate(([False], filled[:-1])))
+    run_ends = np.flatnonzero(filled & ~np.concatenate((filled[1:], [False])))
+    for run_start, run_end in zip(run_starts, run_ends):
+        columns = np.arange(run_start, run_end + 1)
+        upper = ["{:.1f},{:.1f}".format(plot_margin_left + column, y(maximums[column])) for column in columns]
+        lower = ["{:.1f},{:.1f}".format(plot_margin_left + column, y(minimums[column])) for column in columns[::-1]]
+        parts.append('<polygon class="envelope" points="' + " ".join(upper + lower) + '"/>')
+
+    for x, anchor, timestamp in ((plot_margin_left, "start", seconds.min()),
+                                 (plot_margin_left + width, "end", seconds.max())):
+        parts.append('<text x="' + str(x) + '" y="' + str(height - 5) + '" text-anchor="' + anchor + '">' +
+                     datetime.fromtimestamp(int(timestamp)).strftime("%Y/%m/%d %H:%M:%S") + '</text>')
+    parts.append('</svg>')
+    return "\n".join(parts) + "\n"
+
+
+def table_row(cells, css_class=None, fill_cells=()):
+    """
+        Return the markup for a table row. Text cells are left aligned, fill_cells are the indexes of highlighted cells
+    """
+    row = '<tr class="' + css_class + '">' if css_class else '<tr>'
+    for index, cell in enumerate(cells):
+        classes = []
+        if isinstance(cell, str) and cell.strip() and not cell.replace(".", "").replace("-", "").isdigit():
+            classes.append("text")
+        if index in fill_cells:
+            classes.append("fill")
+        row += ('<td class="' + " ".join(classes) + '">' if classes else '<td>') + html.escape(str(cell)) + '</td>'
+    return row + '</tr>\n'
+
+
+def write_html_report(path, title, notes, plots, plot_width, plot_height, event_headers, events, stream_headers,
+                      stream_items):
+    """
+        Write the report to path in one pass.
+        notes           - list of lines (runtime modifiers and totals) shown under the title
+        plots           - list of (title, epoch seconds array, values array) tuples
+        events          - list of logger events table rows
+        stream_items    - iterable of ("note", text) or ("record", cells, fill cell indexes) tuples for the event
+                          streams, consumed as it is written
+    """
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>' + html.escape(title) +
+                   '</title>\n<style>\n' + page_style + '</style>\n</head>\n<body>\n')
+        file.write('<h1>' + html.escape(title) + '</h1>\n')
+        for note in notes:
+            file.write('<div>' + html.escape(note) + '</div>\n')
+
+        file.write('<h2>Trends</h2>\n')
+        for plot_title, seconds, values in plots:
+            if len(seconds):
+                file.write(svg_trend_plot(plot_title, seconds, values, plot_width, plot_height))
+
+        file.write('<h2>Logger events</h2>\n<table>\n')
+        file.write('<tr>' + "".join('<th>' + html.escape(header) + '</th>' for header in event_headers) + '</tr>\n')
+        for event in events:
+            file.write(table_row(event))
+        file.write('</table>\n')
+
+        if stream_items is not None:
+            file.write('<h2>Event analysis</h2>\n<table>\n')
+            file.write('<tr>' + "".join('<th>' + html.escape(header) + '</th>' for header in stream_headers) +
+                       '</tr>\n')
+            for item in stream_items:
+                if item[0] == "note":
+                    file.write('<tr class="note"><td colspan="' + str(len(stream_headers)) + '">' +
+                               html.escape(item[1]) + '</td></tr>\n')
+                else:
+                    file.write(table_row(item[1], "fill" if item[2] else None, item[2]))
+            file.write('</table>\n')
+
+        file.write('</body>\n</html>\n')
@@ -0,0 +1,149 @@
+"""
+
+Quantum Desktop Playback - track sections
+
+Each sample is placed on the line by its odometer reading. The km post at the start of a trip (a run of samples with
+no gap longer than cfg.track_trip_gap_seconds) is known - from cfg.track_trip_starts or cfg.track_default_start_km -
+and the distance travelled since is added to it (or taken from it if the trip runs towards the lower km posts).
+
+The sections of the line are read from cfg.track_sections_file, a CSV file:
+
+    section,start_km,end_km,speed_limit_kph
+    Mount Barker - Bugle Ranges,64.5,71.2,40
+
+Sections must not overlap - gaps between them are allowed, samples in a gap are in no section. The section starts
+are kept as a sorted array, so the sections of all the samples are found with one vectorised binary search, and the
+maximum speed and overspeed occurrences of each section are found with whole column operations.
+
+"""
+
+import os
+import csv
+import numpy as np
+from datetime import datetime
+
+
+def load_track_sections(path):
+    """
+        Read the track sections file. Returns the section names (list) and the start km, end km and speed limit
+        (arrays), in order of start km. Lines starting with # are comments.
+    """
+    sections = []
+    if path and os.path.isfile(path):
+        with open(path, newline="") as file:
+            rows = csv.reader(line for line in file if line.strip() and not line.lstrip().startswith("#"))
+            for line_number, row in enumerate(rows, 1):
+                if line_number == 1 and row[0].strip().lower() == "section":
+                    continue            # Column headings
+                try:
+                    name, start_km, end_km, speed_limit_kph = [field.strip() for field in row]
+                    sections.append((float(start_km), float(end_km), float(speed_limit_kph), name))
+                except ValueError:
+                    raise ValueError("Invalid track section entry " + ",".join(row) + " in " + path)
+    sections.sort()
+    for (start_km, end_km, limit, name), following in zip(sections, sections[1:] + [None]):
+        if end_km <= start_km:
+            raise ValueError("Track section " + name + " ends before it starts in " + path)
+        if following is not None and following[0] < end_km:
+            raise ValueError("Track sections " + name + " and " + following[3] + " overlap in " + path)
+    return ([section[3] for section in sections],
+            np.array([section[0] for section in sections], dtype=np.float64),
+            np.array([section[1] for section in sections], dtype=np.float64),
+            np.array([section[2] for section in sections], dtype=np.float64))
+
+
+def trip_starts(epoch_seconds, gap_seconds):
+    """
+        Return the positions of the first sample of each trip - a trip ends at a gap longer than gap_seconds
+        or a time reversal
+    """
+    epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64)
+    if len(epoch_seconds) == 0:
+        return np.array([], dtype=np.int64)
+    delta_seconds = np.diff(epoch_seconds)
+    return np.concatenate(([0], np.flatnonzero((delta_seconds > gap_seconds) | (delta_seconds < 0)) + 1))
+
+
+def start_points(trip_start_points, default_start_km):
+    """
+        Return the epoch seconds (sorted), start km posts and directions of the trip start points (see
+        line_positions) as arrays. The km post and direction arrays have the default as entry 0, so the entry of a
+        trip starting at a time is the np.searchsorted position (side="right") of the time in the seconds array.
+    """
+    points = sorted((int(datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S").timestamp()), float(start_km),
+                     1 if direction >= 0 else -1) for timestamp, start_km, direction in trip_start_points)
+    return (np.array([point[0] for point in points], dtype=np.int64),
+            np.array([default_start_km] + [point[1] for point in points], dtype=np.float64),
+            np.array([1] + [point[2] for point in points], dtype=np.float64))
+
+
+def line_positions(km, epoch_seconds, gap_seconds, trip_start_points, default_start_km):
+    """
+        Return the km post of each sample given the odometer readings (km). trip_start_points is a list of
+        (timestamp, start km post, direction) - each trip starts at the km post of the latest entry at or before its
+        first sample and runs in its direction (1 = towards higher km posts, -1 = lower). Trips before any entry
+        start at default_start_km and run towards higher km posts.
+    """
+    km = np.asarray(km, dtype=np.float64)
+    epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64)
+    starts = trip_starts(epoch_seconds, gap_seconds)
+    if len(starts) == 0:
+        return km.copy()
+
+    point_seconds, point_km, point_direction = start_points(trip_start_points, default_start_km)
+    trip_points = np.searchsorted(point_seconds, epoch_seconds[starts], side="right")
+
+    trip_numbers = np.zeros(len(km), dtype=np.int64)
+    trip_numbers[starts[1:]] = 1
+    trip_numbers = np.cumsum(trip_numbers)
+    travelled = km - km[starts][trip_numbers]
+    return point_km[trip_points][trip_numbers] + point_direction[trip_points][trip_numbers] * travelled
+
+
+def section_numbers(positions, section_starts, section_ends):
+    """
+        Return the number (position in the section table) of the section each km post is in, -1 if in none
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    if len(section_starts) == 0:
+        return np.full(len(positions), -1, dtype=np.int64)
+    numbers = np.searchsorted(section_starts, positions, side="right") - 1
+    inside = (numbers >= 0) & (positions < section_ends[np.clip(numbers, 0, None)])
+    return np.where(inside, numbers, -1)
+
+
+def overspeed_runs(numbers, speed, speed_limits, tolerance_kph):
+    """
+        Return the (first, last) sample positions of each run of consecutive samples in a section travelling faster
+        than its speed limit plus the tolerance
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    speed = np.asarray(speed, dtype=np.float64)
+    if len(numbers) == 0 or len(speed_limits) == 0:
+        return []
+    over = (numbers >= 0) & (speed > speed_limits[np.clip(numbers, 0, None)] + tolerance_kph)
+    # A run starts where a sample is over the limit and the previous one was not, or was in another section
+    previous_over = np.concatenate(([False], over[:-1]))
+    previous_numbers = np.concatenate(([-1], numbers[:-1]))
+    firsts = np.flatnonzero(over & (~previous_over | (numbers != previous_numbers)))
+    next_over = np.concatenate((over[1:], [False]))
+    next_numbers = np.concatenate((numbers[1:], [-1]))
+    lasts = np.flatnonzero(over & (~next_over | (numbers != next_numbers)))
+    return list(zip(firsts.tolist(), lasts.tolist()))
+
+
+def section_statistics(numbers, speed, section_count, runs):
+    """
+        Return, for each section, the number of samples, the maximum speed (None if no samples) and the number
+        of overspeed occurrences
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    speed = np.asarray(speed, dtype=np.float64)
+    inside = numbers >= 0
+    samples = np.bincount(numbers[inside], minlength=section_count)
+    maximum_speed = np.full(section_count, -np.inf)
+    np.maximum.at(maximum_speed, numbers[inside], speed[inside])
+    occurrences = np.bincount(np.array([numbers[first] for first, last in runs], dtype=np.int64),
+                              minlength=section_count)
+    return [(int(samples[number]), None if samples[number] == 0 else float(maximum_speed[number]),
+             int(occurrences[number])) for number in range(section_count)]
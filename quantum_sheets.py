@@ -0,0 +1,158 @@
+"""
+
+Quantum Desktop Playback - workbook styles and sheet templates
+
+Each kind of sheet written (data extract, logger events, runtime modifiers, event analysis etc.) is described once, as
+a template giving its column widths and formats, frozen panes and heading row. Sheets are created from the templates
+by add_sheet, and the cell formats are created once per workbook and shared by all its sheets, so adding a sheet - or
+a workbook, when several are written in one run - costs little and every sheet of a kind looks the same.
+
+The sheets added are recorded against their workbook so that finish_workbook can hide the unwanted columns and apply
+the protection to all of them, once, before closing it.
+
+If the background writer is running the workbook is created in the writer process, and the workbook, sheets and
+formats handed out are stand-ins whose calls are made there (see quantum_writer.py).
+
+"""
+
+import quantum_extraction_cfg as cfg
+import quantum_writer
+
+
+format_styles = {"left": {'align': 'left'},
+                 "right": {'align': 'right'},
+                 "centre": {'align': 'center'},
+                 "centre_bold": {'align': 'center', 'bold': True},
+                 "two_dp": {'num_format': '0.00'},
+                 "title": {'font_size': 14, 'bold': True},
+                 "fill": {'bg_color': 'yellow'},
+                 "timestamp": {'num_format': 'yyyy/mm/dd hh:mm:ss'}}
+
+# Sheet templates
+#   columns         - (column range, width, format style) for each range of columns
+#   headings        - the column headings written in row 1, "data" for the cfg.headers columns, or None
+#   heading_style   - format style of the heading row
+#   freeze          - freeze the title and heading rows
+#   hide_columns    - hide the cfg.headers columns marked as not visible
+#   hidden          - hide the sheet
+#   first_row       - first row (0 based) written below the headings
+data_sheet_template = {"columns": [("A:B", 15, "left"), ("C:C", 10, "two_dp"), ("D:H", 10, "right"),
+                                   ("I:S", 10, "centre"), ("T:T", 20, "left")],
+                       "headings": "data", "heading_style": "centre_bold", "freeze": True, "hide_columns": True,
+                       "first_row": 3}
+sheet_templates = {"Data Extract": data_sheet_template,
+                   "Event Analysis": data_sheet_template,
+                   "Logger Events": {"columns": [("A:B", 15, "left"), ("C:C", 50, "left"), ("D:F", 15, "left"),
+                                                 ("G:J", 18, "left")],
+                                     "headings": ["Event Date", "Event Time", "Event Type", "Prev Evt Date",
+                                                  "Prev Evt Time", "Offset"],
+                                     "heading_style": "title", "freeze": True, "first_row": 3},
+                   "Runtime modifiers": {"columns": [("A:A", 150, "left")], "freeze": True, "first_row": 3},
+                   "Sampling Anomalies": {"columns": [("A:A", 15, "left"), ("B:C", 12, None), ("D:E", 20, "left"),
+                                                      ("F:G", 12, None)],
+                                          "headings": ["Anomaly", "Prev Row", "Row", "Prev Sample", "Sample",
+                                                       "Delta (s)", "Delta (km)"],
+                                          "heading_style": "title", "freeze": True, "first_row": 3},
+                   "Flag Events": {"columns": [("A:A", 20, "left"), ("B:E", 12, None)],
+                                   "headings": ["Input", "Samples On", "Duty Cycle %", "On Edges", "Off Edges"],
+                                   "heading_style": "title", "freeze": True, "first_row": 3},
+                   "Rejected Lines": {"columns": [("A:B", 8, None), ("C:C", 50, "left"), ("D:D", 120, "left")],
+                                      "headings": ["Page", "Line", "Reason", "Text"],
+                                      "heading_style": "title", "freeze": True, "first_row": 3},
+                   "Event Summary": {"columns": [("A:A", 20, "left"), ("B:K", 15, None)],
+                                     "freeze": True, "first_row": 3},
+                   "Track Sections": {"columns": [("A:A", 30, "left"), ("B:G", 15, None)],
+                                      "headings": ["Section", "Start km", "End km", "Limit (kph)", "Samples",
+                                                   "Max Speed (kph)", "Overspeeds"],
+                                      "heading_style": "title", "freeze": True, "first_row": 3},
+                   "Brake Applications": {"columns": [("A:A", 15, "left"), ("B:C", 20, "left"), ("D:K", 15, None)],
+                                          "freeze": True, "first_row": 3},
+                   "Compliance": {"columns": [("A:A", 30, "left"), ("B:C", 20, "left"), ("D:G", 15, None),
+                                                  ("H:H", 60, "left")],
+                                  "freeze": True, "first_row": 3},
+                   "TMC Anomalies": {"columns": [("A:A", 20, "left"), ("B:B", 10, "centre"), ("C:H", 15, None)],
+                                     "headings": ["Time", "Throttle", "Speed (kph)", "TMC (A)", "Expected (A)",
+                                                  "Std Dev (A)", "Score", "Data Row"],
+                                     "heading_style": "title", "freeze": True, "first_row": 3},
+                   "Charts": {"first_row": 2},
+                   "Chart Data": {"hidden": True, "first_row": 1}}
+
+workbook_formats = dict()       # Workbook: {format style: Format}
+workbook_sheets = dict()        # Workbook: list of (Worksheet, template) for the sheets added
+
+
+def new_workbook(path):
+    """
+        Create a workbook
+    """
+    wb = quantum_writer.new_workbook(path, {'strings_to_numbers': True})
+    wb.set_size(1920, 1080)
+    workbook_formats[wb] = dict()
+    workbook_sheets[wb] = list()
+    return wb
+
+
+def workbook_format(wb, style):
+    """
+        Return the workbook's format for a style, creating it the first time it is used
+    """
+    formats = workbook_formats[wb]
+    if style not in formats:
+        formats[style] = wb.add_format(format_styles[style])
+    return formats[style]
+
+
+def data_headings():
+    """
+        Return the data sheet column headings, with the pressure unit in use
+    """
+    pressure_unit = "(kpa)" if cfg.report_kpa_pressures else "(psi)"
+    return [record[0].replace("(psi)", pressure_unit) for record in cfg.headers]
+
+
+def add_sheet(wb, template_name, title, sheet_name=None):
+    """
+        Add a sheet to the workbook from a template, writing the title (if any) and the headings.
+        The sheet is named after the template unless a name is given. Returns the sheet and the next row number.
+    """
+    template = sheet_templates[template_name]
+    ws = wb.add_worksheet(sheet_name or template_name)
+    workbook_sheets[wb].append((ws, template))
+
+    for columns, width, style in template.get("columns", []):
+        ws.set_column(columns, width, workbook_format(wb, style) if style else None)
+    if template.get("freeze"):
+        ws.freeze_panes(3, 0)
+    if template.get("hidden"):
+        ws.hide()
+    if title is not None:
+        ws.write(0, 0, title, workbook_format(wb, "title"))
+
+    headings = template.get("headings")
+    if headings == "data":
+        ws.set_row(1, None, workbook_format(wb, template["heading_style"]))
+        for column, heading in enumerate(data_headings()):
+            ws.write(1, column, heading)
+    elif headings:
+        for column, heading in enumerate(headings):
+            ws.write(1, column, heading, workbook_format(wb, template["heading_style"]))
+    return ws, template["first_row"]
+
+
+def hide_columns(ws, headers):
+    """ Hide any column with False in the header tuple """
+    for column, record in enumerate(headers):
+        if not record[1]:
+            ws.set_column(column, column, None, None, {'hidden': True})
+
+
+def finish_workbook(wb):
+    """
+        Hide the unwanted columns and protect every sheet added to the workbook, then close it
+    """
+    del workbook_formats[wb]
+    for ws, template in workbook_sheets.pop(wb):
+        if template.get("hide_columns"):
+            hide_columns(ws, cfg.headers)
+        ws.protect(cfg.protect_string, cfg.protection_mode)
+    wb.close()
@@ -0,0 +1,77 @@
+"""
+
+Quantum Desktop Playback - TMC anomaly detector
+
+The event analysis looks for one kind of anomalous traction motor current - current drawn with the throttle in idle,
+the signature of arcing contactors. This detector generalises it to every notch: the TMC expected in each notch and
+speed band (cfg.tmc_anomaly_speed_band_mph wide) is learnt from the samples as they are written, and each sample is
+scored by how far its TMC is from the expected value, in standard deviations:
+
+    score = (TMC - mean) / max(standard deviation, cfg.tmc_anomaly_min_std_amps)
+
+Samples scoring cfg.tmc_anomaly_score_threshold or more either way are anomalies, once the notch and speed band have
+been seen in cfg.tmc_anomaly_min_samples samples. The floor on the standard deviation stops the many samples of
+exactly 0 A in idle making every small current an anomaly.
+
+The mean and variance of each notch and speed band are updated incrementally (Welford), weighting each sample 1/n
+until cfg.tmc_anomaly_window_samples have been seen and 1/window after that, so the statistics follow slow changes
+(wheel wear, load) rather than the whole history. An anomaly is added to the statistics clipped to the threshold so
+that a burst of arcing does not teach the detector to expect it. Each sample costs a dictionary lookup and a few
+arithmetic operations whatever the length of the report.
+
+"""
+
+import math
+import quantum_extraction_cfg as cfg
+
+
+notch_statistics = dict()       # (throttle position, speed band): [samples, mean TMC, variance]
+
+
+def start_detector():
+    """
+        Forget the statistics learnt, before the first sample is scored
+    """
+    notch_statistics.clear()
+
+
+def score_sample(throttle_position, speed, tmc):
+    """
+        Score a sample (throttle position, speed in mph and TMC as logged) against the statistics of its notch and
+        speed band, then add it to them. Returns (expected TMC, standard deviation, score) if it is an anomaly,
+        otherwise None.
+    """
+    key = (throttle_position, int(speed // cfg.tmc_anomaly_speed_band_mph))
+    statistics = notch_statistics.get(key)
+    if statistics is None:
+        statistics = notch_statistics[key] = [0, 0.0, 0.0]
+    samples, mean, variance = statistics
+
+    anomaly = None
+    value = tmc
+    if samples >= cfg.tmc_anomaly_min_samples:
+        deviation = math.sqrt(variance)
+        spread = max(deviation, cfg.tmc_anomaly_min_std_amps)
+        score = (tmc - mean) / spread
+        if abs(score) >= cfg.tmc_anomaly_score_threshold:
+            anomaly = (mean, deviation, score)
+            value = mean + math.copysign(cfg.tmc_anomaly_score_threshold * spread, score)
+
+    samples += 1
+    weight = max(1.0 / samples, 1.0 / cfg.tmc_anomaly_window_samples)
+    delta = value - mean
+    mean += weight * delta
+    variance = (1.0 - weight) * (variance + weight * delta * delta)
+    statistics[0] = samples
+    statistics[1] = mean
+    statistics[2] = variance
+    return anomaly
+
+
+def detector_summary():
+    """
+        Return the (throttle position, speed band, samples, mean TMC, standard deviation) of each notch and speed band
+        seen, in order of throttle position and speed band
+    """
+    return [(throttle_position, band, samples, mean, math.sqrt(variance))
+            for (throttle_position, band), (samples, mean, variance) in sorted(notch_statistics.items())]
@@ -61,10 +61,52 @@ Switches                    Details                         Effect
 -i --integer_idle           If set, IDLE throttle position records will be reported as integer 0 in the spreadsheet
                             to facilitate adding charts. Over-rides the config file entry idle_as_digit
 -t --text_idle              The reverse of -i - IDLE events will be recorded as text "Idle"
+-r --reject_bad_lines       Lines that cannot be parsed     over-rides cfg.parse_error_policy
+                            are set aside in a rejected
+                            lines sheet/file and processing
+                            continues
+-m --max_reject_rate        Percentage of rejected lines    over-rides cfg.max_reject_rate_percent
+                            above which the run fails
+-x --html_report            Write an HTML report, with      over-rides cfg.html_report_enabled
+                            trend plots, the logger events
+                            and the event analysis streams,
+                            alongside the workbook
+-d --save_dataset           Save the samples written as a   over-rides cfg.save_dataset
+                            dataset for the query sub
+                            command
+-g --progress_file          File to which progress is       over-rides cfg.progress_file
+                            written (JSON) - bytes read,
+                            pages and samples per second,
+                            ETA - for a batch scheduler
+-o --output_workbook        Workbook path, used as given    over-rides cfg.workbook_path
+                            (no loco number or date is
+                            added)
+-c --cfg                    Over-ride any configuration     eg: -c conversion_batch_samples=1 -c charts_enabled=True
+                            setting, NAME=VALUE. May be     The value is a Python literal, or is taken as a string
+                            repeated.
+-I --incidents              CSV file of incident times      over-rides cfg.incident_file
+                            (timestamp,incident). The data
+                            either side of each is written
+                            to its own workbook from one
+                            parse of the input
+-W --incident_window        Minutes either side of each     over-rides cfg.incident_window_minutes
+                            incident written
+-P --profile                Add an output profile,          over-rides cfg.output_profiles
+                            NAME:SETTING=VALUE,... May be   eg: -P psi:report_kpa_pressures=False
+                            repeated. Each profile is           -P kpa:report_kpa_pressures=True,idle_as_digit=True
+                            written to its own workbook
+                            (the name is appended to the
+                            workbook name) from one parse
+                            of the input
 -q --quiet                  Control amount of information displayed on console during processing:
-                            -q      - no page number indications
+                            -q      - no page number indications (or progress bar)
                             -qq     - no page numbers or inflight analysis processing indications
 
+query                       Sub command - query the         See quantum_dataset.py for the query switches
+                            datasets saved by previous      eg: quantum_txt_extraction.py query -l 844
+                            runs (cfg.save_dataset, -d)        -b 2025/03/01 -e 2025/03/31
+                                                                -w "throttle == idle" -a "max(tmc)"
+
 -------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -182,6 +224,156 @@ March 2023	GJN	Initial Creation
                 -q suppresses page numbers
                 -qq suppresses page numbers and inflight analysis event indications on console
 
+2026/10/19      Add sampling anomaly detection. Once all records are processed the sample timestamps and odometer
+                readings are checked, as whole columns, for gaps, duplicated timestamps, time reversals and odometer
+                jumps inconsistent with the recorded speed. These are written to a "Sampling Anomalies" sheet with the
+                data sheet row numbers of the samples concerned. Requires numpy. Turned on by
+                cfg.sampling_anomaly_detection_enabled.
+
+2026/10/19      Save the processed data samples as a columnar dataset (one numpy file per column plus a time index)
+                when cfg.save_dataset is set, and add the "query" sub command to run filter/aggregate queries over
+                the saved datasets without re-running the extraction. See quantum_dataset.py.
+
+2026/10/19      The digital input flags are now packed into an integer per sample (first flag in bit 0) rather than
+                kept as a list of strings. Add flag transition analysis - on/off edges of each input are found by
+                XOR'ing the flags of adjacent samples and written, with per input duty cycles and edge counts, to a
+                "Flag Events" sheet if cfg.flag_transition_analysis_enabled is set. Datasets store the packed flags,
+                the query tool unpacks them by name.
+
+2026/10/19      Add a parse error policy. By default (abort) a line that cannot be parsed stops processing as before,
+                now with the reason and page number. With the tolerant policy (-r) such lines are quarantined, with
+                their page number, line offset within the page and reason, to a "Rejected Lines" sheet and text file
+                and processing continues. The reject rate is reported at the end and the run fails if it exceeds
+                cfg.max_reject_rate_percent.
+
+2026/10/19      Accept compressed input files (gzip, bzip2, xz and, if the zstandard module is installed, zstd). The
+                compression is detected from the leading bytes of the file and the file is decompressed as it is read,
+                in a separate thread feeding a pipe, so archived reports are processed without inflating them to disk.
+
+2026/10/19      PDF input is back. PDF files (recognised by their leading bytes) have their text extracted page by page
+                with pypdf in layout mode, which is much faster than pdfplumber, optionally spread over a pool of
+                worker processes and with a per page cache on disk. The text is fed through the same line processing
+                as a text file. See quantum_pdf.py.
+
+2026/10/19      The speed and TMC field positions of the sample lines are no longer hard coded. The column header
+                line ("TIME ...") at the top of each page is analysed, once per distinct header, to derive the layout
+                and a parser for that layout is built and cached, so reports from other QDP versions and print widths
+                parse correctly. If the header cannot be interpreted, or the derived layout does not fit the sample
+                lines, the original layout is used.
+
+2026/10/19      In flight analysis event streams are no longer written to the workbook as they are detected. They are
+                buffered, spilling to a temporary file when the buffer is full, and written in one sequential batch at
+                the end, optionally to a separate workbook. The number of streams kept can be capped and/or sampled
+                and very long streams are cut down to their first records plus a ring buffer of their latest ones, so
+                a faulty loco (or a zero TMC threshold) cannot blow up memory or runtime.
+
+2026/10/19      Add a "Charts" sheet with line charts of speed, TMC, brake pipe and cylinder pressures and throttle
+                notch against time, one set per day (or per trip). The charts reference downsampled series (the
+                extreme value in each bucket of samples, so peaks survive) held on a hidden "Chart Data" sheet rather
+                than the data sheet, so the workbook stays responsive whatever the size of the extract. Set
+                cfg.charts_enabled to add them.
+
+2026/10/19      Add an optional HTML report (-x), a single static file with SVG trend plots, the logger events table
+                and the event analysis streams, for extracts too large to open comfortably as a workbook. The plots
+                are reduced to a min/max envelope per pixel column so their size does not depend on the number of
+                samples. See quantum_report.py.
+
+2026/10/19      Unit conversion is done in one place, quantum_units.py, on batches of samples rather than value by
+                value as each row is written. The samples are kept as logged and converted a batch at a time, the data
+                sheet rows being written as each batch is converted, so every output reports the same values. Miles
+                are now converted with the exact factor (1.609344) rather than 1.6, and psi to kPa likewise. The query
+                tool reports pressures in the units of the original run unless -k or -p is given.
+
+2026/10/19      Wheel diameters are taken from a calibration store (cfg.wheel_calibration_file) holding the history
+                of each loco's wheel diameter with effective dates, falling back to cfg.wheel_dia_actual_mm. The speed
+                correction for each sample uses the diameter in force when it was recorded, resolved for each batch
+                of samples at once, so files recorded before a wheel re-profile are corrected properly without
+                editing the configuration between runs. The configuration module is no longer modified at run time.
+                See quantum_calibration.py.
+
+2026/10/19      Sheets are created from templates (column widths and formats, frozen panes, headings) and the cell
+                formats are created once per workbook and shared, rather than re-created for every sheet. Column
+                hiding and protection are applied to all the sheets of a workbook in one step when it is closed.
+                See quantum_sheets.py.
+
+2026/10/19      Progress is reported by bytes of the source file read against its size, with pages/s, samples/s and
+                an ETA, on a console progress bar (replacing the line printed per page) and optionally as JSON in a
+                progress file (-g) for a batch scheduler. Reports are throttled to a few a second.
+                See quantum_progress.py.
+
+2026/10/19      Add a regression harness, quantum_regression.py, which runs the extraction over the same input in
+                the reference mode and in alternative modes (conversion batch size, event analysis buffering, layout
+                detection) and compares the workbooks cell by cell, including hidden rows and columns, reporting the
+                differences and the run time of each mode. To support it the workbook path can be given exactly (-o)
+                and any configuration setting over-ridden on the command line (-c). The harness runs as a pytest
+                suite over test_report.txt (test_regression.py), and test_features.py checks the result of each
+                analysis on that report.
+
+2026/10/19      Lines are classified (page header, column header, page 1 loco number and wheel size, skipped,
+                sample or annotation) by one anchored match of a compiled pattern on how they start, rather than
+                a chain of substring searches. An annotation containing "Page" is no longer taken as a page
+                header, and skip words only apply at the start of a line (after any indentation, which every
+                line but a sample may have). See quantum_lines.py, which also
+                benchmarks the classifier against the old checks.
+
+2026/10/19      Logger events are kept in a catalog (quantum_events.py), typed by kind (power on/off, laptop
+                connected, download, settings change, brake pipe transition, suppression marker etc. - patterns in
+                cfg.logger_event_kinds) with epoch seconds, and indexed by time once the report is read so the
+                intervals between events of a kind are found in bulk. An "Event Summary" sheet
+                (cfg.logger_event_summary_enabled) gives the events of each kind per day and the intervals between
+                them. The Logger Events offsets and the intervals are between the times as reported, so are not put
+                out by daylight saving.
+
+2026/10/19      Each event on the Logger Events sheet is joined to the data samples - the data sheet row (as a
+                link to it) and time of the nearest sample at or before and after the event are added - using a
+                binary search of the sorted sample times for each event, if cfg.logger_event_sample_join_enabled
+                is set.
+
+2026/10/19      Several output profiles (combinations of pressure units, idle as digit, stationary event
+                suppression and date window - cfg.output_profiles or -P) can be written from one parse of the
+                input, each to its own workbook. The parsed records are kept while the first profile is written
+                and replayed for the others, and the sampling anomaly and digital input analyses are shared by
+                profiles with the same date window. Sample parsing (parse_sample) is now separate from writing
+                (write_sample), and the output state is set up by reset_output_state for each profile.
+
+2026/10/19      Add track sections. Each sample is placed on the line (km post) from its odometer reading and the
+                start point of its trip, and its section is found from the table in cfg.track_sections_file with a
+                vectorised binary search of the sorted section starts. The section is shown on the data sheet, and a
+                "Track Sections" sheet gives the maximum speed in each section and lists the overspeeds. Turned on
+                by cfg.track_sections_enabled. See quantum_sections.py.
+
+2026/10/19      Add brake application analysis. Every automatic (brake pipe reduction), emergency and independent
+                (brake cylinder rise without a brake pipe reduction) application is found, with its depth, duration,
+                speed at application and release and the deceleration, using whole column differences, running
+                maxima and reductions over the sample arrays so the time taken grows linearly with the samples.
+                A "Brake Applications" sheet lists them, with a summary per trip, when cfg.brake_analysis_enabled
+                is set. See quantum_brakes.py.
+
+2026/10/19      Add safety input compliance checks, made on each sample as it is written: headlight on while moving,
+                vigilance acknowledged in time while moving, horn sounded before each level crossing and EIE
+                occurrences with their speed. The exceptions are written to a "Compliance" sheet as they close, with
+                a summary per rule, so only the state of each rule is kept. Turned on by cfg.compliance_enabled.
+                See quantum_compliance.py.
+
+2026/10/19      Add a TMC anomaly detector for every notch, not only idle. The mean and variance of the TMC in each
+                notch and speed band are updated incrementally as the samples are written, and samples whose TMC
+                is several standard deviations from the expected value are listed with their score on a
+                "TMC Anomalies" sheet, if cfg.tmc_anomaly_detection_enabled is set. See quantum_tmc.py.
+
+2026/10/19      The workbook can be written by a background process (quantum_writer.py) so that writing the cells
+                and closing (building and compressing) the workbook overlap with reading and parsing the input, the
+                analyses and saving the dataset. The calls to the workbook and its sheets are sent in order, in
+                batches, on a bounded queue - the parser waits if the writer falls behind - so the workbook is exactly
+                as written directly. If the writer process fails, the run stops with its error. Off by default -
+                set cfg.background_writer_enabled to True to use it.
+
+2026/10/19      Incident windows - the data either side (cfg.incident_window_minutes, -W) of each time listed in the
+                cfg.incident_file (-I) CSV file is written to a workbook of its own, with the epoch dated records in
+                the window as for a -b/-e run, from one parse of the input. Each window is an output profile. The
+                records of date filtered profiles are no longer all replayed - the parsed records are indexed once by
+                time and only those in the window replayed. See quantum_incidents.py.
+                -e no longer fails checking for the start timestamp.
+
 -------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -227,32 +419,84 @@ the interval if either record has an epoch datestamp.
 #import pprint
 import os
 import sys
-import xlsxwriter
+import bz2
+import gzip
+import lzma
+import pickle
+import tempfile
+import threading
+import re
+import ast
 import argparse
+import numpy as np
+from array import array
 from collections import deque
 from datetime import datetime
 import quantum_extraction_cfg as cfg
+import quantum_dataset
+import quantum_pdf
+import quantum_report
+import quantum_units
+import quantum_calibration
+import quantum_sheets
+import quantum_progress
+import quantum_lines
+import quantum_events
+import quantum_sections
+import quantum_brakes
+import quantum_compliance
+import quantum_tmc
+import quantum_writer
+import quantum_incidents
+from datetime import timedelta
+try:
+    import zstandard        # Optional - only needed for zstd compressed input files
+except ImportError:
+    zstandard = None
 
 
 loco_number = ""
 old_page_number=0
 current_page_number=0
-old_record_date="None"
-old_record_time="None"
-writing_records_to_xls=True     # Only used when filtering records based on date.
-
-first_datestamp_written=[None,None]
-last_non_epoch_datestamp_written=[None,None]
-last_datestamp_written=[None,None]
-
-previous_event_speed=-1 # Used to track loco stationary event sequences
-previous_event_tmc=-1
-previous_throttle_position=""
-suppressed_stationary_event_count=0
-first_suppressed_timestamp=""
-last_suppressed_timestamp=""
-suppressed_rows=list()      # Stores row numbers with suppressed events, used to hide said rows
-previous_event_brake_pipe_pressure=-1   # Brake pipe pressure
+rejected_lines=list()       # (page number, line in page, reason, line) for lines that could not be parsed
+line_number_in_page=0
+count_lines_processed=0
+flag_columns = quantum_dataset.flag_column_names()
+flag_cell_values = dict()               # Packed flags value: tuple of Y/N cell values, filled as values are seen
+wheel_history = None                   # Wheel diameter history of the loco, from quantum_calibration
+
+# Output profiles. Several workbooks, each with its own combination of the cfg.output_profile_settings, can be
+# written from one parse of the input. The records parsed (sample tuples and annotation lines) are kept in
+# parsed_records while the first profile is written, and replayed for each of the others.
+output_profile_name = None             # Name of the profile being written, None if there are no profiles
+output_profile_base = dict()           # The cfg values of the profile settings before any profile was applied
+parsed_records = None
+parsed_record_index = None             # Time index of parsed_records, for replaying date windows (quantum_incidents)
+analysis_cache = dict()                # Date window: (sampling anomalies, flag transitions) - shared by profiles
+track_sections = None                  # Section names, start km, end km and speed limit arrays, read once
+workbooks_written = list()             # Workbooks closed by the writer process, reported once it has finished
+
+# Compressed input files are recognised by their leading (magic) bytes
+compression_signatures = [(b'\x1f\x8b', "gzip"),
+                          (b'BZh', "bzip2"),
+                          (b'\xfd7zXZ\x00', "xz"),
+                          (b'\x28\xb5\x2f\xfd', "zstd")]
+pdf_signature = b'%PDF'
+decompression_chunk_size = 1024 * 1024
+source_reader_thread = None            # Thread decompressing or extracting the source file, if required
+source_reader_error = None             # Set by the source reader thread if it fails
+source_bytes_read = 0                  # Progress of the source reader thread through the source file
+source_file = None                     # The source file, as opened for reading text
+
+# Sample line layouts are (speed position, speed length, tmc position, tmc length) tuples. The default is that of
+# the Generic Text print of the QDP version in use at SteamRanger.
+default_sample_layout = (28, 4, 32, 4)
+sample_parsers = dict()                # Layout: compiled parser function
+header_sample_layouts = dict()         # Column header line: layout derived from it
+current_sample_layout = default_sample_layout
+current_sample_parser = None           # Parser for current_sample_layout, compiled in main
+sample_layout_failures = 0             # Sample lines in a row the current (derived) layout has not fitted
+classify_line = None                   # Line classifier, from quantum_lines, compiled once the cfg is final
 
 global wb_name
 global workbook
@@ -271,6 +515,12 @@ global ws_row_annotations
 global ws_modifiers
 global ws_in_flight_analysis
 global ws_row_in_flight_analysis
+global ws_sampling_anomalies
+global ws_row_sampling_anomalies
+global ws_flag_events
+global ws_row_flag_events
+global ws_rejected_lines
+global ws_row_rejected_lines
 global lalign
 global cell_fill
 global old_record_data
@@ -278,8 +528,111 @@ global in_suppression_mode
 
 
 
-if cfg.in_flight_analysis_enabled:
-    previous_events_deque = deque(maxlen = cfg.ifa_deque_maxlen)    # This will hold (n) data points for analysis
+def reset_output_state():
+    """
+        Set the state of the output - the workbook contents derived from the parsed records - to its initial values.
+        Called before the records are written for each output profile.
+    """
+    global old_record_date
+    global old_record_time
+    global writing_records_to_xls
+    global first_datestamp_written
+    global last_non_epoch_datestamp_written
+    global last_datestamp_written
+    global previous_event_speed
+    global previous_event_tmc
+    global previous_throttle_position
+    global suppressed_stationary_event_count
+    global first_suppressed_timestamp
+    global last_suppressed_timestamp
+    global suppressed_rows
+    global logger_events
+    global previous_event_brake_pipe_pressure
+    global sample_columns
+    global converted_columns
+    global pending_samples
+    global count_data_samples
+    global count_in_flight_analysis
+    global count_epoch_events
+    global count_suppressed_events
+    global start_timestamp_epoch_seconds
+    global end_timestamp_epoch_seconds
+    global previous_events_deque
+    global ifa_stream_tail
+    global ifa_buffer
+    global ifa_spill_file
+    global ifa_stream_kept
+    global ifa_stream_records
+    global count_in_flight_analysis_kept
+
+    old_record_date="None"
+    old_record_time="None"
+    writing_records_to_xls=True     # Only used when filtering records based on date.
+
+    first_datestamp_written=[None,None]
+    last_non_epoch_datestamp_written=[None,None]
+    last_datestamp_written=[None,None]
+
+    previous_event_speed=-1 # Used to track loco stationary event sequences
+    previous_event_tmc=-1
+    previous_throttle_position=""
+    suppressed_stationary_event_count=0
+    first_suppressed_timestamp=""
+    last_suppressed_timestamp=""
+    suppressed_rows=list()      # Stores row numbers with suppressed events, used to hide said rows
+    logger_events=list()        # Logger events table rows for the HTML report
+    previous_event_brake_pipe_pressure=-1   # Brake pipe pressure
+
+    # Columnar copy of the data samples written to the data sheet. The post processing stages work on whole
+    # columns at once rather than row by row, and the columns are saved as a dataset for the query tool.
+    # Values are as logged (miles, mph, psi). Row is the (0 based) data sheet row the sample was written to.
+    sample_columns = {"epoch_seconds": array('q'),
+                      "mileage": array('d'),
+                      "speed": array('l'),
+                      "tmc": array('l'),
+                      "bp": array('l'),
+                      "bc": array('l'),
+                      "throttle": array('b'),
+                      "flags": array('H'),
+                      "row": array('l')}
+
+    # The samples converted to the reported units (km, wheel corrected kph, psi or kpa), a batch at a time, by
+    # quantum_units. The data sheet rows are written as each batch is converted, pending_samples holding the
+    # (row, date, time, throttle position, fill) of the samples waiting for conversion.
+    converted_columns = {"km": array('d'),
+                         "speed": array('l'),
+                         "bp": array('l'),
+                         "bc": array('l')}
+    pending_samples = list()
+
+    count_data_samples=0
+    count_epoch_events=0
+    count_suppressed_events=0
+    count_in_flight_analysis=0
+    start_timestamp_epoch_seconds = get_epoch(cfg.start_timestamp)
+    end_timestamp_epoch_seconds = get_epoch(cfg.end_timestamp)
+
+    if cfg.in_flight_analysis_enabled:
+        previous_events_deque = deque(maxlen = cfg.ifa_deque_maxlen)    # This will hold (n) data points for analysis
+        ifa_stream_tail = deque(maxlen = cfg.ifa_stream_tail_records)   # Latest records of a stream over the record limit
+    cfg.ifa_in_event_of_interest = False
+
+    if ifa_spill_file is not None:
+        ifa_spill_file.close()
+    ifa_buffer = list()             # In flight analysis items waiting to be written to the workbook
+    ifa_spill_file = None           # Temporary file holding in flight analysis items spilled from the buffer
+    ifa_stream_kept = False         # The current stream is to be written to the workbook
+    ifa_stream_records = 0          # Records in the current stream after the lead in records
+    count_in_flight_analysis_kept = 0
+
+    quantum_events.clear_catalog()
+    if cfg.compliance_enabled:
+        quantum_compliance.start_compliance()
+    if cfg.tmc_anomaly_detection_enabled:
+        quantum_tmc.start_detector()
+
+
+ifa_spill_file = None           # Closed by reset_output_state if a previous output profile spilled to it
 
 def main():
     # pp = pprint.PrettyPrinter(indent=4)
@@ -301,17 +654,33 @@ def main():
 
     global start_timestamp_epoch_seconds
     global end_timestamp_epoch_seconds
+    global source_file
+    global classify_line
+    global current_sample_parser
+    global parsed_records
 
     process_command_line_args()
-
-    start_timestamp_epoch_seconds = get_epoch(cfg.start_timestamp)
-    end_timestamp_epoch_seconds = get_epoch(cfg.end_timestamp)
-
-    count_data_samples=0
-    count_epoch_events=0
-    count_suppressed_events=0
-    if cfg.in_flight_analysis_enabled:
-        count_in_flight_analysis=0
+    classify_line = quantum_lines.compile_line_classifier(cfg.skip_list_words, cfg.layout_header_word)
+    current_sample_parser = get_sample_parser(current_sample_layout)
+    quantum_writer.start_writer()
+
+    # The first output profile is written as the input is parsed, the others from the parsed records afterwards
+    output_profiles = list(cfg.output_profiles)
+    if cfg.incident_file:
+        try:
+            output_profiles += quantum_incidents.load_incidents(cfg.incident_file, cfg.incident_window_minutes,
+                                                                cfg.incident_timestamp_formats)
+        except ValueError as e:
+            print("Error: " + str(e))
+            sys.exit(1)
+        print(str(len(output_profiles) - len(cfg.output_profiles)) + " incident windows of " +
+              str(cfg.incident_window_minutes) + " minutes either side read from " + cfg.incident_file)
+    if not output_profiles:
+        output_profiles = [None]
+    apply_output_profile(output_profiles[0])
+    reset_output_state()
+    if len(output_profiles) > 1:
+        parsed_records = list()
 
     if cfg.filter_dates:
         print("Record filtering enabled")
@@ -334,19 +703,33 @@ def main():
         print("Stationary loco events are included in report")
     if cfg.report_kpa_pressures:
         print("Pressures will be reported in kpa")
+    if cfg.save_dataset:
+        print("Dataset will be saved to " + cfg.dataset_directory)
+    if cfg.html_report_enabled:
+        print("HTML report will be written")
 
     print("Input = " + cfg.source_file)
 
     try:
-        with open(cfg.source_file) as file:
-            while raw_line := file.readline():
-                # We need to examine the line to see if there is a FORM FEED (0x0C) within it, if so
-                # the line needs to be split on that character and each half treated as a separate line
-                # The W11 print to Generic Text or the Quantum software inserts FFs at the end of the page
-                raw_line = raw_line.rstrip()
-                lines = raw_line.split('\x0c')
-                for line in lines:
-                    process_line(line)
+        with open_source_file(cfg.source_file) as file:
+            source_file = file
+            quantum_progress.start_progress(cfg.source_file, os.path.getsize(cfg.source_file),
+                                            cfg.progress_display and cfg.quiet == 0, cfg.progress_file)
+            try:
+                while raw_line := file.readline():
+                    # We need to examine the line to see if there is a FORM FEED (0x0C) within it, if so
+                    # the line needs to be split on that character and each half treated as a separate line
+                    # The W11 print to Generic Text or the Quantum software inserts FFs at the end of the page
+                    raw_line = raw_line.rstrip()
+                    lines = raw_line.split('\x0c')
+                    for line in lines:
+                        process_line(line)
+            except RuntimeError as e:
+                # The writer process has stopped
+                quantum_progress.finish_progress(source_position(), current_page_number, count_data_samples,
+                                                 "failed")
+                print("Error: " + str(e))
+                sys.exit(-1)
     except FileNotFoundError:
         print('Error: The file ',cfg.source_file, 'was not found.')
         sys.exit(-1)
@@ -356,10 +739,192 @@ def main():
     except IOError as e:
         print(f"An I/O error occurred: {e}")
         sys.exit(-1)
+    if source_reader_thread is not None:
+        source_reader_thread.join()
+    if source_reader_error is not None:
+        quantum_progress.finish_progress(source_position(), current_page_number, count_data_samples, "failed")
+        print("Error: Unable to read " + cfg.source_file + " - " + str(source_reader_error))
+        sys.exit(-1)
+    quantum_progress.finish_progress(os.path.getsize(cfg.source_file), current_page_number, count_data_samples)
+    # The workbooks are written from here on - by the writer process if it is running, which may have stopped
+    try:
+        reject_rate = finish_output()
+
+        if cfg.save_dataset:
+            dataset_columns = {column: values for column, values in sample_columns.items() if column != "row"}
+            dataset_meta = {"loco_number": loco_number,
+                            "source_file": cfg.source_file,
+                            "workbook": wb_name,
+                            "speed_adjustment_factor": cfg.speed_adjustment_factor}
+            if cfg.speed_adjustment_factor == 0 and wheel_history is not None:
+                dataset_meta["wheel_diameter_qdp_inches"] = wheel_diameter_qdp_inches
+                dataset_meta["wheel_calibration"] = [[int(effective_seconds), float(wheel_dia_mm)]
+                                                     for effective_seconds, wheel_dia_mm in zip(*wheel_history)]
+            dataset_path = quantum_dataset.save_dataset(dataset_columns,
+                                                        {**dataset_meta,
+                                                         "kpa_pressures": cfg.report_kpa_pressures,
+                                                         "ts_adjustment": cfg.ts_adjustment,
+                                                         "flag_columns": flag_columns,
+                                                         "first_record": datestamp_text(first_datestamp_written),
+                                                         "last_record": datestamp_text(last_datestamp_written)},
+                                                        cfg.dataset_directory)
+            print("Written dataset : " + dataset_path)
+
+        for profile in output_profiles[1:]:
+            apply_output_profile(profile)
+            reset_output_state()
+            create_workbook()
+            replay_parsed_records()
+            finish_output()
+
+        quantum_writer.stop_writer()
+    except RuntimeError as e:
+        print("Error: " + str(e))
+        sys.exit(-1)
+    for name in workbooks_written:
+        print("Written file : " + name)
+
+    if reject_rate > cfg.max_reject_rate_percent:
+        print("FATAL: {:.2f}% of lines were rejected, the limit is ".format(reject_rate) +
+              str(cfg.max_reject_rate_percent) + "%. Check the input file")
+        sys.exit(1)
+
+
+
+def apply_output_profile(profile):
+    """
+        Set the cfg values of an output profile - a dictionary holding the profile name and any of the
+        cfg.output_profile_settings. Settings not in the profile keep the values they had before any profile was
+        applied. A profile giving a start or end timestamp turns on date filtering unless it says otherwise.
+    """
+    global output_profile_name
+
+    if profile is None:
+        return
+    if not output_profile_base:
+        output_profile_base.update((setting, getattr(cfg, setting)) for setting in cfg.output_profile_settings)
+    for setting, value in output_profile_base.items():
+        setattr(cfg, setting, value)
+    for setting, value in profile.items():
+        if setting != "name":
+            setattr(cfg, setting, value)
+    if ("start_timestamp" in profile or "end_timestamp" in profile) and "filter_dates" not in profile:
+        cfg.filter_dates = True
+    output_profile_name = profile["name"]
+    print("\nOutput profile " + output_profile_name + ": " + ", ".join(
+        setting + " = " + str(getattr(cfg, setting)) for setting in cfg.output_profile_settings))
+
+
+def replay_parsed_records():
+    """
+        Write the records kept from the parse of the input (see process_sample) for another output profile. If the
+        profile filters on date only the records in its window are replayed (see quantum_incidents), the state the
+        records skipped would have left being set before each run of records replayed.
+    """
+    global parsed_record_index
+    global count_epoch_events
+    global old_record_date
+    global old_record_time
+    global writing_records_to_xls
+
+    if not cfg.filter_dates:
+        for record in parsed_records:
+            if isinstance(record, str):
+                write_annotation(record, True)
+            else:
+                write_sample(record)
+        return
+
+    if parsed_record_index is None:
+        parsed_record_index = index_parsed_records()
+    kinds = parsed_record_index["kinds"]
+    seconds = parsed_record_index["seconds"]
+    positions = quantum_incidents.window_records(parsed_record_index, start_timestamp_epoch_seconds,
+                                                 end_timestamp_epoch_seconds)
+    previous_position = -1
+    for position in positions.tolist():
+        if position != previous_position + 1:
+            previous_sample = parsed_record_index["previous_sample"][position]
+            if previous_sample >= 0:
+                old_record_date, old_record_time = parsed_records[previous_sample][:2]
+            previous_non_epoch = parsed_record_index["previous_non_epoch"][position]
+            writing_records_to_xls = previous_non_epoch < 0 or \
+                start_timestamp_epoch_seconds <= seconds[previous_non_epoch] <= end_timestamp_epoch_seconds
+        if kinds[position] == quantum_incidents.ANNOTATION:
+            write_annotation(parsed_records[position], True)
+        else:
+            write_sample(parsed_records[position])
+        previous_position = position
+    # Every epoch dated sample is counted, written or not
+    count_epoch_events += int(np.count_nonzero(kinds == quantum_incidents.EPOCH_SAMPLE)) - int(
+        np.count_nonzero(kinds[positions] == quantum_incidents.EPOCH_SAMPLE))
+
+
+def index_parsed_records():
+    """
+        Index parsed_records by time (see quantum_incidents.record_index). The epoch seconds of the samples are found
+        once per hour of the day rather than once per sample.
+    """
+    hour_seconds = dict()           # (date, hour): epoch seconds at the start of the hour
+    kinds = []
+    seconds = []
+    for record in parsed_records:
+        if isinstance(record, str):
+            kinds.append(quantum_incidents.ANNOTATION)
+            seconds.append(annotation_timestamp(record)[2])
+            continue
+        record_date, record_time = record[:2]
+        hour, minute, second = record_time.split(":")
+        if (record_date, hour) not in hour_seconds:
+            hour_seconds[(record_date, hour)] = get_epoch_seconds(record_date + " " + hour + ":00:00")
+        kinds.append(quantum_incidents.EPOCH_SAMPLE if check_for_epoch_year(record_date) else quantum_incidents.SAMPLE)
+        seconds.append(hour_seconds[(record_date, hour)] + int(minute) * 60 + int(second))
+    return quantum_incidents.record_index(kinds, seconds)
+
+
+def finish_output():
+    """
+        Once all the records have been written, write the remaining samples, the analyses, statistics and totals,
+        close the workbook and write the HTML report. Returns the percentage of lines rejected.
+    """
+    global ws_row_modifiers
+
+    if pending_samples:
+        write_pending_samples()
 
     if cfg.suppress_stationary_events:
         hide_suppressed_rows(ws_data_samples,suppressed_rows)
 
+    if cfg.in_flight_analysis_enabled:
+        write_in_flight_analysis_streams()
+
+    # The analyses depend only on the samples written, which are the same for all profiles with the same date window
+    window = (cfg.filter_dates, start_timestamp_epoch_seconds, end_timestamp_epoch_seconds)
+    if window not in analysis_cache:
+        analysis_cache[window] = (
+            detect_sampling_anomalies(sample_columns) if cfg.sampling_anomaly_detection_enabled else None,
+            detect_flag_transitions(sample_columns) if cfg.flag_transition_analysis_enabled else None,
+            detect_brake_applications(sample_columns) if cfg.brake_analysis_enabled else None)
+    anomalies, flag_transitions, brake_applications = analysis_cache[window]
+    if cfg.sampling_anomaly_detection_enabled:
+        count_sampling_anomalies = write_sampling_anomalies(anomalies, sample_columns)
+    if cfg.flag_transition_analysis_enabled:
+        flag_edges, flag_statistics = flag_transitions
+        count_flag_transitions = write_flag_transitions(flag_edges, flag_statistics, sample_columns)
+    if cfg.logger_event_summary_enabled:
+        write_event_summary()
+    if cfg.logger_event_sample_join_enabled:
+        write_event_sample_links(sample_columns)
+    if track_sections_written():
+        count_overspeeds = write_track_sections(sample_columns)
+    if cfg.brake_analysis_enabled:
+        count_brake_applications = write_brake_applications(brake_applications, sample_columns)
+    if cfg.compliance_enabled:
+        count_compliance_exceptions = write_compliance_summary()
+    if cfg.tmc_anomaly_detection_enabled:
+        count_tmc_anomalies = write_tmc_statistics()
+    if cfg.charts_enabled:
+        count_chart_periods = write_charts(sample_columns)
 
     print("\nProcessing statistics")
     print("=====================")
@@ -367,11 +932,36 @@ def main():
     print(str(count_epoch_events)+" epoch dated events processed")
     if cfg.in_flight_analysis_enabled:
         print(str(count_in_flight_analysis)+" analysis streams processed")
+        if count_in_flight_analysis_kept != count_in_flight_analysis:
+            print(str(count_in_flight_analysis_kept)+" analysis streams written")
     print(str(count_suppressed_events) + " stationary loco events suppressed")
+    print(str(len(quantum_events.event_kinds)) + " logger events catalogued")
+    if cfg.sampling_anomaly_detection_enabled:
+        print(str(count_sampling_anomalies) + " sampling anomalies detected")
+    if cfg.flag_transition_analysis_enabled:
+        print(str(count_flag_transitions) + " digital input transitions detected")
+    if track_sections_written():
+        print(str(count_overspeeds) + " overspeed occurrences in " + str(len(track_sections[0])) + " track sections")
+    if cfg.brake_analysis_enabled:
+        print(str(count_brake_applications) + " brake applications detected")
+    if cfg.compliance_enabled:
+        print(str(count_compliance_exceptions) + " compliance exceptions found")
+    if cfg.tmc_anomaly_detection_enabled:
+        print(str(count_tmc_anomalies) + " TMC anomalies detected")
+    if cfg.charts_enabled:
+        print(str(count_chart_periods) + " " + cfg.chart_period + "s charted")
+    reject_rate = 100.0 * len(rejected_lines) / count_lines_processed if count_lines_processed else 0.0
+    if cfg.parse_error_policy == "tolerant":
+        print(str(len(rejected_lines)) + " lines rejected ({:.2f}% of lines processed)".format(reject_rate))
     print("")
-    print("First record written = "+first_datestamp_written[0]+" "+first_datestamp_written[1])
-    print("Last record written =  "+last_datestamp_written[0]+" "+last_datestamp_written[1])
-    if (last_non_epoch_datestamp_written[0] != last_datestamp_written [0]) and \
+    if first_datestamp_written[0] is None:
+        print("No records written" + (" - none are in the window of output profile " + output_profile_name
+                                      if output_profile_name else ""))
+    else:
+        print("First record written = "+first_datestamp_written[0]+" "+first_datestamp_written[1])
+        print("Last record written =  "+last_datestamp_written[0]+" "+last_datestamp_written[1])
+    if last_non_epoch_datestamp_written[0] is not None and \
+        (last_non_epoch_datestamp_written[0] != last_datestamp_written [0]) and \
         (last_non_epoch_datestamp_written[1] != last_datestamp_written[1]):
         print("Last non-epoch record written =  " + last_non_epoch_datestamp_written[0] + " " + last_non_epoch_datestamp_written[1])
 
@@ -384,53 +974,240 @@ def main():
     if cfg.in_flight_analysis_enabled:
         ws_modifiers.write(ws_row_modifiers, 0,"Totals: " + str(count_in_flight_analysis)+" analysis streams processed")
         ws_row_modifiers += 1
+        if count_in_flight_analysis_kept != count_in_flight_analysis:
+            ws_modifiers.write(ws_row_modifiers, 0,"Totals: " + str(count_in_flight_analysis_kept)+" analysis streams written")
+            ws_row_modifiers += 1
     ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(count_suppressed_events)+" stationary loco events suppressed")
     ws_row_modifiers += 1
+    if cfg.sampling_anomaly_detection_enabled:
+        ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(count_sampling_anomalies)+" sampling anomalies detected")
+        ws_row_modifiers += 1
+    if cfg.flag_transition_analysis_enabled:
+        ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(count_flag_transitions)+" digital input transitions detected")
+        ws_row_modifiers += 1
+    if cfg.charts_enabled:
+        ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(count_chart_periods)+" "+cfg.chart_period+"s charted")
+        ws_row_modifiers += 1
+    if track_sections_written():
+        ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(count_overspeeds)+" overspeed occurrences")
+        ws_row_modifiers += 1
+    if cfg.brake_analysis_enabled:
+        ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(count_brake_applications)+" brake applications detected")
+        ws_row_modifiers += 1
+    if cfg.compliance_enabled:
+        ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(count_compliance_exceptions)+" compliance exceptions found")
+        ws_row_modifiers += 1
+    if cfg.tmc_anomaly_detection_enabled:
+        ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(count_tmc_anomalies)+" TMC anomalies detected")
+        ws_row_modifiers += 1
+    if cfg.parse_error_policy == "tolerant":
+        ws_modifiers.write(ws_row_modifiers, 0, "Totals: "+str(len(rejected_lines))+
+                           " lines rejected ({:.2f}% of lines processed)".format(reject_rate))
+        ws_row_modifiers += 1
+        write_rejected_lines(ws_rejected_lines, ws_row_rejected_lines)
 
 
-    hide_columns(ws_data_samples, cfg.headers)
-    if cfg.in_flight_analysis_enabled:
-        hide_columns(ws_in_flight_analysis, cfg.headers)
-    ws_data_samples.protect(cfg.protect_string,cfg.protection_mode)
-    ws_annotations.protect(cfg.protect_string,cfg.protection_mode)
-    ws_modifiers.protect(cfg.protect_string,cfg.protection_mode)
-    if cfg.in_flight_analysis_enabled:
-        ws_in_flight_analysis.protect(cfg.protect_string, cfg.protection_mode)
-    workbook.close()
-    print("Written file : " + wb_name)
+    quantum_sheets.finish_workbook(workbook)        # Hides columns and protects all the sheets
+    report_written_workbook(wb_name)
+
+    if cfg.html_report_enabled:
+        report_notes = ["First record written = " + datestamp_text(first_datestamp_written),
+                        "Last record written = " + datestamp_text(last_datestamp_written),
+                        str(count_data_samples) + " data points processed",
+                        str(count_epoch_events) + " epoch dated events processed",
+                        str(count_suppressed_events) + " stationary loco events suppressed"]
+        if cfg.in_flight_analysis_enabled:
+            report_notes.append(str(count_in_flight_analysis) + " analysis streams processed")
+        print("Written file : " + write_report(report_notes))
+    return reject_rate
+
+
+def report_written_workbook(name):
+    """
+        Report a workbook as written - at once if it was written directly, or once the writer process has finished
+        (and so has closed it) if not
+    """
+    if quantum_writer.writer_process is None:
+        print("Written file : " + name)
+    else:
+        workbooks_written.append(name)
+
+
+def open_source_file(path):
+    """
+        Open the source file for reading as text. Compressed files (gzip, bzip2, xz or zstd) and PDF files are
+        recognised by their magic bytes. Compressed files are decompressed as they are read, PDF files have the text
+        of each page extracted (see quantum_pdf.py). Either way the work runs in a separate thread which feeds the text
+        through a pipe, so it overlaps the parsing of the lines without inflating the file to disk.
+    """
+    with open(path, "rb") as file:
+        magic = file.read(6)
+
+    if magic.startswith(pdf_signature):
+        if quantum_pdf.pypdf is None:
+            print("Error: " + path + " is a PDF file but the pypdf module is not installed")
+            sys.exit(-1)
+        if cfg.quiet < 2:
+            print("Input is a PDF file")
+        return open_pipe_reader(pdf_page_chunks(path), "w")
+
+    compression = None
+    for signature, name in compression_signatures:
+        if magic.startswith(signature):
+            compression = name
+    if compression is None:
+        return open(path)
+
+    if compression == "zstd" and zstandard is None:
+        print("Error: " + path + " is zstd compressed but the zstandard module is not installed")
+        sys.exit(-1)
+    if cfg.quiet < 2:
+        print("Input is " + compression + " compressed")
+    return open_pipe_reader(decompressed_chunks(path, compression), "wb")
+
+
+def open_pipe_reader(chunks, mode):
+    """
+        Start a thread writing the chunks (bytes or text as given by mode) into a pipe and return the read end of the
+        pipe opened as a text file
+    """
+    global source_reader_thread
+
+    read_fd, write_fd = os.pipe()
+    source_reader_thread = threading.Thread(target=feed_pipe, args=(chunks, mode, write_fd), daemon=True)
+    source_reader_thread.start()
+    return open(read_fd)
+
+
+def feed_pipe(chunks, mode, write_fd):
+    """
+        Thread function - write the chunks into the write end of a pipe, then close it to signal end of file.
+        Any error is left in source_reader_error for the main thread to report.
+    """
+    global source_reader_error
+
+    try:
+        with open(write_fd, mode) as pipe:
+            for chunk in chunks:
+                pipe.write(chunk)
+    except BrokenPipeError:
+        pass        # The main thread stopped reading
+    except Exception as e:      # Reported by the main thread once the pipe is closed
+        source_reader_error = e
 
 
+def decompressed_chunks(path, compression):
+    """
+        Generator - yield the decompressed content of the file in chunks. The position reached in the compressed
+        file is kept in source_bytes_read for the progress reporting.
+    """
+    global source_bytes_read
+
+    raw = open(path, "rb")
+    if compression == "gzip":
+        source = gzip.GzipFile(fileobj=raw, mode="rb")
+    elif compression == "bzip2":
+        source = bz2.BZ2File(raw, "rb")
+    elif compression == "xz":
+        source = lzma.LZMAFile(raw, "rb")
+    else:
+        source = zstandard.ZstdDecompressor().stream_reader(raw)
+    with raw, source:
+        while chunk := source.read(decompression_chunk_size):
+            source_bytes_read = raw.tell()
+            yield chunk
+
+
+def pdf_page_chunks(path):
+    """
+        Generator - yield the text of each page of a PDF file. The proportion of the pages extracted, as a
+        proportion of the file size, is kept in source_bytes_read for the progress reporting.
+    """
+    global source_bytes_read
+
+    file_size = os.path.getsize(path)
+    page_count = max(quantum_pdf.pdf_page_count(path), 1)
+    for page_number, text in enumerate(quantum_pdf.extract_pdf_pages(path), 1):
+        source_bytes_read = file_size * page_number // page_count
+        yield text
+
+
+def source_position():
+    """
+        Return the number of bytes of the source file read so far
+    """
+    if source_reader_thread is not None:
+        return source_bytes_read
+    return source_file.buffer.tell()
+
 
 def process_line(line):
     """
         Process each line, if we are in page 1 we set a number of variables based on the contents.
         For other pages, if the line starts with a number (ie a date record) then we pass it to the data sampling function
         otherwise it's an annotation so we write it to the annotation worksheet
+        Lines that cannot be parsed are handled according to the parse error policy (see reject_line) - only the
+        parsing of the line is guarded, errors in writing the output are not taken for bad lines
+    """
+    global line_number_in_page
+    global count_lines_processed
+
+    line_number_in_page += 1
+    if len(line)==0:
+        return
+    count_lines_processed += 1
+
+    dispatch_line(line)
+
+
+def dispatch_line(line):
+    """
+        Pass the line to the function that handles its type of content
     """
     global old_page_number
     global loco_number
     global wheel_diameter_qdp_inches
+    global wheel_history
     global current_page_number
+    global line_number_in_page
 
-    if len(line)==0:
-        return
+    line_kind = classify_line(line)
 
-    if 'Page' in line:
-        current_page_number = get_page_number(line)
-        if cfg.quiet==0:
+    if line_kind == quantum_lines.PAGE_HEADER:
+        try:
+            current_page_number = quantum_lines.get_page_number(line)
+        except (ValueError, IndexError) as e:
+            reject_line(line, rejection_reason(e))
+            return
+        line_number_in_page = 0
+        if cfg.progress_display or cfg.progress_file:
+            quantum_progress.update_progress(source_position(), current_page_number, count_data_samples)
+        elif cfg.quiet==0:
             print("Processing page " + str(current_page_number))
         return
 
     if old_page_number > 1:
-        # Skip lines with strings we are not interested in
-        if skip_line_found(line):
+        # Skip lines with strings we are not interested in. The column header line is used to set the layout
+        # of the sample lines that follow it.
+        if line_kind == quantum_lines.COLUMN_HEADER:
+            if cfg.layout_detection_enabled:
+                select_sample_layout(line)
+            return
+        if line_kind == quantum_lines.SKIPPED or line_kind == quantum_lines.LOCO_NUMBER:
             return
 
         # Data lines begin with an integer (1st character in timestamp)
-        if line[0].isnumeric():  # Data sample lines are the only ones starting with a digit
+        if line_kind == quantum_lines.SAMPLE:  # Data sample lines are the only ones starting with a digit
             process_sample(line)
         else:
+            try:
+                annotation_timestamp(line)
+            except (ValueError, IndexError) as e:
+                reject_line(line, rejection_reason(e))
+                return
             write_annotation(line,True)
+            if parsed_records is not None:
+                parsed_records.append(line)
 
         if current_page_number != old_page_number:
             old_page_number=current_page_number
@@ -440,11 +1217,16 @@ def process_line(line):
         # If we are now on page number 2 then we should have all the informational variables from
         # page 1 set and ready to create the workbook.
         if current_page_number == 2 and old_page_number == 1:
+            if cfg.speed_adjustment_factor == 0 and wheel_history is None:
+                print("No wheel diameter found on page 1 of the input file. Please check and set.")
+                sys.exit(1)
             create_workbook()
             old_page_number=current_page_number
+            # The line is the first of page 2 - usually its column header, which sets the sample layout
+            dispatch_line(line)
             return
         old_page_number=current_page_number
-        if "Locomotive Number" in line:
+        if line_kind == quantum_lines.LOCO_NUMBER:
             words = line.split()
             loco_number = words[-1]
             return
@@ -454,24 +1236,76 @@ def process_line(line):
         # loco number, obtained from the input file. If there is no loco number in the input file or there is no
         # match in the configuration file then the code will stop.
         if cfg.speed_adjustment_factor == 0:
-            if "Circumference" in line and "Diameter" in line:
+            if line_kind == quantum_lines.WHEEL_SIZE:
                 words = line.split()
+                try:
+                    wheel_diameter_qdp = float(words[-1])    # wheel diameter according to the QDP software
+                except ValueError:
+                    # Every speed depends on it, so the run cannot go on without it whatever the parse error policy
+                    print("Unable to read the wheel diameter from page 1 of the input file: " + line.strip())
+                    sys.exit(1)
                 # pp.pprint(words)
                 # Check for wheel size entry in config dictionary
                 if loco_number == "":   # not set
                     print("No locomotive number detected in the input file. Please check and set.")
                     sys.exit(1)
-                if loco_number in cfg.wheel_dia_actual_mm:
-                    actual_wheel_dia_mm = cfg.wheel_dia_actual_mm[loco_number]
-                else:
-                    print("No wheel diameter defined in configuration file for locomotive "+loco_number)
+                # The factor in force for each sample is resolved from the loco's wheel diameter history as the
+                # samples are converted
+                try:
+                    wheel_history = quantum_calibration.calibration_history(loco_number)
+                except ValueError as e:
+                    print("Error: " + str(e))
+                    sys.exit(1)
+                if wheel_history is None:
+                    print("No wheel diameter defined in configuration file or wheel calibration store for locomotive "+loco_number)
                     sys.exit(1)
-                wheel_diameter_qdp_inches = float(words[-1])  # wheel diameter according to the QDP software
-                cfg.speed_adjustment_factor = actual_wheel_dia_mm / (wheel_diameter_qdp_inches * 25.4)
-                # pp.pprint(cfg.speed_adjustment_factor)
+                wheel_diameter_qdp_inches = wheel_diameter_qdp
                 return
         return  # We don't want anything else from page 1
 
+def rejection_reason(error):
+    """
+        Return the reason a line is rejected, from the ValueError or IndexError raised parsing it
+    """
+    return str(error) if isinstance(error, ValueError) else "Missing field"
+
+
+def reject_line(line, reason):
+    """
+        Handle a line that could not be parsed. With the abort policy processing stops, with the tolerant policy the
+        line is set aside, together with its page number, line offset within the page and the reason, for the
+        rejected lines report and processing carries on.
+    """
+    if cfg.parse_error_policy != "tolerant":
+        quantum_progress.finish_progress(source_position(), current_page_number, count_data_samples, "failed")
+        print("FATAL: " + reason + " in line [" + line + "] on page " + str(current_page_number) + ". Processing abandoned")
+        sys.exit(1)
+    rejected_lines.append((current_page_number, line_number_in_page, reason, line))
+    if cfg.quiet < 2:
+        print("Rejected line " + str(line_number_in_page) + " on page " + str(current_page_number) + ": " + reason)
+
+
+def write_rejected_lines(ws, ws_row):
+    """
+        Write the rejected lines to the rejected lines sheet and, if required, to a tab separated text file
+        alongside the workbook
+    """
+    for page_number, line_number, reason, line in rejected_lines:
+        ws.write_number(ws_row, 0, page_number)
+        ws.write_number(ws_row, 1, line_number)
+        ws.write_string(ws_row, 2, reason)
+        ws.write_string(ws_row, 3, line)
+        ws_row += 1
+
+    if cfg.write_rejected_lines_file and len(rejected_lines) > 0:
+        rejected_lines_file = os.path.splitext(wb_name)[0] + " rejected lines.txt"
+        with open(rejected_lines_file, "w") as file:
+            file.write("Page\tLine\tReason\tText\n")
+            for page_number, line_number, reason, line in rejected_lines:
+                file.write(str(page_number) + "\t" + str(line_number) + "\t" + reason + "\t" + line + "\n")
+        print("Written rejected lines : " + rejected_lines_file)
+
+
 def create_workbook():
     """
         Create Excel workbook with required pages and initiate vars for each page to track the current row for that page
@@ -488,26 +1322,62 @@ def create_workbook():
     if cfg.in_flight_analysis_enabled:
         global ws_in_flight_analysis
         global ws_row_in_flight_analysis
-
+    if cfg.sampling_anomaly_detection_enabled:
+        global ws_sampling_anomalies
+        global ws_row_sampling_anomalies
+    if cfg.flag_transition_analysis_enabled:
+        global ws_flag_events
+        global ws_row_flag_events
+    if cfg.logger_event_summary_enabled:
+        global ws_event_summary
+        global ws_row_event_summary
+    global ws_track_sections
+    global ws_row_track_sections
+    global track_sections
+    if cfg.brake_analysis_enabled:
+        global ws_brake_applications
+        global ws_row_brake_applications
+    if cfg.compliance_enabled:
+        global ws_compliance
+        global ws_row_compliance
+    if cfg.tmc_anomaly_detection_enabled:
+        global ws_tmc_anomalies
+        global ws_row_tmc_anomalies
+    if cfg.parse_error_policy == "tolerant":
+        global ws_rejected_lines
+        global ws_row_rejected_lines
+
+    global ws_charts
+    global ws_row_charts
+    global ws_chart_data
+    global ws_row_chart_data
     global lalign
     global cell_fill
     global wb_name
     global wheel_diameter_qdp_inches
 
 
-    wb_name = cfg.workbook_name + " " + loco_number + " " + datetime.now().strftime("%Y%m%d%H%M") + ".xlsx"
-    workbook = xlsxwriter.Workbook(wb_name, {'strings_to_numbers': True})
-    ws_data_samples = workbook.add_worksheet(cfg.worksheet_name)
-    lalign = workbook.add_format({'align': 'left'})
-    cell_fill = workbook.add_format({'bg_color': 'yellow'})
-    ws_annotations = workbook.add_worksheet("Logger Events")
+    if cfg.workbook_path:
+        wb_name = cfg.workbook_path
+    else:
+        wb_name = cfg.workbook_name + " " + loco_number + " " + datetime.now().strftime("%Y%m%d%H%M") + ".xlsx"
+    if output_profile_name is not None:
+        wb_name = os.path.splitext(wb_name)[0] + " " + output_profile_name + os.path.splitext(wb_name)[1]
+    workbook = quantum_sheets.new_workbook(wb_name)
+    lalign = quantum_sheets.workbook_format(workbook, "left")
+    cell_fill = quantum_sheets.workbook_format(workbook, "fill")
     parts = os.path.split(cfg.source_file)
-    ws_modifiers = workbook.add_worksheet("Runtime modifiers")
-    ws_row_data_samples = write_header(workbook, ws_data_samples, "Data extract from Quantum Data Recorder",
-                            "Locomotive " + loco_number + ". Source file " + parts[1])
-    ws_row_annotations = write_header_ann(workbook, ws_annotations,
-                        "Data extract from Quantum Data Recorder", loco_number)
-    ws_row_modifiers = write_header_modifiers(workbook, ws_modifiers, "Runtime modifiers and events")
+    ws_data_samples, ws_row_data_samples = quantum_sheets.add_sheet(workbook, "Data Extract",
+                            "Data extract from Quantum Data Recorder : Locomotive " + loco_number + ". Source file " +
+                            parts[1], cfg.worksheet_name)
+    ws_annotations, ws_row_annotations = quantum_sheets.add_sheet(workbook, "Logger Events",
+                            "Data extract from Quantum Data Recorder : " + loco_number)
+    ws_modifiers, ws_row_modifiers = quantum_sheets.add_sheet(workbook, "Runtime modifiers",
+                                                              "Runtime modifiers and events")
+    if output_profile_name is not None:
+        ws_modifiers.write(ws_row_modifiers, 0, "Output profile " + output_profile_name + ": " + ", ".join(
+            setting + " = " + str(getattr(cfg, setting)) for setting in cfg.output_profile_settings))
+        ws_row_modifiers += 1
     if cfg.filter_dates:
         ws_modifiers.write(ws_row_modifiers, 0,
                             "Records selected from " + cfg.start_timestamp + " to " + cfg.end_timestamp)
@@ -518,13 +1388,21 @@ def create_workbook():
     ws_modifiers.write(ws_row_modifiers, 0,
                         "Record timestamp offset applied is " + str(cfg.ts_adjustment) + " seconds")
     ws_row_modifiers += 1
-    ws_modifiers.write(ws_row_modifiers, 0,
-                       "Speed adjustment factor applied. QDP defined wheel diameter = " + str(
-                        wheel_diameter_qdp_inches) + " inches (" + str(
-                       wheel_diameter_qdp_inches * 25.4) + " mm). Measured wheel diameter = " + str(
-                       cfg.wheel_dia_actual_mm[loco_number]) + " mm. Adjustment factor = " + str(
-                       cfg.speed_adjustment_factor) + ".")
-    ws_row_modifiers += 1
+    if cfg.speed_adjustment_factor != 0:
+        ws_modifiers.write(ws_row_modifiers, 0, "Speed adjustment factor set in configuration file = " +
+                           str(cfg.speed_adjustment_factor) + ".")
+        ws_row_modifiers += 1
+    else:
+        # One line per wheel diameter in the loco's history
+        for effective_seconds, wheel_dia_mm in zip(*wheel_history):
+            ws_modifiers.write(ws_row_modifiers, 0,
+                               "Speed adjustment factor applied. QDP defined wheel diameter = " + str(
+                                wheel_diameter_qdp_inches) + " inches (" + str(
+                               wheel_diameter_qdp_inches * 25.4) + " mm). Measured wheel diameter = " + "{:g}".format(
+                               wheel_dia_mm) + " mm" + ("" if effective_seconds == 0 else " from " +
+                               datetime.fromtimestamp(int(effective_seconds)).strftime("%Y/%m/%d %H:%M:%S")) +
+                               ". Adjustment factor = " + str(wheel_dia_mm / (wheel_diameter_qdp_inches * 25.4)) + ".")
+            ws_row_modifiers += 1
     if cfg.epoch_timestamps_allowed:
         ws_modifiers.write(ws_row_modifiers, 0,
             "Epoch dated records permitted. Epoch year is " + str(cfg.epoch_year))
@@ -534,20 +1412,100 @@ def create_workbook():
         ws_row_modifiers += 1
 
     if cfg.in_flight_analysis_enabled:
-        ws_in_flight_analysis = workbook.add_worksheet("Event Analysis")
-        ws_row_in_flight_analysis = write_header(workbook, ws_in_flight_analysis, "Event of interest analysis",
-                                           "Locomotive " + loco_number + ". Source file " + parts[1])
-        ws_in_flight_analysis.write(ws_row_in_flight_analysis,0,"Events will be flagged if the TMC value is over "+str(cfg.ifa_tmc_threshold)+" Amps with the throttle in IDLE")
-        ws_row_in_flight_analysis+=1
-        ws_in_flight_analysis.write(ws_row_in_flight_analysis,1,"This may be caused by arcing across contactors when dropping to Idle position.")
-        ws_row_in_flight_analysis+=1
-        ws_in_flight_analysis.write(ws_row_in_flight_analysis,0,"The previous "+str(cfg.ifa_deque_maxlen)+" events will be shown. All subsequent events will also be shown until the selection criteria are no longer met")
-        ws_row_in_flight_analysis+=2
+        if not cfg.ifa_separate_workbook:
+            ws_in_flight_analysis, ws_row_in_flight_analysis = create_in_flight_analysis_sheet(workbook)
         ws_modifiers.write(ws_row_modifiers,0,"Event analysis: Events will be flagged if the TMC value is over "+str(cfg.ifa_tmc_threshold)+" Amps with the throttle in IDLE")
         ws_row_modifiers+=1
         ws_modifiers.write(ws_row_modifiers,0,"Event analysis: The previous "+str(cfg.ifa_deque_maxlen)+" events will be shown. All subsequent events will also be shown until the selection criteria are no longer met")
         ws_row_modifiers+=1
 
+    if cfg.sampling_anomaly_detection_enabled:
+        ws_sampling_anomalies, ws_row_sampling_anomalies = quantum_sheets.add_sheet(workbook, "Sampling Anomalies",
+                                                                    "Sampling anomalies : " + loco_number)
+        ws_modifiers.write(ws_row_modifiers, 0, "Sampling anomalies: gaps over " +
+                           str(cfg.sampling_gap_threshold_seconds) + " seconds, duplicated and reversed timestamps and "
+                           "odometer jumps over " + str(cfg.odometer_jump_tolerance_miles) + " miles are reported")
+        ws_row_modifiers += 1
+
+    if cfg.flag_transition_analysis_enabled:
+        ws_flag_events, ws_row_flag_events = quantum_sheets.add_sheet(workbook, "Flag Events",
+                                                        "Digital input statistics and events : " + loco_number)
+        ws_modifiers.write(ws_row_modifiers, 0, "Flag events: transitions of all digital inputs except " +
+                           ", ".join(cfg.flag_transition_ignore) + " are reported")
+        ws_row_modifiers += 1
+
+    if cfg.logger_event_summary_enabled:
+        ws_event_summary, ws_row_event_summary = quantum_sheets.add_sheet(workbook, "Event Summary",
+                                                                "Logger events by kind and day : " + loco_number)
+        ws_modifiers.write(ws_row_modifiers, 0, "Event summary: logger events are counted by kind (" +
+                           ", ".join(kind for kind, pattern in cfg.logger_event_kinds) + ", other) and day")
+        ws_row_modifiers += 1
+
+    if cfg.track_sections_enabled and track_sections is None:
+        try:
+            track_sections = quantum_sections.load_track_sections(cfg.track_sections_file)
+        except ValueError as e:
+            print("Error: " + str(e))
+            sys.exit(1)
+    if track_sections_written():
+        ws_track_sections, ws_row_track_sections = quantum_sheets.add_sheet(workbook, "Track Sections",
+                                                                "Track sections and overspeeds : " + loco_number)
+        ws_modifiers.write(ws_row_modifiers, 0, "Track sections: " + str(len(track_sections[0])) + " sections from " +
+                           cfg.track_sections_file + ". Overspeed tolerance " + str(cfg.overspeed_tolerance_kph) +
+                           " kph. Trips split at gaps over " + str(cfg.track_trip_gap_seconds) + " seconds")
+        ws_row_modifiers += 1
+
+    if cfg.brake_analysis_enabled:
+        ws_brake_applications, ws_row_brake_applications = quantum_sheets.add_sheet(workbook, "Brake Applications",
+                                                                "Brake applications : " + loco_number)
+        ws_modifiers.write(ws_row_modifiers, 0, "Brake applications: brake pipe reductions of " +
+                           str(cfg.brake_pipe_reduction_psi) + " psi or more (emergency at " +
+                           str(cfg.brake_pipe_emergency_psi) + " psi or less) and brake cylinder pressures of " +
+                           str(cfg.brake_cylinder_application_psi) + " psi or more are reported")
+        ws_row_modifiers += 1
+
+    if cfg.compliance_enabled:
+        ws_compliance, ws_row_compliance = quantum_sheets.add_sheet(workbook, "Compliance",
+                                                                    "Safety input compliance : " + loco_number)
+        title_format = quantum_sheets.workbook_format(workbook, "title")
+        for column, heading in enumerate(["Rule", "Exceptions", "Exception Seconds", "Checked", "Compliant %"]):
+            ws_compliance.write(1, column, heading, title_format)
+        # The summary rows are written at the end - the exceptions are written below them as they are found
+        ws_row_compliance += len(quantum_compliance.rules) + 1
+        for column, heading in enumerate(["Exception", "From", "To", "Seconds", "Speed (kph)", "Max Speed (kph)",
+                                          "Data Row", "Detail"]):
+            ws_compliance.write(ws_row_compliance, column, heading, title_format)
+        ws_row_compliance += 1
+        ws_modifiers.write(ws_row_modifiers, 0, "Compliance: headlight (" + ", ".join(cfg.compliance_headlight_inputs) +
+                           ") on while moving, vigilance acknowledged within " +
+                           str(cfg.vigilance_ack_interval_seconds) + " seconds, horn within " +
+                           str(cfg.horn_warning_seconds) + " seconds before " + str(len(cfg.level_crossings)) +
+                           " level crossings, EIE occurrences")
+        ws_row_modifiers += 1
+
+    if cfg.tmc_anomaly_detection_enabled:
+        ws_tmc_anomalies, ws_row_tmc_anomalies = quantum_sheets.add_sheet(workbook, "TMC Anomalies",
+                                                                "TMC anomalies by notch and speed : " + loco_number)
+        ws_modifiers.write(ws_row_modifiers, 0, "TMC anomalies: TMC " + str(cfg.tmc_anomaly_score_threshold) +
+                           " or more standard deviations (at least " + str(cfg.tmc_anomaly_min_std_amps) +
+                           " A) from the mean of its notch and " + str(cfg.tmc_anomaly_speed_band_mph) +
+                           " mph speed band is reported")
+        ws_row_modifiers += 1
+
+    if cfg.charts_enabled:
+        ws_charts, ws_row_charts = quantum_sheets.add_sheet(workbook, "Charts", "Charts : " + loco_number)
+        ws_chart_data, ws_row_chart_data = quantum_sheets.add_sheet(workbook, "Chart Data", None)
+        ws_modifiers.write(ws_row_modifiers, 0, "Charts: " + ", ".join(cfg.chart_channels) + " by " + cfg.chart_period +
+                           ", at most " + str(cfg.chart_points_per_period) + " points per chart")
+        ws_row_modifiers += 1
+
+    if cfg.parse_error_policy == "tolerant":
+        ws_rejected_lines, ws_row_rejected_lines = quantum_sheets.add_sheet(workbook, "Rejected Lines",
+                                                                   "Rejected input lines : " + loco_number)
+        ws_modifiers.write(ws_row_modifiers, 0, "Lines that cannot be parsed are rejected. Processing fails if more than " +
+                           str(cfg.max_reject_rate_percent) + "% of lines are rejected")
+        ws_row_modifiers += 1
+
     if cfg.suppress_stationary_events:
         ws_modifiers.write(ws_row_modifiers, 0,
                            "Events where locomotive is stationary (speed = 0 kph, throttle is in idle, and tmc = 0) are suppressed.")
@@ -560,6 +1518,103 @@ def create_workbook():
 
     return
 
+def create_in_flight_analysis_sheet(wb):
+    """
+        Add the event analysis sheet to the workbook and write its headers. Returns the sheet and the next row number
+    """
+    ws, ws_row = quantum_sheets.add_sheet(wb, "Event Analysis", "Event of interest analysis : Locomotive " +
+                                          loco_number + ". Source file " + os.path.split(cfg.source_file)[1])
+    ws.write(ws_row,0,"Events will be flagged if the TMC value is over "+str(cfg.ifa_tmc_threshold)+" Amps with the throttle in IDLE")
+    ws_row+=1
+    ws.write(ws_row,1,"This may be caused by arcing across contactors when dropping to Idle position.")
+    ws_row+=1
+    ws.write(ws_row,0,"The previous "+str(cfg.ifa_deque_maxlen)+" events will be shown. All subsequent events will also be shown until the selection criteria are no longer met")
+    ws_row+=2
+    if cfg.ifa_max_streams or cfg.ifa_stream_sample_every > 1 or cfg.ifa_max_records_per_stream:
+        ws.write(ws_row,0,"Streams kept: every "+str(cfg.ifa_stream_sample_every)+" stream(s), maximum "+
+                 (str(cfg.ifa_max_streams) if cfg.ifa_max_streams else "unlimited")+". Records per stream: maximum "+
+                 (str(cfg.ifa_max_records_per_stream)+" plus the last "+str(cfg.ifa_stream_tail_records)
+                  if cfg.ifa_max_records_per_stream else "unlimited"))
+        ws_row+=2
+    return ws, ws_row
+
+def derive_sample_layout(header):
+    """
+        Derive the sample line layout from a column header line. The numeric fields are right aligned with their
+        header labels, so the speed field runs from the end of the label before the speed label to the end of the
+        speed label, and the TMC field from there to the end of the TMC label.
+        Returns a (speed position, speed length, tmc position, tmc length) tuple, or None if the header cannot be
+        interpreted.
+    """
+    labels = [(match.group(0).upper(), match.end()) for match in re.finditer(r"\S+", header)]
+    for index in range(1, len(labels) - 1):
+        if labels[index][0] in cfg.layout_speed_labels and labels[index + 1][0] in cfg.layout_tmc_labels:
+            speed_position = labels[index - 1][1]
+            tmc_position = labels[index][1]
+            tmc_end = labels[index + 1][1]
+            if speed_position < 20 or tmc_position - speed_position < 3 or tmc_end - tmc_position < 3:
+                return None
+            return speed_position, tmc_position - speed_position, tmc_position, tmc_end - tmc_position
+    return None
+
+
+def get_sample_parser(layout):
+    """
+        Return the parser function for a sample line layout, compiling it on first use
+    """
+    parser = sample_parsers.get(layout)
+    if parser is None:
+        parser = compile_sample_parser(layout)
+        sample_parsers[layout] = parser
+    return parser
+
+
+def compile_sample_parser(layout):
+    """
+        Build a function that splits a sample line, in the given layout, into mileage, speed, tmc and a list of the
+        remaining fields (bp, bc, throttle position and the flags).
+    """
+    speed_position, speed_length, tmc_position, tmc_length = layout
+    speed_field = slice(speed_position, speed_position + speed_length)
+    tmc_field = slice(tmc_position, tmc_position + tmc_length)
+    remainder_position = tmc_position + tmc_length
+
+    def parse_sample_fields(line):
+        # Because the mileage field leading space is lost when the distance goes to 3 figures and
+        # extends when it goes to 4 figures, we start at the end of the date field then strip any leading
+        # spaces. The mileage field should be followed by a space as the next field will be the speed
+        mileage = float(line[20:].lstrip().split(" ", 1)[0])
+        # We need to handle speed and tmc carefully as the TMC field will lose leading spaces when it
+        # goes over 3 digits, so these are taken from fixed positions
+        return mileage, int(line[speed_field]), int(line[tmc_field]), line[remainder_position:].split()
+
+    return parse_sample_fields
+
+
+def select_sample_layout(header):
+    """
+        Set the sample parser for the lines following a column header line. Each distinct header is only analysed
+        once.
+    """
+    global current_sample_layout
+    global current_sample_parser
+    global sample_layout_failures
+
+    layout = header_sample_layouts.get(header)
+    if layout is None:
+        layout = derive_sample_layout(header)
+        if layout is None:
+            print("Unable to derive the sample line layout from header [" + header + "], using the default layout")
+            layout = default_sample_layout
+        elif layout != default_sample_layout and cfg.quiet < 2:
+            print("Sample line layout " + str(layout) + " derived from header [" + header + "]")
+        header_sample_layouts[header] = layout
+    if layout != current_sample_layout:
+        current_sample_layout = layout
+        current_sample_parser = get_sample_parser(layout)
+        sample_layout_failures = 0
+
+
 def write_annotation(line,write_to_logger_event_sheet):
     """
         Annotations are text records that contain no loco movement data, they get written to a worksheet in the workbook.
@@ -576,20 +1631,21 @@ def write_annotation(line,write_to_logger_event_sheet):
 
 
     # Handle annotations
-    # Extract date and time - last word in string in format HH:MM:SS-mm/dd/yyyy
     words = line.split()
-    record_date = convert_date(words[-1])
-    record_time = words[-2].replace("-", "")
-    record_date, record_time = apply_time_adjustment(record_date, record_time)
-    record_ts_epoch_seconds = get_epoch(record_date + " " + record_time)
+    record_date, record_time, record_ts_epoch_seconds = annotation_timestamp(line)
     if start_timestamp_epoch_seconds > 0 and (
             (record_ts_epoch_seconds < start_timestamp_epoch_seconds) or (
             record_ts_epoch_seconds > end_timestamp_epoch_seconds)):
             return
 
+    event_text = ' '.join(words[:-2])
+    event_kind = quantum_events.add_event(record_ts_epoch_seconds, record_date, record_time, event_text,
+                                          check_for_epoch_year(record_date),
+                                          ws_row_annotations if write_to_logger_event_sheet else -1)
+
     ws_data_samples.write(ws_row_data_samples, 0, record_date)
     ws_data_samples.write(ws_row_data_samples, 1, record_time)
-    ws_data_samples.write(ws_row_data_samples, 2, ' '.join(words[:-2]), lalign)
+    ws_data_samples.write(ws_row_data_samples, 2, event_text, lalign)
     ws_row_data_samples += 1
 
     if not write_to_logger_event_sheet:  # only write to data samples sheet.
@@ -599,59 +1655,70 @@ def write_annotation(line,write_to_logger_event_sheet):
     # Calculate offset between this annotation and the previous record.
     # If either date is in the epoch period then don't do this as it makes no sense
     if old_record_date != "None" and not check_for_epoch_year(old_record_date) and not check_for_epoch_year(record_date):
-        s = datetime.strptime(old_record_date + " " + old_record_time, "%Y/%m/%d %H:%M:%S")
-        e = datetime.strptime(record_date + " " + record_time, "%Y/%m/%d %H:%M:%S")
-        offset = str(e - s)
+        offset = str(timedelta(seconds=quantum_events.event_naive_seconds[-1] -
+                                       quantum_events.naive_seconds(old_record_date, old_record_time)))
     else:
         offset="N/A"
 
     ws_annotations.write(ws_row_annotations, 0, record_date)
     ws_annotations.write(ws_row_annotations, 1, record_time)
-    ws_annotations.write(ws_row_annotations, 2, " ".join(words[:-2]))
+    ws_annotations.write(ws_row_annotations, 2, event_text)
     # Only write inter-event interval for power related events.
-    if words[0][:5] == 'Power':
+    if event_kind in cfg.logger_event_offset_kinds:
         ws_annotations.write(ws_row_annotations, 3, old_record_date)
         ws_annotations.write(ws_row_annotations, 4, old_record_time)
         ws_annotations.write(ws_row_annotations, 5, offset)
     ws_row_annotations += 1
+    if cfg.html_report_enabled:
+        if event_kind in cfg.logger_event_offset_kinds:
+            logger_events.append([record_date, record_time, event_text, old_record_date, old_record_time, offset])
+        else:
+            logger_events.append([record_date, record_time, event_text, "", "", ""])
 
     return
 
+def annotation_timestamp(line):
+    """
+        Return the date, time and epoch seconds of an annotation, with the timestamp adjustment applied
+    """
+    # Extract date and time - last word in string in format HH:MM:SS-mm/dd/yyyy
+    words = line.split()
+    record_date = convert_date(words[-1])
+    record_time = words[-2].replace("-", "")
+    record_date, record_time = apply_time_adjustment(record_date, record_time)
+    return record_date, record_time, get_epoch_seconds(record_date + " " + record_time)
+
+
 def process_sample(line):
     """
         This function is passed a line containing data from the Quantum data logger, the function parses the data and
-        passes it to be written to the Excel worksheet
+        passes it to be written to the Excel worksheet. If there are several output profiles the parsed record is
+        kept to be replayed for the others.
     """
-    global old_record_date
-    global old_record_time
-    global ws_data_samples
-    global ws_row_data_samples
-    global count_data_samples
-    global count_epoch_events
-    global writing_records_to_xls           # Only used when filtering records on date
-    global first_datestamp_written
-    global last_non_epoch_datestamp_written
-    global last_datestamp_written
-    global previous_event_speed
-    global previous_event_tmc
-    global suppressed_stationary_event_count
-    global in_suppression_mode
-    global count_suppressed_events
-    global first_suppressed_timestamp
-    global last_suppressed_timestamp
-    global previous_throttle_position
-    global suppressed_rows
-    global previous_event_brake_pipe_pressure
+    try:
+        record = parse_sample(line)
+    except (ValueError, IndexError) as e:
+        reject_line(line, rejection_reason(e))
+        return
+    if parsed_records is not None:
+        parsed_records.append(record)
+    write_sample(record)
+
+
+def parse_sample(line):
+    """
+        Parse a data sample line. Returns a tuple of the date, time, mileage, speed, tmc, brake pipe and cylinder
+        pressures, throttle position, packed flags and the timestamp text of the line (as printed).
+    """
+    global current_sample_parser
+    global current_sample_layout
+    global sample_layout_failures
 
     time_position = 0
     time_length = 8
     date_position = 10
     date_length = 10
     remainder_position = 20
-    speed_position = 28
-    speed_length = 4
-    tmc_position = 32
-    tmc_length = 4
 
     # Date and time are in fixed positions starting at column 0 and in the format
     # hh:mm:ss- mm/dd/yyyy
@@ -659,29 +1726,33 @@ def process_sample(line):
     date_us_fmt = line[date_position:date_position + date_length]
     record_date = convert_date(date_us_fmt)
     record_date, record_time = apply_time_adjustment(record_date, record_time)
-    old_record_date = record_date
-    old_record_time = record_time
 
-    # Because the mileage field leading space is lost when the distance goes to 3 figures and
-    # extends when it goes to 4 figures, we start at the end of the date field then strip any leading
-    # spaces. The mileage field should be followed by a space as the next field will be the speed
-    parts = line[remainder_position:].lstrip().split(" ", 1)
-    mileage = float(parts[0])
-     # We need to handle speed and tmc carefully as the TMC field will lose leading spaces when it
-    # goes over 3 digits
-    # pp.pprint(line[28:32])
-    speed = int(line[speed_position:speed_position + speed_length].strip())
-    tmc = int(line[tmc_position:tmc_position + tmc_length].strip())
-    parts = line[speed_position + speed_length + tmc_length:].lstrip().split()
-    # pp.pprint(parts)
-
-    # The first 3 fields are values as follows:
+    # Mileage, speed, tmc and the remaining fields are split out by the parser for the current page layout.
+    # A line a layout derived from a page header does not fit is rejected. If cfg.layout_failure_lines lines in a row
+    # do not fit, fall back to the default layout for the rest of the pages using that header.
+    try:
+        mileage, speed, tmc, parts = current_sample_parser(line)
+        sample_layout_failures = 0
+    except ValueError:
+        if current_sample_layout == default_sample_layout:
+            raise
+        # With the abort policy a line rejected stops processing, so the default layout is tried at once
+        sample_layout_failures += 1
+        if cfg.parse_error_policy == "tolerant" and sample_layout_failures < cfg.layout_failure_lines:
+            raise
+        print("Sample line layout " + str(current_sample_layout) + " derived from the page header does not fit line [" +
+              line + "]" + ("" if sample_layout_failures == 1 else " or the " + str(sample_layout_failures - 1) +
+              " before it") + ", using the default layout")
+        for header in [header for header, layout in header_sample_layouts.items() if layout == current_sample_layout]:
+            header_sample_layouts[header] = default_sample_layout
+        current_sample_layout = default_sample_layout
+        current_sample_parser = get_sample_parser(default_sample_layout)
+        sample_layout_failures = 0
+        mileage, speed, tmc, parts = current_sample_parser(line)
+
+    # The first 3 fields are values as follows (pressures are kept in psi, see quantum_units):
     brake_pipe_pressure = int(parts[0])
-    if cfg.report_kpa_pressures:
-        brake_pipe_pressure=round(brake_pipe_pressure*cfg.psi_to_kpa_factor)
     brake_cylinder_pressure = int(parts[1])
-    if cfg.report_kpa_pressures:
-        brake_cylinder_pressure=round(brake_cylinder_pressure*cfg.psi_to_kpa_factor)
 
     throttle_position = parts[2]  # This is left as string to cater for (D)dynamic or low (ID)le states
 
@@ -698,16 +1769,53 @@ def process_sample(line):
     # Digital Spare 2
     # Vigilance Control Alert Acknowledged
     # Axle Drive TypeError
-    flags = parts[3:]
     # Sanity check the flags to ensure we have the correct number. If the print setup is
     # wrong in the QDP software then this may occur. If this were allowed to go through then
     # the column headers for the flags would be wrong!
-    if len(flags) != cfg.number_of_flags_expected:
-        print("FATAL: Expected "+str(cfg.number_of_flags_expected)+" flags but received "+str(len(flags))+" in line ["+line+"]. Processing abandoned")
-        sys.exit(1)
+    if len(parts) - 3 != cfg.number_of_flags_expected:
+        raise ValueError("Expected "+str(cfg.number_of_flags_expected)+" flags but received "+str(len(parts) - 3))
+    # The flags are packed into an integer, the first flag (Reverse) in bit 0
+    flags = pack_flags(parts[3:])
+
+    return (record_date, record_time, mileage, speed, tmc, brake_pipe_pressure, brake_cylinder_pressure,
+            throttle_position, flags, line[time_position:remainder_position])
+
+
+def write_sample(record):
+    """
+        Write a parsed data sample (see parse_sample), subject to the date filter, with any brake pipe transition or
+        stationary event suppression annotations it gives rise to
+    """
+    global old_record_date
+    global old_record_time
+    global ws_data_samples
+    global ws_row_data_samples
+    global count_data_samples
+    global count_epoch_events
+    global writing_records_to_xls           # Only used when filtering records on date
+    global first_datestamp_written
+    global last_non_epoch_datestamp_written
+    global last_datestamp_written
+    global previous_event_speed
+    global previous_event_tmc
+    global suppressed_stationary_event_count
+    global in_suppression_mode
+    global count_suppressed_events
+    global first_suppressed_timestamp
+    global last_suppressed_timestamp
+    global previous_throttle_position
+    global suppressed_rows
+    global previous_event_brake_pipe_pressure
+
+    (record_date, record_time, mileage, speed, tmc, brake_pipe_pressure, brake_cylinder_pressure, throttle_position,
+     flags, record_timestamp_text) = record
+
+    # The line has been parsed successfully
+    old_record_date = record_date
+    old_record_time = record_time
 
 
-    record_ts_epoch_seconds = get_epoch(record_date + " " + record_time)
+    record_ts_epoch_seconds = get_epoch_seconds(record_date + " " + record_time)
     # We want to filter out dates prior to or after a range of datestamps - use timestamp WITHOUT adjustments
     is_epoch_year_datestamp = check_for_epoch_year(record_date)
     if is_epoch_year_datestamp:
@@ -740,15 +1848,12 @@ def process_sample(line):
 
     # Check for brake pipe pressure changes of interest
     #       Transition from 0 to non-zero - engine startup?
-    if cfg.report_kpa_pressures:
-        pressure_unit="kpa"
-    else:
-        pressure_unit="psi"
+    pressure_unit = quantum_units.pressure_unit(cfg.report_kpa_pressures)
     if previous_event_brake_pipe_pressure == 0 and brake_pipe_pressure > 0:     # Compressor start up
-        write_annotation("Brake pipe pressure transitioned from "+str(previous_event_brake_pipe_pressure)+" "+pressure_unit+" to "+str(brake_pipe_pressure)+" "+pressure_unit+" - compressor start up "+line[time_position:remainder_position],True)
+        write_annotation("Brake pipe pressure transitioned from "+str(previous_event_brake_pipe_pressure)+" "+pressure_unit+" to "+str(quantum_units.convert_pressure(brake_pipe_pressure, cfg.report_kpa_pressures))+" "+pressure_unit+" - compressor start up "+record_timestamp_text,True)
     #       Transition from non-zero tp 0 - emergency application or brake pipe rupture?
     if previous_event_brake_pipe_pressure > 0  and brake_pipe_pressure == 0:
-        write_annotation("Brake pipe pressure transitioned from "+str(previous_event_brake_pipe_pressure)+" "+pressure_unit+" to "+str(brake_pipe_pressure)+" "+pressure_unit+". "+line[time_position:remainder_position],True)
+        write_annotation("Brake pipe pressure transitioned from "+str(quantum_units.convert_pressure(previous_event_brake_pipe_pressure, cfg.report_kpa_pressures))+" "+pressure_unit+" to "+str(brake_pipe_pressure)+" "+pressure_unit+". "+record_timestamp_text,True)
 
     ##################################################################################################
     # NOTE: Any state change that writes an annotation to the data samples sheet MUST be done prior  #
@@ -770,7 +1875,7 @@ def process_sample(line):
     # write this record to the sheet after reporting the gap in events...
     if cfg.suppress_stationary_events and (speed!=0 and previous_event_speed==0) or (tmc!=0 and previous_event_tmc==0) or (throttle_position!="ID" and previous_throttle_position=="ID"):
         if suppressed_stationary_event_count!=0:
-            write_annotation("Suppressed "+str(suppressed_stationary_event_count)+" consecutive "+("event" if suppressed_stationary_event_count==1 else "events")+" with Speed = 0 kph, TMC = 0 Amps, and Throttle in Idle from "+first_suppressed_timestamp+" to "+last_suppressed_timestamp+" "+line[time_position:remainder_position],False)
+            write_annotation("Suppressed "+str(suppressed_stationary_event_count)+" consecutive "+("event" if suppressed_stationary_event_count==1 else "events")+" with Speed = 0 kph, TMC = 0 Amps, and Throttle in Idle from "+first_suppressed_timestamp+" to "+last_suppressed_timestamp+" "+record_timestamp_text,False)
             count_suppressed_events+=suppressed_stationary_event_count
         suppressed_stationary_event_count=0
 
@@ -778,19 +1883,10 @@ def process_sample(line):
 
 
 
-    ws_row_data_samples = write_record(ws_data_samples,
-                                       ws_row_data_samples,
-                                       mileage,
-                                       speed,
-                                       tmc,
-                                       brake_pipe_pressure,
-                                       brake_cylinder_pressure,
-                                       throttle_position,
-                                       flags,
-                                       record_date,
-                                       record_time,
-                                       fill,
-                                       False)
+    # The row is reserved now, it is written when the batch of samples it is in is converted
+    sample_row = ws_row_data_samples
+    ws_row_data_samples += 1
+    pending_samples.append((sample_row, record_date, record_time, throttle_position, fill))
     previous_event_speed=speed
     previous_event_tmc=tmc
     previous_throttle_position=throttle_position
@@ -802,33 +1898,100 @@ def process_sample(line):
     last_datestamp_written[0]=record_date
     last_datestamp_written[1]=record_time
 
+    sample_index = len(sample_columns["epoch_seconds"])
+    sample_columns["epoch_seconds"].append(record_ts_epoch_seconds)
+    sample_columns["mileage"].append(mileage)
+    sample_columns["speed"].append(speed)
+    sample_columns["tmc"].append(tmc)
+    sample_columns["bp"].append(brake_pipe_pressure)
+    sample_columns["bc"].append(brake_cylinder_pressure)
+    sample_columns["throttle"].append(quantum_dataset.encode_throttle(throttle_position))
+    sample_columns["flags"].append(flags)
+    sample_columns["row"].append(sample_row)
+    if len(pending_samples) >= cfg.conversion_batch_samples:
+        write_pending_samples()
+
+    if cfg.compliance_enabled:
+        write_compliance_exceptions(quantum_compliance.check_sample(record_ts_epoch_seconds, mileage, speed, flags,
+                                                                    sample_index, sample_row))
+    if cfg.tmc_anomaly_detection_enabled:
+        tmc_anomaly = quantum_tmc.score_sample(throttle_position, speed, tmc)
+        if tmc_anomaly is not None:
+            write_tmc_anomaly(tmc_anomaly, record_timestamp_text, throttle_position, speed, tmc, sample_index,
+                              sample_row)
+
     # If we are doing in flight analysis, add this record to the deque.
     # Later we'll play more with this stuff.
     if cfg.in_flight_analysis_enabled:
-        previous_events_deque.append((record_date,record_time,mileage,speed,tmc,brake_pipe_pressure,brake_cylinder_pressure,throttle_position,flags))
+        previous_events_deque.append((record_date,record_time,mileage,speed,tmc,brake_pipe_pressure,brake_cylinder_pressure,throttle_position,flags,sample_index))
         perform_in_flight_analysis()
 
     count_data_samples+=1
 
     return
 
+def write_pending_samples():
+    """
+        Convert the samples parsed since the last batch to the reported units, in one go, and write them to their
+        reserved rows of the data sheet
+    """
+    start = len(converted_columns["km"])
+    end = len(sample_columns["epoch_seconds"])
+    for name, values in quantum_units.convert_columns(sample_columns, start, end, speed_adjustment_factors(start, end),
+                                                      cfg.report_kpa_pressures).items():
+        converted_columns[name].extend(values.tolist())
+
+    for index, (row, record_date, record_time, throttle_position, fill) in enumerate(pending_samples, start):
+        write_record(ws_data_samples,
+                     row,
+                     converted_columns["km"][index],
+                     converted_columns["speed"][index],
+                     sample_columns["tmc"][index],
+                     converted_columns["bp"][index],
+                     converted_columns["bc"][index],
+                     throttle_position,
+                     sample_columns["flags"][index],
+                     record_date,
+                     record_time,
+                     fill,
+                     False)
+    pending_samples.clear()
+
+
+def speed_adjustment_factors(start, end):
+    """
+        Return the speed adjustment factor for the samples start to end (exclusive) - the factor set in the
+        configuration file if there is one, otherwise the factor in force at each sample's time
+    """
+    if cfg.speed_adjustment_factor != 0:
+        return cfg.speed_adjustment_factor
+    if wheel_history is None:
+        return 0            # No wheel size found in the input file
+    return quantum_calibration.speed_adjustment_factors(wheel_history, wheel_diameter_qdp_inches,
+                                                        sample_columns["epoch_seconds"][start:end])
+
+
 def perform_in_flight_analysis():
     """
         Analyse data records and alert on events of interest. A deque is set up to store the 10 events leading up to the current event so
         we can report on precursors to an event
+        The event streams are not written to the workbook as they are found, they are buffered (see
+        buffer_in_flight_analysis_item) and written in one batch once all the records have been processed.
     """
 
 
-    global ws_in_flight_analysis
-    global ws_row_in_flight_analysis
     global count_in_flight_analysis
+    global count_in_flight_analysis_kept
+    global ifa_stream_kept
+    global ifa_stream_records
     # At this stage the current data point has been appended to the deque, so we have up to (n-1) previous data points plus the current data point
     # each data point is a tuple with the following members:
     # 0 - date              5 - bp pressure
     # 1 - time              6 - bc pressure
     # 2 - mileage           7 - throttle position (1-8, ID, LO etc.)
-    # 3 - speed             8 - binary flags (11 off)
-    # 4 - tmc
+    # 3 - speed             8 - binary flags (11 off, packed into an integer)
+    # 4 - tmc               9 - sample index (position in the sample columns)
+    # Values are as logged, the converted values are looked up by sample index when the streams are written
 
     # See if this data point contains an item of interest
     current_data_point = previous_events_deque[-1]
@@ -840,24 +2003,18 @@ def perform_in_flight_analysis():
             fill=False
         else:
             fill=True
-        ws_row_in_flight_analysis = write_record(ws_in_flight_analysis,
-                                           ws_row_in_flight_analysis,
-                                           current_data_point[2],
-                                           current_data_point[3],
-                                           current_data_point[4],
-                                           current_data_point[5],
-                                           current_data_point[6],
-                                           current_data_point[7],
-                                           current_data_point[8],
-                                           current_data_point[0],
-                                           current_data_point[1],
-                                         False,
-                                                 fill)
+        if ifa_stream_kept:
+            ifa_stream_records += 1
+            if cfg.ifa_max_records_per_stream and ifa_stream_records > cfg.ifa_max_records_per_stream:
+                ifa_stream_tail.append((current_data_point, fill))      # Ring buffer of the latest records
+            else:
+                buffer_in_flight_analysis_item(("record", current_data_point, fill))
         # If the throttle leaves the idle position or the tmc drops to 0 then we are done with this event
         if current_data_point[7] != 'ID' or current_data_point[4] == 0:
             cfg.ifa_in_event_of_interest = False
-            ws_in_flight_analysis.write(ws_row_in_flight_analysis, 0, "End of event flow "+str(count_in_flight_analysis))
-            ws_row_in_flight_analysis += 2
+            if ifa_stream_kept:
+                flush_in_flight_analysis_tail()
+                buffer_in_flight_analysis_item(("end", count_in_flight_analysis))
             if cfg.quiet < 2:
                 print("EVENT "+str(count_in_flight_analysis)+" TERMINATED")
         return
@@ -877,8 +2034,16 @@ def perform_in_flight_analysis():
     count_in_flight_analysis+=1
     if cfg.quiet < 2:
         print("EVENT "+str(count_in_flight_analysis)+" COMMENCED")
-    ws_in_flight_analysis.write(ws_row_in_flight_analysis, 0, "Start of event flow "+str(count_in_flight_analysis))
-    ws_row_in_flight_analysis += 1
+    cfg.ifa_in_event_of_interest = True
+
+    # Only every nth stream is kept if sampling, and no more than the maximum number of streams
+    ifa_stream_kept = (count_in_flight_analysis - 1) % cfg.ifa_stream_sample_every == 0 and \
+                      (cfg.ifa_max_streams == 0 or count_in_flight_analysis_kept < cfg.ifa_max_streams)
+    if not ifa_stream_kept:
+        return
+    count_in_flight_analysis_kept += 1
+    ifa_stream_records = 0
+    buffer_in_flight_analysis_item(("start", count_in_flight_analysis))
 
     deque_len=len(previous_events_deque)
     for index, preceding_data_point in enumerate(previous_events_deque):
@@ -887,34 +2052,627 @@ def perform_in_flight_analysis():
             fill=True
         else:
             fill=False
-        ws_row_in_flight_analysis = write_record(ws_in_flight_analysis,
-                                           ws_row_in_flight_analysis,
-                                           preceding_data_point[2],
-                                           preceding_data_point[3],
-                                           preceding_data_point[4],
-                                           preceding_data_point[5],
-                                           preceding_data_point[6],
-                                           preceding_data_point[7],
-                                           preceding_data_point[8],
-                                           preceding_data_point[0],
-                                           preceding_data_point[1],
-                                    False,
-                                                 fill)
-
-    cfg.ifa_in_event_of_interest = True
+        buffer_in_flight_analysis_item(("record", preceding_data_point, fill))
 
 
     return
 
-def hide_columns(ws, headers):
-    """ Hide any column with False in the header tuple """
-    for column, record in enumerate(headers):
-        if not record[1]:
-            ws.set_column(column, column, None, None, {'hidden': True})
 
+def flush_in_flight_analysis_tail():
+    """
+        At the end of a stream that exceeded the record limit, buffer a note of the records omitted followed by the
+        latest records held in the ring buffer
+    """
+    if len(ifa_stream_tail) == 0:
+        return
+    omitted = ifa_stream_records - cfg.ifa_max_records_per_stream - len(ifa_stream_tail)
+    if omitted > 0:
+        buffer_in_flight_analysis_item(("omitted", omitted))
+    for data_point, fill in ifa_stream_tail:
+        buffer_in_flight_analysis_item(("record", data_point, fill))
+    ifa_stream_tail.clear()
+
+
+def buffer_in_flight_analysis_item(item):
+    """
+        Add an item (start or end of a stream, a record, or a note of omitted records) to the in flight analysis
+        buffer. When the buffer is full its contents are spilled to a temporary file, so memory use is bounded however
+        many streams are found.
+    """
+    global ifa_buffer
+    global ifa_spill_file
+
+    ifa_buffer.append(item)
+    if len(ifa_buffer) >= cfg.ifa_buffer_items:
+        if ifa_spill_file is None:
+            ifa_spill_file = tempfile.TemporaryFile()
+        pickle.dump(ifa_buffer, ifa_spill_file, pickle.HIGHEST_PROTOCOL)
+        ifa_buffer = list()
+
+
+def buffered_in_flight_analysis_items():
+    """
+        Generator - yield the buffered in flight analysis items in order, those spilled to the temporary file first.
+        The items can be read any number of times.
+    """
+    if ifa_spill_file is not None:
+        ifa_spill_file.seek(0)
+        while True:
+            try:
+                items = pickle.load(ifa_spill_file)
+            except EOFError:
+                break
+            yield from items
+    yield from ifa_buffer
+
+
+def write_in_flight_analysis_streams():
+    """
+        Write all the buffered event streams to the event analysis sheet in one sequential batch. If required the
+        sheet is in a separate workbook, which is created, protected and closed here.
+    """
+    global ws_in_flight_analysis
+    global ws_row_in_flight_analysis
+
+    if cfg.ifa_separate_workbook:
+        ifa_wb_name = os.path.splitext(wb_name)[0] + " event analysis.xlsx"
+        ifa_workbook = quantum_sheets.new_workbook(ifa_wb_name)
+        fill_format = quantum_sheets.workbook_format(ifa_workbook, "fill")
+        ws_in_flight_analysis, ws_row_in_flight_analysis = create_in_flight_analysis_sheet(ifa_workbook)
+    else:
+        fill_format = cell_fill
+
+    if cfg.ifa_in_event_of_interest and ifa_stream_kept:
+        flush_in_flight_analysis_tail()     # Stream still running at the end of the input
+
+    for item in buffered_in_flight_analysis_items():
+        if item[0] == "record":
+            data_point = item[1]
+            ws_row_in_flight_analysis = write_record(ws_in_flight_analysis,
+                                                     ws_row_in_flight_analysis,
+                                                     converted_columns["km"][data_point[9]],
+                                                     converted_columns["speed"][data_point[9]],
+                                                     data_point[4],
+                                                     converted_columns["bp"][data_point[9]],
+                                                     converted_columns["bc"][data_point[9]],
+                                                     data_point[7],
+                                                     data_point[8],
+                                                     data_point[0],
+                                                     data_point[1],
+                                                     False,
+                                                     item[2],
+                                                     fill_format)
+        elif item[0] == "start":
+            ws_in_flight_analysis.write(ws_row_in_flight_analysis, 0, "Start of event flow "+str(item[1]))
+            ws_row_in_flight_analysis += 1
+        elif item[0] == "end":
+            ws_in_flight_analysis.write(ws_row_in_flight_analysis, 0, "End of event flow "+str(item[1]))
+            ws_row_in_flight_analysis += 2
+        else:
+            ws_in_flight_analysis.write(ws_row_in_flight_analysis, 0, str(item[1])+" records omitted")
+            ws_row_in_flight_analysis += 1
+
+    if cfg.ifa_separate_workbook:
+        quantum_sheets.finish_workbook(ifa_workbook)
+        report_written_workbook(ifa_wb_name)
+
+
+def detect_sampling_anomalies(columns):
+    """
+        Check the sample timestamps and odometer readings for gaps, duplicated timestamps, time reversals and odometer
+        jumps that are inconsistent with the recorded speed. The checks are made on whole columns at once.
+        Returns a list of (index, anomaly) tuples in sample order, index being the position in the columns of the
+        later sample of the offending pair.
+    """
+    epoch_seconds = np.asarray(columns["epoch_seconds"], dtype=np.int64)
+    if len(epoch_seconds) < 2:
+        return []
+    mileage = np.asarray(columns["mileage"], dtype=np.float64)
+    speed = np.asarray(columns["speed"], dtype=np.float64)
+
+    delta_seconds = np.diff(epoch_seconds)
+    delta_miles = np.diff(mileage)
+    # Furthest the loco could have travelled between the two samples at the higher of the two speeds (mph)
+    expected_miles = np.maximum(speed[:-1], speed[1:]) * np.clip(delta_seconds, 0, None) / 3600.0
+
+    checks = (("Gap", delta_seconds > cfg.sampling_gap_threshold_seconds),
+              ("Duplicate", delta_seconds == 0),
+              ("Time reversal", delta_seconds < 0),
+              ("Odometer jump", (delta_miles > expected_miles + cfg.odometer_jump_tolerance_miles) |
+                                (delta_miles < -cfg.odometer_jump_tolerance_miles)))
+    anomalies = []
+    for anomaly, mask in checks:
+        anomalies.extend((int(index) + 1, anomaly) for index in np.flatnonzero(mask))
+    anomalies.sort()
+    return anomalies
+
+
+def write_sampling_anomalies(anomalies, columns):
+    """
+        Write the anomalies found by detect_sampling_anomalies to the anomalies sheet. Row numbers are those shown
+        by Excel for the data sheet. Returns the number of anomalies written.
+    """
+    global ws_row_sampling_anomalies
+
+    for index, anomaly in anomalies:
+        previous_seconds = columns["epoch_seconds"][index - 1]
+        seconds = columns["epoch_seconds"][index]
+        ws_sampling_anomalies.write(ws_row_sampling_anomalies, 0, anomaly)
+        ws_sampling_anomalies.write_number(ws_row_sampling_anomalies, 1, columns["row"][index - 1] + 1)
+        ws_sampling_anomalies.write_number(ws_row_sampling_anomalies, 2, columns["row"][index] + 1)
+        ws_sampling_anomalies.write(ws_row_sampling_anomalies, 3,
+                                    datetime.fromtimestamp(previous_seconds).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_sampling_anomalies.write(ws_row_sampling_anomalies, 4,
+                                    datetime.fromtimestamp(seconds).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_sampling_anomalies.write_number(ws_row_sampling_anomalies, 5, seconds - previous_seconds)
+        ws_sampling_anomalies.write_number(ws_row_sampling_anomalies, 6,
+                                           converted_columns["km"][index] - converted_columns["km"][index - 1])
+        ws_row_sampling_anomalies += 1
+    return len(anomalies)
+
+
+def write_event_sample_links(columns):
+    """
+        Join the logger events to the data samples and write, against each event on the Logger Events sheet, the
+        data sheet row (as a link) and time of the nearest sample at or before it and after it
+    """
+    epoch_seconds = np.asarray(columns["epoch_seconds"], dtype=np.int64)
+    sample_epoch_dated = np.ones(len(epoch_seconds), dtype=bool)
+    sample_epoch_dated[plotted_sample_positions(epoch_seconds)] = False
+    preceding, following = quantum_events.nearest_samples(epoch_seconds, sample_epoch_dated)
+    data_sheet = "internal:'" + cfg.worksheet_name + "'!A"
+    title_format = quantum_sheets.workbook_format(workbook, "title")
+    for column, heading in enumerate(["Sample Before Row", "Sample Before Time", "Sample After Row",
+                                      "Sample After Time"], 6):
+        ws_annotations.write(1, column, heading, title_format)
+    count_links = 0
+    for sheet_row, sample_before, sample_after in zip(quantum_events.event_sheet_rows, preceding, following):
+        if sheet_row < 0:
+            continue
+        for column, sample_index in ((6, sample_before), (8, sample_after)):
+            if sample_index < 0:
+                continue
+            data_row = columns["row"][sample_index] + 1     # As shown by Excel
+            if count_links < cfg.logger_event_link_limit:
+                ws_annotations.write_url(sheet_row, column, data_sheet + str(data_row), None, str(data_row))
+                count_links += 1
+            else:
+                ws_annotations.write_number(sheet_row, column, int(data_row))
+            ws_annotations.write(sheet_row, column + 1, datetime.fromtimestamp(
+                epoch_seconds[sample_index]).strftime("%Y/%m/%d %H:%M:%S"))
+
+
+def track_sections_written():
+    """
+        Return True if samples are placed in track sections - enabled and the track sections file holds sections
+    """
+    return cfg.track_sections_enabled and track_sections is not None and len(track_sections[0]) > 0
+
+
+def write_track_sections(columns):
+    """
+        Place each sample in its track section, showing the section on the data sheet, then write the statistics of
+        each section and its overspeed occurrences to the track sections sheet. Returns the number of overspeeds.
+    """
+    global ws_row_track_sections
+
+    names, section_starts, section_ends, speed_limits = track_sections
+    epoch_seconds = np.asarray(columns["epoch_seconds"], dtype=np.int64)
+    speed = np.asarray(converted_columns["speed"], dtype=np.float64)
+    positions = quantum_sections.line_positions(converted_columns["km"], epoch_seconds, cfg.track_trip_gap_seconds,
+                                                cfg.track_trip_starts, cfg.track_default_start_km)
+    numbers = quantum_sections.section_numbers(positions, section_starts, section_ends)
+    runs = quantum_sections.overspeed_runs(numbers, speed, speed_limits, cfg.overspeed_tolerance_kph)
+
+    # The section is shown in the column after the data columns
+    section_column = len(cfg.headers)
+    ws_data_samples.write(1, section_column, "Section")
+    for row, number in zip(columns["row"], numbers.tolist()):
+        if number >= 0:
+            ws_data_samples.write_string(row, section_column, names[number])
+
+    statistics = quantum_sections.section_statistics(numbers, speed, len(names), runs)
+    for name, start_km, end_km, limit, (samples, maximum_speed, occurrences) in zip(
+            names, section_starts, section_ends, speed_limits, statistics):
+        ws_track_sections.write(ws_row_track_sections, 0, name)
+        for column, value in enumerate([start_km, end_km, limit, samples], 1):
+            ws_track_sections.write_number(ws_row_track_sections, column, value)
+        if maximum_speed is not None:
+            ws_track_sections.write_number(ws_row_track_sections, 5, maximum_speed)
+        ws_track_sections.write_number(ws_row_track_sections, 6, occurrences)
+        ws_row_track_sections += 1
+
+    ws_row_track_sections += 1
+    title_format = quantum_sheets.workbook_format(workbook, "title")
+    for column, heading in enumerate(["Overspeed in", "From", "To", "Seconds", "Max Speed (kph)", "Limit (kph)",
+                                      "Data Row"]):
+        ws_track_sections.write(ws_row_track_sections, column, heading, title_format)
+    ws_row_track_sections += 1
+    for first, last in runs:
+        number = numbers[first]
+        ws_track_sections.write(ws_row_track_sections, 0, names[number])
+        ws_track_sections.write(ws_row_track_sections, 1,
+                                datetime.fromtimestamp(epoch_seconds[first]).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_track_sections.write(ws_row_track_sections, 2,
+                                datetime.fromtimestamp(epoch_seconds[last]).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_track_sections.write_number(ws_row_track_sections, 3, int(epoch_seconds[last] - epoch_seconds[first]))
+        ws_track_sections.write_number(ws_row_track_sections, 4, speed[first:last + 1].max())
+        ws_track_sections.write_number(ws_row_track_sections, 5, speed_limits[number])
+        ws_track_sections.write_number(ws_row_track_sections, 6, columns["row"][first] + 1)
+        ws_row_track_sections += 1
+    return len(runs)
+
+
+def detect_brake_applications(columns):
+    """
+        Find the brake applications in the samples written (see quantum_brakes.brake_applications)
+    """
+    return quantum_brakes.brake_applications(columns["epoch_seconds"], columns["bp"], columns["bc"],
+                                             cfg.track_trip_gap_seconds, cfg.brake_pipe_reduction_psi,
+                                             cfg.brake_pipe_emergency_psi, cfg.brake_cylinder_application_psi)
+
+
+def write_brake_applications(applications, columns):
+    """
+        Write the summary of the brake applications in each trip, then each application with its depth, duration,
+        speeds and deceleration, to the brake applications sheet. Returns the number of applications.
+    """
+    global ws_row_brake_applications
+
+    epoch_seconds = np.asarray(columns["epoch_seconds"], dtype=np.int64)
+    durations, applied_speeds, released_speeds, decelerations = quantum_brakes.application_measures(
+        applications, epoch_seconds, converted_columns["speed"])
+    reductions = quantum_units.psi_to_pressure(applications["reduction"], cfg.report_kpa_pressures)
+    peak_cylinder_pressures = quantum_units.psi_to_pressure(applications["peak_bc"], cfg.report_kpa_pressures)
+    pressure_unit = "(" + quantum_units.pressure_unit(cfg.report_kpa_pressures) + ")"
+    title_format = quantum_sheets.workbook_format(workbook, "title")
+
+    for column, heading in enumerate(["Trip", "From", "To"] + quantum_brakes.application_types +
+                                     ["Max BP Reduction " + pressure_unit, "Mean Decel (kph/s)"]):
+        ws_brake_applications.write(1, column, heading, title_format)
+    for trip, (first, last, counts, greatest_reduction, mean_deceleration) in enumerate(
+            quantum_brakes.trip_summary(applications, decelerations, epoch_seconds, cfg.track_trip_gap_seconds), 1):
+        ws_brake_applications.write_number(ws_row_brake_applications, 0, trip)
+        for column, index in ((1, first), (2, last)):
+            ws_brake_applications.write(ws_row_brake_applications, column,
+                                        datetime.fromtimestamp(epoch_seconds[index]).strftime("%Y/%m/%d %H:%M:%S"))
+        for column, count in enumerate(counts, 3):
+            ws_brake_applications.write_number(ws_row_brake_applications, column, count)
+        ws_brake_applications.write_number(ws_row_brake_applications, 6, quantum_units.convert_pressure(
+            greatest_reduction, cfg.report_kpa_pressures))
+        if not np.isnan(mean_deceleration):
+            ws_brake_applications.write_number(ws_row_brake_applications, 7, round(mean_deceleration, 2))
+        ws_row_brake_applications += 1
+
+    ws_row_brake_applications += 1
+    for column, heading in enumerate(["Application", "From", "To", "Seconds", "BP Reduction " + pressure_unit,
+                                      "Peak BC " + pressure_unit, "Speed (kph)", "Release Speed (kph)",
+                                      "Decel (kph/s)", "Data Row", "Trip"]):
+        ws_brake_applications.write(ws_row_brake_applications, column, heading, title_format)
+    ws_row_brake_applications += 1
+    for index, (application_type, first, last, trip) in enumerate(zip(
+            applications["type"].tolist(), applications["first"].tolist(), applications["last"].tolist(),
+            applications["trip"].tolist())):
+        ws_brake_applications.write(ws_row_brake_applications, 0, quantum_brakes.application_types[application_type])
+        ws_brake_applications.write(ws_row_brake_applications, 1,
+                                    datetime.fromtimestamp(epoch_seconds[first]).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_brake_applications.write(ws_row_brake_applications, 2,
+                                    datetime.fromtimestamp(epoch_seconds[last]).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_brake_applications.write_number(ws_row_brake_applications, 3, int(durations[index]))
+        if application_type != quantum_brakes.INDEPENDENT:
+            ws_brake_applications.write_number(ws_row_brake_applications, 4, int(reductions[index]))
+        ws_brake_applications.write_number(ws_row_brake_applications, 5, int(peak_cylinder_pressures[index]))
+        ws_brake_applications.write_number(ws_row_brake_applications, 6, applied_speeds[index])
+        ws_brake_applications.write_number(ws_row_brake_applications, 7, released_speeds[index])
+        if not np.isnan(decelerations[index]):
+            ws_brake_applications.write_number(ws_row_brake_applications, 8, round(decelerations[index], 2))
+        ws_brake_applications.write_number(ws_row_brake_applications, 9, columns["row"][first] + 1)
+        ws_brake_applications.write_number(ws_row_brake_applications, 10, trip + 1)
+        ws_row_brake_applications += 1
+    return len(applications["first"])
+
+
+def write_compliance_exceptions(exceptions):
+    """
+        Write compliance exceptions (see quantum_compliance.check_sample) to the compliance sheet as they are found.
+        Speeds are converted with the speed adjustment factor of the exception's first sample.
+    """
+    global ws_row_compliance
+
+    for rule, first_seconds, last_seconds, index, row, speed, maximum_speed, detail in exceptions:
+        speeds = quantum_units.mph_to_kph([speed, maximum_speed], speed_adjustment_factors(index, index + 1))
+        ws_compliance.write(ws_row_compliance, 0, rule)
+        ws_compliance.write(ws_row_compliance, 1,
+                            datetime.fromtimestamp(first_seconds).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_compliance.write(ws_row_compliance, 2,
+                            datetime.fromtimestamp(last_seconds).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_compliance.write_number(ws_row_compliance, 3, last_seconds - first_seconds)
+        ws_compliance.write_number(ws_row_compliance, 4, int(speeds[0]))
+        ws_compliance.write_number(ws_row_compliance, 5, int(speeds[1]))
+        ws_compliance.write_number(ws_row_compliance, 6, row + 1)
+        ws_compliance.write(ws_row_compliance, 7, detail)
+        ws_row_compliance += 1
+
+
+def write_compliance_summary():
+    """
+        Write the exceptions still open at the end, then the summary of each rule to the rows kept for it at the top
+        of the compliance sheet. Returns the number of exceptions.
+    """
+    write_compliance_exceptions(quantum_compliance.finish_compliance())
+    count_exceptions = 0
+    for summary_row, (rule, exceptions, seconds, checked, compliant_percent) in enumerate(
+            quantum_compliance.compliance_summary(), quantum_sheets.sheet_templates["Compliance"]["first_row"]):
+        ws_compliance.write(summary_row, 0, rule)
+        for column, value in enumerate([exceptions, seconds, checked], 1):
+            ws_compliance.write_number(summary_row, column, value)
+        if compliant_percent is not None:
+            ws_compliance.write_number(summary_row, 4, round(compliant_percent, 2))
+        count_exceptions += exceptions
+    return count_exceptions
+
+
+def write_tmc_anomaly(anomaly, record_timestamp_text, throttle_position, speed, tmc, index, row):
+    """
+        Write a TMC anomaly (see quantum_tmc.score_sample) to the TMC anomalies sheet as it is found
+    """
+    global ws_row_tmc_anomalies
+
+    expected, deviation, score = anomaly
+    ws_tmc_anomalies.write(ws_row_tmc_anomalies, 0, record_timestamp_text)
+    ws_tmc_anomalies.write(ws_row_tmc_anomalies, 1, translate_tp(throttle_position))
+    ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 2,
+                                  int(quantum_units.mph_to_kph([speed], speed_adjustment_factors(index, index + 1))[0]))
+    ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 3, tmc)
+    ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 4, round(expected, 1))
+    ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 5, round(deviation, 1))
+    ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 6, round(score, 2))
+    ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 7, row + 1)
+    ws_row_tmc_anomalies += 1
+
+
+def write_tmc_statistics():
+    """
+        Write the TMC statistics learnt for each notch and speed band below the anomalies. Returns the number of
+        anomalies.
+    """
+    global ws_row_tmc_anomalies
+
+    count_anomalies = ws_row_tmc_anomalies - quantum_sheets.sheet_templates["TMC Anomalies"]["first_row"]
+    ws_row_tmc_anomalies += 1
+    title_format = quantum_sheets.workbook_format(workbook, "title")
+    for column, heading in enumerate(["Throttle", "Speed (mph)", "Samples", "Mean TMC (A)", "Std Dev (A)"]):
+        ws_tmc_anomalies.write(ws_row_tmc_anomalies, column, heading, title_format)
+    ws_row_tmc_anomalies += 1
+    for throttle_position, band, samples, mean, deviation in quantum_tmc.detector_summary():
+        ws_tmc_anomalies.write(ws_row_tmc_anomalies, 0, translate_tp(throttle_position))
+        ws_tmc_anomalies.write(ws_row_tmc_anomalies, 1, str(band * cfg.tmc_anomaly_speed_band_mph) + " - " +
+                               str((band + 1) * cfg.tmc_anomaly_speed_band_mph))
+        ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 2, samples)
+        ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 3, round(mean, 1))
+        ws_tmc_anomalies.write_number(ws_row_tmc_anomalies, 4, round(deviation, 1))
+        ws_row_tmc_anomalies += 1
+    return count_anomalies
+
+
+def write_event_summary():
+    """
+        Write the number of logger events of each kind per day, then the number of events of each kind and the
+        intervals between them, to the event summary sheet
+    """
+    global ws_row_event_summary
+
+    quantum_events.build_event_index()
+    days, kinds, counts = quantum_events.daily_event_counts()
+    title_format = quantum_sheets.workbook_format(workbook, "title")
+    ws_event_summary.write(1, 0, "Day", title_format)
+    for column, kind in enumerate(kinds, 1):
+        ws_event_summary.write(1, column, kind, title_format)
+    for day, day_counts in zip(days, counts):
+        ws_event_summary.write(ws_row_event_summary, 0, day)
+        for column, count in enumerate(day_counts, 1):
+            ws_event_summary.write_number(ws_row_event_summary, column, int(count))
+        ws_row_event_summary += 1
+
+    ws_row_event_summary += 1
+    for column, heading in enumerate(["Kind", "Events", "Min interval", "Median interval", "Max interval"]):
+        ws_event_summary.write(ws_row_event_summary, column, heading, title_format)
+    ws_row_event_summary += 1
+    for kind, kind_counts in zip(kinds, counts.T):
+        ws_event_summary.write(ws_row_event_summary, 0, kind)
+        ws_event_summary.write_number(ws_row_event_summary, 1, int(kind_counts.sum()))
+        intervals = quantum_events.event_intervals(kind)
+        if len(intervals):
+            for column, seconds in enumerate([intervals.min(), np.median(intervals), intervals.max()], 2):
+                ws_event_summary.write(ws_row_event_summary, column, str(timedelta(seconds=int(seconds))))
+        ws_row_event_summary += 1
+
+
+def plotted_sample_positions(epoch_seconds):
+    """
+        Return the positions of the samples that are charted or plotted - all but the epoch (1990) dated ones
+    """
+    return np.flatnonzero(epoch_seconds >= get_epoch_seconds(str(cfg.epoch_year + 1) + "/01/01 00:00:00"))
+
+
+def chart_periods(epoch_seconds):
+    """
+        Split the samples to be charted into periods - calendar days or trips (runs of samples with no gap longer than
+        cfg.chart_trip_gap_seconds) depending on cfg.chart_period. Epoch (1990) dated samples are not charted.
+        Returns a list of (title, sample positions) tuples.
+    """
+    positions = plotted_sample_positions(epoch_seconds)
+    if len(positions) == 0:
+        return []
+    seconds = epoch_seconds[positions]
+
+    if cfg.chart_period == "trip":
+        breaks = np.flatnonzero((np.diff(seconds) > cfg.chart_trip_gap_seconds) | (np.diff(seconds) < 0)) + 1
+        periods = []
+        for trip in np.split(np.arange(len(positions)), breaks):
+            periods.append(("Trip " + datetime.fromtimestamp(seconds[trip[0]]).strftime("%Y/%m/%d %H:%M") + " to " +
+                            datetime.fromtimestamp(seconds[trip[-1]]).strftime("%Y/%m/%d %H:%M"), positions[trip]))
+        return periods
+
+    # Local dates are looked up once per quarter hour rather than per sample (all time zone offsets are multiples
+    # of 15 minutes)
+    quarter_hours, quarter_hour_index = np.unique(seconds // 900, return_inverse=True)
+    quarter_hour_dates = [datetime.fromtimestamp(int(quarter_hour) * 900).strftime("%Y/%m/%d")
+                          for quarter_hour in quarter_hours]
+    dates, quarter_hour_date_index = np.unique(quarter_hour_dates, return_inverse=True)
+    date_index = quarter_hour_date_index[quarter_hour_index]
+    return [("Day " + str(date), positions[date_index == index]) for index, date in enumerate(dates)]
+
+
+def chart_channel_values(columns, channel, positions):
+    """
+        Return the values of a chart channel for the sample positions, in the units shown on the data sheet
+    """
+    if channel in ("Speed", "BP", "BC"):
+        return np.asarray(converted_columns[channel.lower()])[positions]
+    if channel == "TMC":
+        return np.asarray(columns["tmc"])[positions]
+    if channel == "Notch":
+        return np.clip(np.asarray(columns["throttle"])[positions], 0, None)     # Idle, dynamic, stop etc. chart as 0
+    raise ValueError("Unknown chart channel " + channel)
+
+
+def chart_channel_title(channel):
+    """
+        Return the chart title, with units, for a chart channel
+    """
+    pressure_unit = "(kpa)" if cfg.report_kpa_pressures else "(psi)"
+    return {"Speed": "Speed (kph)", "TMC": "TMC (A)", "BP": "BP " + pressure_unit, "BC": "BC " + pressure_unit,
+            "Notch": "Throttle notch"}[channel]
+
+
+def downsample_period(columns, positions):
+    """
+        Reduce the samples of a period to at most cfg.chart_points_per_period points by splitting them into equal
+        sized buckets. Each point takes the time of the first sample in its bucket and the extreme value of each
+        channel in the bucket (the lowest brake pipe pressure, the highest of the others) so peaks are not lost.
+        Returns the point timestamps and a dictionary of the channel values.
+    """
+    bucket_starts = np.unique(np.linspace(0, len(positions), min(len(positions), cfg.chart_points_per_period),
+                                          endpoint=False).astype(np.int64))
+    seconds = np.asarray(columns["epoch_seconds"])[positions][bucket_starts]
+    values = dict()
+    for channel in cfg.chart_channels:
+        reduce = np.minimum if channel == "BP" else np.maximum
+        values[channel] = reduce.reduceat(chart_channel_values(columns, channel, positions), bucket_starts)
+    return seconds, values
+
+
+def write_charts(columns):
+    """
+        Write downsampled speed, TMC, brake pressure and notch series for each day (or trip) to the hidden chart data
+        sheet and add a line chart per channel and period, referencing that sheet, to the charts sheet. Charting the
+        downsampled series rather than the data sheet keeps Excel responsive however long the extract.
+        Returns the number of periods charted.
+    """
+    global ws_row_charts
+
+    periods = chart_periods(np.asarray(columns["epoch_seconds"], dtype=np.int64))
+    if cfg.chart_max_periods and len(periods) > cfg.chart_max_periods:
+        ws_charts.write(ws_row_charts, 0, "Only the first " + str(cfg.chart_max_periods) + " of " + str(len(periods)) +
+                        " periods are charted")
+        ws_row_charts += 1
+        periods = periods[:cfg.chart_max_periods]
+
+    time_format = quantum_sheets.workbook_format(workbook, "timestamp")
+    ws_chart_data.write(0, 0, "Period")
+    ws_chart_data.write(0, 1, "Time")
+    for column, channel in enumerate(cfg.chart_channels):
+        ws_chart_data.write(0, column + 2, chart_channel_title(channel))
+
+    chart_data_row = 1
+    for title, positions in periods:
+        seconds, values = downsample_period(columns, positions)
+        first_row = chart_data_row
+        for index, point_seconds in enumerate(seconds):
+            ws_chart_data.write(chart_data_row, 0, title)
+            ws_chart_data.write_datetime(chart_data_row, 1, datetime.fromtimestamp(int(point_seconds)), time_format)
+            for column, channel in enumerate(cfg.chart_channels):
+                ws_chart_data.write_number(chart_data_row, column + 2, values[channel][index])
+            chart_data_row += 1
+        last_row = chart_data_row - 1
+
+        ws_charts.write(ws_row_charts, 0, title + " - " + str(len(positions)) + " samples, " + str(len(seconds)) +
+                        " points charted", quantum_sheets.workbook_format(workbook, "title"))
+        for column, channel in enumerate(cfg.chart_channels):
+            chart = workbook.add_chart({'type': 'line'})
+            chart.add_series({'name': chart_channel_title(channel),
+                              'categories': ["Chart Data", first_row, 1, last_row, 1],
+                              'values': ["Chart Data", first_row, column + 2, last_row, column + 2],
+                              'line': {'width': 1}})
+            chart.set_title({'name': chart_channel_title(channel), 'name_font': {'size': 10}})
+            chart.set_x_axis({'date_axis': True, 'num_format': 'dd/mm hh:mm', 'num_font': {'rotation': -45}})
+            chart.set_legend({'none': True})
+            ws_charts.insert_chart(ws_row_charts + 1, column * 8, chart)
+        ws_row_charts += 17
+    return len(periods)
+
+
+def record_cells(data_point):
+    """
+        Return the cell values of the visible columns for an in flight analysis data point, as written by write_record
+    """
+    index = data_point[9]
+    cells = [data_point[0], data_point[1], "{:.2f}".format(converted_columns["km"][index]),
+             converted_columns["speed"][index], data_point[4], converted_columns["bp"][index],
+             converted_columns["bc"][index], translate_tp(data_point[7])] + list(unpack_flag_cells(data_point[8]))
+    return [cell for cell, header in zip(cells, cfg.headers) if header[1]]
+
+
+def report_stream_items():
+    """
+        Generator - yield the buffered in flight analysis items in the form taken by quantum_report.write_html_report
+    """
+    tmc_column = [header for header in cfg.headers if header[1]].index(cfg.headers[4])
+    for item in buffered_in_flight_analysis_items():
+        if item[0] == "record":
+            yield "record", record_cells(item[1]), (tmc_column,) if item[2] else ()
+        elif item[0] == "start":
+            yield "note", "Start of event flow " + str(item[1])
+        elif item[0] == "end":
+            yield "note", "End of event flow " + str(item[1])
+        else:
+            yield "note", str(item[1]) + " records omitted"
+
+
+def write_report(notes):
+    """
+        Write the HTML report alongside the workbook. Returns the report file name.
+    """
+    report_name = os.path.splitext(wb_name)[0] + ".html"
+    epoch_seconds = np.asarray(sample_columns["epoch_seconds"], dtype=np.int64)
+    positions = plotted_sample_positions(epoch_seconds)
+    plots = [(chart_channel_title(channel), epoch_seconds[positions],
+              chart_channel_values(sample_columns, channel, positions)) for channel in cfg.chart_channels]
+    pressure_unit = "(kpa)" if cfg.report_kpa_pressures else "(psi)"
+    quantum_report.write_html_report(report_name,
+                                     "Data extract from Quantum Data Recorder : Locomotive " + loco_number +
+                                     ". Source file " + os.path.split(cfg.source_file)[1],
+                                     notes,
+                                     plots,
+                                     cfg.report_plot_width,
+                                     cfg.report_plot_height,
+                                     ["Event Date", "Event Time", "Event Type", "Prev Evt Date", "Prev Evt Time",
+                                      "Offset"],
+                                     logger_events,
+                                     [header[0].replace("(psi)", pressure_unit) for header in cfg.headers if header[1]],
+                                     report_stream_items() if cfg.in_flight_analysis_enabled else None)
+    return report_name
+
+
+def write_record(ws, ws_row, km, speed, tmc, brake_pipe_pressure, brake_cylinder_pressure, throttle_position, flags, record_date, record_time, fill_year_cell,fill_tmc_cell,fill_format=None):
+    """
+        Write spreadsheet row, return updated row number. Distance, speed and pressures are passed already converted
+        to the reported units (see quantum_units). The fill format defaults to that of the main workbook
+    """
 
-def write_record(ws, ws_row, mileage, speed, tmc, brake_pipe_pressure, brake_cylinder_pressure, throttle_position, flags, record_date, record_time, fill_year_cell,fill_tmc_cell):
-    """ Write spreadsheet row, return updated row number """
+    if fill_format is None:
+        fill_format = cell_fill
 
     # Time - has a dash appended
     # Date - is in mm/dd/yyyy format
@@ -941,23 +2699,22 @@ def write_record(ws, ws_row, mileage, speed, tmc, brake_pipe_pressure, brake_cyl
 
     ws_col = 0
     if fill_year_cell:
-        ws.write_string(ws_row, ws_col, record_date,cell_fill)  # AUS Date stamp
+        ws.write_string(ws_row, ws_col, record_date,fill_format)  # AUS Date stamp
     else:
         ws.write_string(ws_row, ws_col, record_date)  # AUS Date stamp
 
     ws_col += 1
     ws.write_string(ws_row, ws_col, record_time)  # Timestamp
     ws_col += 1
-    # ws.write(ws_row, ws_col, "{:.2f}".format(float(words[2]) * 1.6))  # Mileage converted to km units
-    ws.write_number(ws_row, ws_col, float(mileage) * 1.6)  # Mileage converted to km units
+    ws.write_number(ws_row, ws_col, km)  # Mileage converted to km units
     ws_col += 1
     # Speed, converted to kph and adjusted according to the difference between the real wheel diameter
     # and the diameter reported by the QDP software. NB: The reported wheel diameter can be set when
     # downloading the data via QDP but not when downloading via the QRST software.
-    ws.write_number(ws_row, ws_col, round(speed * 1.6 * cfg.speed_adjustment_factor))
+    ws.write_number(ws_row, ws_col, speed)
     ws_col += 1
     if fill_tmc_cell:
-        ws.write_number(ws_row, ws_col, tmc, cell_fill)  # TMC
+        ws.write_number(ws_row, ws_col, tmc, fill_format)  # TMC
     else:
         ws.write_number(ws_row, ws_col, tmc)  # TMC
     ws_col += 1
@@ -968,14 +2725,103 @@ def write_record(ws, ws_row, mileage, speed, tmc, brake_pipe_pressure, brake_cyl
     ws.write(ws_row, ws_col, translate_tp(throttle_position))  # Throttle position
     ws_col += 1
     # Digital inputs follow
-    for flag in flags:
-        ws.write(ws_row, ws_col, "Y" if flag == "1" else "N")
+    for flag in unpack_flag_cells(flags):
+        ws.write_string(ws_row, ws_col, flag)
         ws_col += 1
 
     ws_row += 1
     return ws_row
 
 
+def pack_flags(flags):
+    """
+        Pack the list of "0"/"1" flag strings into an integer, the first flag in bit 0
+    """
+    return int("".join(reversed(flags)), 2)
+
+
+def unpack_flag_cells(flags):
+    """
+        Return the "Y"/"N" worksheet cell values for a packed flags value
+    """
+    cells = flag_cell_values.get(flags)
+    if cells is None:
+        cells = tuple("Y" if flags >> bit & 1 else "N" for bit in range(cfg.number_of_flags_expected))
+        flag_cell_values[flags] = cells
+    return cells
+
+
+def detect_flag_transitions(columns):
+    """
+        Find the on/off edges of each digital input by XOR'ing the packed flags of adjacent samples, and work out
+        the duty cycle of each input. Time between samples is capped at the sampling gap threshold so that logger
+        power downs don't count towards the duty cycles.
+        Returns a tuple of
+            edges      - (index, bit, on) arrays in sample order, index being the position of the sample in the columns
+            statistics - list of (bit, samples on, duty cycle %, on edges, off edges) per flag
+    """
+    flags = np.asarray(columns["flags"], dtype=np.int64)
+    epoch_seconds = np.asarray(columns["epoch_seconds"], dtype=np.int64)
+    delta_seconds = np.clip(np.diff(epoch_seconds), 0, cfg.sampling_gap_threshold_seconds)
+    changed = flags[1:] ^ flags[:-1]
+    total_seconds = delta_seconds.sum()
+
+    edge_indexes = list()
+    edge_bits = list()
+    statistics = list()
+    for bit in range(cfg.number_of_flags_expected):
+        flag_on = (flags >> bit) & 1
+        indexes = np.flatnonzero((changed >> bit) & 1) + 1
+        on_edges = int(flag_on[indexes].sum())
+        duty_cycle = 100.0 * delta_seconds[flag_on[:-1] == 1].sum() / total_seconds if total_seconds else 0.0
+        statistics.append((bit, int(flag_on.sum()), duty_cycle, on_edges, len(indexes) - on_edges))
+        if cfg.headers[quantum_dataset.first_flag_column + bit][0] in cfg.flag_transition_ignore:
+            continue
+        edge_indexes.append(indexes)
+        edge_bits.append(np.full(len(indexes), bit))
+
+    indexes = np.concatenate(edge_indexes) if edge_indexes else np.zeros(0, dtype=np.int64)
+    bits = np.concatenate(edge_bits) if edge_bits else np.zeros(0, dtype=np.int64)
+    order = np.lexsort((bits, indexes))
+    indexes = indexes[order]
+    bits = bits[order]
+    return (indexes, bits, (flags[indexes] >> bits) & 1), statistics
+
+
+def write_flag_transitions(edges, statistics, columns):
+    """
+        Write the per flag statistics followed by the flag transition events to the flag events sheet.
+        Returns the number of transition events written.
+    """
+    global ws_row_flag_events
+
+    for bit, samples_on, duty_cycle, on_edges, off_edges in statistics:
+        ws_flag_events.write(ws_row_flag_events, 0, cfg.headers[quantum_dataset.first_flag_column + bit][0])
+        ws_flag_events.write_number(ws_row_flag_events, 1, samples_on)
+        ws_flag_events.write_number(ws_row_flag_events, 2, round(duty_cycle, 2))
+        ws_flag_events.write_number(ws_row_flag_events, 3, on_edges)
+        ws_flag_events.write_number(ws_row_flag_events, 4, off_edges)
+        ws_row_flag_events += 1
+    ws_row_flag_events += 1
+
+    ws_flag_events.write(ws_row_flag_events, 0, "Date/Time", quantum_sheets.workbook_format(workbook, "title"))
+    ws_flag_events.write(ws_row_flag_events, 1, "Row", quantum_sheets.workbook_format(workbook, "title"))
+    ws_flag_events.write(ws_row_flag_events, 2, "Input", quantum_sheets.workbook_format(workbook, "title"))
+    ws_flag_events.write(ws_row_flag_events, 3, "Edge", quantum_sheets.workbook_format(workbook, "title"))
+    ws_flag_events.write(ws_row_flag_events, 4, "Speed (kph)", quantum_sheets.workbook_format(workbook, "title"))
+    ws_row_flag_events += 1
+    indexes, bits, on = edges
+    for index, bit, flag_on in zip(indexes.tolist(), bits.tolist(), on.tolist()):
+        ws_flag_events.write(ws_row_flag_events, 0, datetime.fromtimestamp(
+            columns["epoch_seconds"][index]).strftime("%Y/%m/%d %H:%M:%S"))
+        ws_flag_events.write_number(ws_row_flag_events, 1, columns["row"][index] + 1)
+        ws_flag_events.write(ws_row_flag_events, 2, cfg.headers[quantum_dataset.first_flag_column + bit][0])
+        ws_flag_events.write(ws_row_flag_events, 3, "On" if flag_on else "Off")
+        ws_flag_events.write_number(ws_row_flag_events, 4, converted_columns["speed"][index])
+        ws_row_flag_events += 1
+    return len(indexes)
+
+
 def translate_tp(tp):
     """ take a throttle position. If it's a number, then return that number.
         If it's a letter then returnn the corresponding text.
@@ -998,94 +2844,19 @@ def convert_date(us_date):
     return aus_date
 
 
-def check_for_epoch_year(date):
-    """
-        Return true if the date contains the epoch year (usually 1990)
-    """
-    if str(cfg.epoch_year) in date:
-      return True
-    return False
-
-
-def write_header(wb, ws, text, loco_number):
-    """
-        write the header(s) to an Excel worksheet
-    """
-
-    wb.set_size(1920, 1080)
-    lalign = wb.add_format({'align': 'left'})
-    ws.set_column('A:B', 15, lalign)
-    numfmt = wb.add_format({'num_format': '0.00'})
-    ws.set_column('C:C', 10, numfmt)
-    ralign = wb.add_format({'align': 'right'})
-    ws.set_column('D:H', 10, ralign)
-    calign = wb.add_format({'align': 'center'})
-    ws.set_column('I:S', 10, calign)
-    ws.set_column('T:T', 20, lalign)
-
-    calign_b = wb.add_format({'align': 'center', 'bold': True})
-    ws.set_row(1, None, calign_b)
-
-    header_format = wb.add_format({'font_size': 14, 'bold': True})
-
-    ws.freeze_panes(3, 0)
-
-    """ Write header line to the worksheet. Return the next row number (0 based) """
-    ws.write(0, 0, text + " : " + loco_number, header_format)
-
-    if cfg.report_kpa_pressures:
-        # Change header value from config file if we are reporting in kpa.
-        pressure_unit="(kpa)"
-    else:
-        pressure_unit="(psi)"
-    for column, record in enumerate(cfg.headers):
-        ws.write(1, column, record[0].replace("(psi)",pressure_unit))
-    return 3
-
-
-def write_header_modifiers(wb, ws, text):
-    """
-        Write the header row for the modifiers worksheet
-    """
-    l_align = wb.add_format({'align': 'left'})
-    ws.set_column('A:A', 150, l_align)
-    header_format_modifiers = wb.add_format({'font_size': 14, 'bold': True})
-    ws.freeze_panes(3, 0)
-    """ Write header line to the worksheet. Return the next row number (0 based) """
-    ws.write(0, 0, text, header_format_modifiers)
-    return 3
-
-
-def write_header_ann(wb, ws, text, loco_number):
+def datestamp_text(datestamp):
     """
-        Write the header row for the annotations worksheet
+        Return a [date, time] datestamp written as text, or "none" if no record has been written
     """
-    l_align = wb.add_format({'align': 'left'})
-    ws.set_column('A:B', 15, l_align)
-    ws.set_column('C:C', 50, l_align)
-    ws.set_column('D:F', 15, l_align)
+    return "none" if datestamp[0] is None else " ".join(datestamp)
 
-    header_format_ann = wb.add_format({'font_size': 14, 'bold': True})
-    ws.freeze_panes(3, 0)
-    """ Write header line to the worksheet. Return the next row number (0 based) """
-    ws.write(0, 0, text + " : " + loco_number, header_format_ann)
-    ws.write(1, 0, "Event Date", header_format_ann)
-    ws.write(1, 1, "Event Time", header_format_ann)
-    ws.write(1, 2, "Event Type", header_format_ann)
-    ws.write(1, 3, "Prev Evt Date", header_format_ann)
-    ws.write(1, 4, "Prev Evt Time", header_format_ann)
-    ws.write(1, 5, "Offset", header_format_ann)
-    return 3
 
-
-def skip_line_found(line):
+def check_for_epoch_year(date):
     """
-        Search for existence of skip_list word(s) in the line variable passed into the function.
-        If found then return True, otherwise return False
+        Return true if the date contains the epoch year (usually 1990)
     """
-    for word in cfg.skip_list_words:
-        if word in line:
-            return True
+    if str(cfg.epoch_year) in date:
+      return True
     return False
 
 
@@ -1093,6 +2864,11 @@ def get_epoch(timestamp):
     """ Take string in format yyyy/mm/dd hh:mm:ss and return epoch seconds (or 0 if flag is false) """
     if not cfg.filter_dates:
         return 0
+    return get_epoch_seconds(timestamp)
+
+
+def get_epoch_seconds(timestamp):
+    """ Take string in format yyyy/mm/dd hh:mm:ss and return epoch seconds irrespective of the date filter flag """
     d = datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S")
     epoch = datetime(d.year, d.month, d.day, d.hour, d.minute, d.second).timestamp()
     return int(epoch)
@@ -1125,14 +2901,6 @@ def apply_time_adjustment(date, time):
     time = datetime_obj.strftime("%H:%M:%S")
     return date, time
 
-def get_page_number(line):
-    """
-        Find the page number from the incoming pages
-    """
-    parts = line.rstrip().split()
-    page_number = int(parts[4])
-    return page_number
-
 def hide_suppressed_rows(ws,suppressed_rows):
     """
         Passed a worksheet and a list of row numbers, hide each of the rows from the list
@@ -1163,6 +2931,18 @@ def process_command_line_args():
                         action='store_true')
     parser.add_argument('-i','--integer_idle', help='if set, throttle position idle is reported as integer 0', action='store_true' )
     parser.add_argument('-t','--text_idle', help='if set, throttle position idle is reported as Idle', action='store_true' )
+    parser.add_argument('-r','--reject_bad_lines', help='if set, lines that cannot be parsed are reported and skipped rather than stopping processing', action='store_true' )
+    parser.add_argument('-m','--max_reject_rate', type=float, help='if set, processing fails if more than this percentage of lines are rejected' )
+    parser.add_argument('-x','--html_report', help='if set, an HTML report is written alongside the workbook', action='store_true' )
+    parser.add_argument('-d','--save_dataset', help='if set, the samples written are saved as a dataset for the query sub command', action='store_true' )
+    parser.add_argument('-g','--progress_file', help='if set, progress is written to this file (JSON) as processing proceeds' )
+    parser.add_argument('-o','--output_workbook', help='if set, the workbook is written to this path as given' )
+    parser.add_argument('-c','--cfg', action='append', default=[], metavar='NAME=VALUE',
+                        help='over-ride a configuration setting, may be repeated - the value is a Python literal or a string' )
+    parser.add_argument('-I','--incidents', help='if set, the data either side of each incident time in this CSV file is written to its own workbook' )
+    parser.add_argument('-W','--incident_window', type=float, help='if set, the minutes either side of each incident written' )
+    parser.add_argument('-P','--profile', action='append', default=[], metavar='NAME:SETTING=VALUE,...',
+                        help='add an output profile, may be repeated - each profile is written to its own workbook from one parse of the input' )
     parser.add_argument('-q','--quiet', action='count', default=0, help='Modify progress display on console. -q = no page numbers, -qq = no in-flight-analysis counts or page numbers, ')
     args = parser.parse_args()
 
@@ -1181,7 +2961,7 @@ def process_command_line_args():
         cfg.start_timestamp = args.begin_timestamp
         cfg.filter_dates = True
     if args.end_timestamp:
-        if not args.start_timestamp:
+        if not args.begin_timestamp:
             print("If supplying an end timestamp for record filtering, you must also supply a start timestamp")
             sys.exit(-1)
         print("CFG record filtering enabled. End timestamp ", cfg.end_timestamp,
@@ -1206,10 +2986,79 @@ def process_command_line_args():
     if args.text_idle:
         print("CFG idle_as_digit over-ridden to report idle as text")
         cfg.idle_as_digit = False
+    if args.reject_bad_lines:
+        print("CFG parse error policy over-ridden to reject bad lines and continue")
+        cfg.parse_error_policy = "tolerant"
+    if args.max_reject_rate is not None:
+        print("CFG maximum reject rate ", cfg.max_reject_rate_percent, " over-ridden by command line value ", args.max_reject_rate)
+        cfg.max_reject_rate_percent = args.max_reject_rate
+    if args.html_report:
+        print("CFG HTML report will be written")
+        cfg.html_report_enabled = True
+    if args.save_dataset:
+        print("CFG dataset will be saved")
+        cfg.save_dataset = True
+    if args.progress_file:
+        print("CFG progress file ", cfg.progress_file, " over-ridden by command line value ", args.progress_file)
+        cfg.progress_file = args.progress_file
+    if args.output_workbook:
+        print("CFG workbook path ", cfg.workbook_path, " over-ridden by command line value ", args.output_workbook)
+        cfg.workbook_path = args.output_workbook
+    if args.incidents:
+        print("CFG incident file ", cfg.incident_file, " over-ridden by command line value ", args.incidents)
+        cfg.incident_file = args.incidents
+    if args.incident_window is not None:
+        print("CFG incident window ", cfg.incident_window_minutes, " over-ridden by command line value ",
+              args.incident_window)
+        cfg.incident_window_minutes = args.incident_window
+    for setting in args.cfg:
+        name, separator, text = setting.partition("=")
+        name = name.strip()
+        if not separator or not hasattr(cfg, name) or name.startswith("_"):
+            print("Invalid configuration over-ride " + setting + " - must be NAME=VALUE for an existing setting")
+            sys.exit(-1)
+        try:
+            value = ast.literal_eval(text.strip())
+        except (ValueError, SyntaxError):
+            value = text.strip()
+        print("CFG " + name + " value of " + repr(getattr(cfg, name)) + " over-ridden by command line value " + repr(value))
+        setattr(cfg, name, value)
+    if args.profile:
+        cfg.output_profiles = list()
+        for profile in args.profile:
+            name, separator, settings = profile.partition(":")
+            profile_settings = {"name": name.strip()}
+            for setting in [setting for setting in settings.split(",") if setting.strip()]:
+                setting_name, separator, text = setting.partition("=")
+                try:
+                    value = ast.literal_eval(text.strip())
+                except (ValueError, SyntaxError):
+                    value = text.strip()
+                profile_settings[setting_name.strip()] = value
+            cfg.output_profiles.append(profile_settings)
+        print("CFG output profiles over-ridden by command line values " + ", ".join(args.profile))
+    profile_names = [profile.get("name") for profile in cfg.output_profiles]
+    for profile in cfg.output_profiles:
+        unknown = [setting for setting in profile if setting != "name" and setting not in cfg.output_profile_settings]
+        if not profile.get("name") or profile_names.count(profile["name"]) > 1 or unknown:
+            print("Invalid output profile " + str(profile) + " - each profile needs a unique name and may only set " +
+                  ", ".join(cfg.output_profile_settings))
+            sys.exit(-1)
+        for setting in ("start_timestamp", "end_timestamp"):
+            if setting in profile:
+                try:
+                    get_epoch_seconds(str(profile[setting]))
+                except ValueError:
+                    print("Invalid " + setting + " " + str(profile[setting]) + " in output profile " +
+                          profile["name"] + " - must be yyyy/mm/dd hh:mm:ss")
+                    sys.exit(-1)
     if args.quiet > 0:
         print("CFG quiet value of " + str(cfg.quiet) + " over-ridden by CLI switch value "+ str(args.quiet))
         cfg.quiet=args.quiet
 
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'query':
+        quantum_dataset.query_main(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,66 @@
+"""
+
+Quantum Desktop Playback - unit conversion
+
+The logger records distance in miles, speed in mph and pressures in psi. Every conversion to the units reported (km,
+wheel corrected kph and psi or kPa) is made here, on whole columns of samples at a time, so the workbook, charts,
+HTML report and query tool all report the same values. The raw values are kept (they are what the datasets store) so
+the units can be switched later without re-parsing the input.
+
+"""
+
+import numpy as np
+import quantum_extraction_cfg as cfg
+
+
+km_per_mile = 1.609344          # Exact - the international mile is defined as 1609.344 metres
+
+
+def pressure_unit(kpa_pressures):
+    """
+        Return the unit name for the reported pressures
+    """
+    return "kpa" if kpa_pressures else "psi"
+
+
+def miles_to_km(miles):
+    """
+        Convert an array of odometer readings in miles to km
+    """
+    return np.asarray(miles, dtype=np.float64) * km_per_mile
+
+
+def mph_to_kph(mph, speed_adjustment_factor):
+    """
+        Convert an array of speeds in mph to kph, corrected for the actual wheel diameter, rounded to whole kph.
+        The adjustment factor may be a single value or an array holding a factor per sample.
+    """
+    return np.round(np.asarray(mph, dtype=np.float64) * km_per_mile * speed_adjustment_factor).astype(np.int64)
+
+
+def psi_to_pressure(psi, kpa_pressures):
+    """
+        Convert an array of pressures in psi to the reported unit, rounded to whole kPa if reporting kPa
+    """
+    psi = np.asarray(psi, dtype=np.int64)
+    if not kpa_pressures:
+        return psi
+    return np.round(psi * cfg.psi_to_kpa_factor).astype(np.int64)
+
+
+def convert_pressure(psi, kpa_pressures):
+    """
+        Convert a single pressure in psi to the reported unit - for messages, not sample columns
+    """
+    return int(psi_to_pressure([psi], kpa_pressures)[0])
+
+
+def convert_columns(columns, start, end, speed_adjustment_factor, kpa_pressures):
+    """
+        Convert the samples start to end (exclusive) of the raw sample columns (mileage, speed, bp, bc) to the
+        reported units. Returns a dictionary of numpy arrays - km, speed, bp and bc.
+    """
+    return {"km": miles_to_km(columns["mileage"][start:end]),
+            "speed": mph_to_kph(columns["speed"][start:end], speed_adjustment_factor),
+            "bp": psi_to_pressure(columns["bp"][start:end], kpa_pressures),
+            "bc": psi_to_pressure(columns["bc"][start:end], kpa_pressures)}
@@ -0,0 +1,204 @@
+"""
+
+Quantum Desktop Playback - background workbook writer
+
+Writing the cells of the workbook, and closing it (building the XML of each sheet and compressing it into the xlsx
+file), takes as long as reading and parsing the input. It is done by a writer process so that the two overlap - a
+thread would not do, as both are Python code and the interpreter lock would let only one of them run at a time.
+
+The workbook, and its sheets, formats and charts, live in the writer process. The main process is handed stand-ins
+(RemoteObject) whose methods - add_worksheet, write, write_number, set_row, close etc. - record the call rather than
+make it. Calls that create an object (add_worksheet, add_format, add_chart) return a stand-in for it at once, and a
+stand-in passed as an argument (a format, a chart) is sent as a reference to the object in the writer process. The
+calls are collected into batches of cfg.writer_batch_calls and put on a queue holding at most cfg.writer_queue_batches
+batches, from which the writer process makes them in order. If the writer falls behind the parser waits on the full
+queue, so the memory used by calls waiting to be made is bounded. Every call is made, in the order the main process
+made it, with the values it was given at the time, so the workbook is exactly as it would be if written directly.
+Nothing is read back from the workbook - the main process only ever writes to it.
+
+If a call fails the writer process returns the error and stops. The main process finds this when next it waits on
+the full queue, or when it stops the writer, and raises RuntimeError giving the error.
+
+If cfg.background_writer_enabled is not set, or there are fewer than cfg.background_writer_min_cpus CPUs (with one
+the two processes would only take turns), the workbook is written directly, by the main process. How much, if at all,
+the writer shortens a run on a machine with more than one CPU has not been measured.
+
+"""
+
+import os
+import queue
+import multiprocessing
+import xlsxwriter
+import quantum_extraction_cfg as cfg
+
+
+# Calls that create an object in the writer process, the stand-in for which is returned to the caller
+creating_methods = {"Workbook", "add_worksheet", "add_format", "add_chart", "add_chartsheet"}
+
+writer_process = None
+writer_calls = None             # Queue of batches of calls for the writer process
+writer_results = None           # Queue on which the writer process returns its error (None if all went well)
+writer_batch = list()           # Calls collected for the next batch - (object id, method, args[, kwargs[, new id]])
+next_object_id = 1              # Object 0 is the xlsxwriter module
+remote_objects = dict()         # In the writer process - object id: object
+
+
+class RemoteObject:
+    """
+        Stands in for an object in the writer process - calling any of its methods submits the call to it
+    """
+
+    def __init__(self, object_id):
+        self.object_id = object_id
+
+    def __getattr__(self, name):
+        object_id = self.object_id
+        if name in creating_methods:
+            def remote_call(*args, **kwargs):
+                return create_remote(object_id, name, args, kwargs)
+        else:
+            def remote_call(*args, **kwargs):
+                writer_batch.append((object_id, name, args, kwargs) if kwargs else (object_id, name, args))
+                if len(writer_batch) >= cfg.writer_batch_calls:
+                    flush_batch()
+        setattr(self, name, remote_call)        # Found directly next time
+        return remote_call
+
+    def __reduce__(self):
+        # Sent to the writer process as a reference to the object it stands in for
+        return remote_object, (self.object_id,)
+
+
+def remote_object(object_id):
+    """
+        Return the object in the writer process with the id (unpickling a RemoteObject)
+    """
+    return remote_objects[object_id]
+
+
+def create_remote(object_id, name, args, kwargs):
+    """
+        Submit a call creating an object in the writer process. Returns the stand-in for the new object. The batch
+        is sent at once, so that the object exists by the time any later call refers to it.
+    """
+    global next_object_id
+
+    new_object_id = next_object_id
+    next_object_id += 1
+    writer_batch.append((object_id, name, args, kwargs, new_object_id))
+    flush_batch()
+    return RemoteObject(new_object_id)
+
+
+def new_workbook(*args):
+    """
+        Create an xlsxwriter workbook - in the writer process if it is running
+    """
+    if writer_process is None:
+        return xlsxwriter.Workbook(*args)
+    return create_remote(0, "Workbook", args, {})
+
+
+def start_writer():
+    """
+        Start the writer process, if enabled and not already running
+    """
+    global writer_process
+    global writer_calls
+    global writer_results
+
+    if not cfg.background_writer_enabled or writer_process is not None:
+        return
+    if (os.cpu_count() or 1) < cfg.background_writer_min_cpus:
+        return              # Nothing for the writer to run on alongside the parser
+    context = multiprocessing.get_context("spawn")
+    writer_calls = context.Queue(maxsize=max(cfg.writer_queue_batches, 1))
+    writer_results = context.Queue()
+    writer_process = context.Process(target=write_batches, args=(writer_calls, writer_results), daemon=True)
+    writer_process.start()
+
+
+def write_batches(calls, results):
+    """
+        Writer process - make the calls in each batch taken from the queue, until the batch is None, then return None.
+        If a call fails, return the error at once and stop.
+    """
+    remote_objects[0] = xlsxwriter
+    try:
+        while (batch := calls.get()) is not None:
+            for call in batch:
+                if len(call) == 3:
+                    getattr(remote_objects[call[0]], call[1])(*call[2])
+                else:
+                    result = getattr(remote_objects[call[0]], call[1])(*call[2], **call[3])
+                    if len(call) > 4:
+                        remote_objects[call[4]] = result
+    except Exception as e:
+        results.put(str(e) or type(e).__name__)
+        return
+    results.put(None)
+
+
+def writer_error():
+    """
+        Return the error the writer process stopped with, or its exit code if it did not return one
+    """
+    try:
+        error = writer_results.get(timeout=1)
+    except queue.Empty:
+        error = None
+    return error or "the writer process has stopped (exit code " + str(writer_process.exitcode) + ")"
+
+
+def put_batch(batch):
+    """
+        Put a batch on the queue, waiting for room if the writer process is behind. Raises RuntimeError, giving the
+        error of the writer process, if it has stopped.
+    """
+    while True:
+        try:
+            writer_calls.put(batch, timeout=1)
+            return
+        except queue.Full:
+            if not writer_process.is_alive():
+                writer_calls.cancel_join_thread()       # Nothing will read the batches still waiting
+                raise RuntimeError("Unable to write the workbook - " + writer_error())
+
+
+def flush_batch():
+    """
+        Put the calls collected on the queue, waiting for room if the writer process is behind
+    """
+    global writer_batch
+
+    if not writer_batch:
+        return
+    put_batch(writer_batch)
+    writer_batch = list()
+
+
+def stop_writer():
+    """
+        Wait for the writer process to make all the calls submitted, then stop it. Raises RuntimeError if any failed.
+    """
+    global writer_process
+
+    if writer_process is None:
+        return
+    flush_batch()
+    put_batch(None)
+    error = None
+    while True:
+        try:
+            error = writer_results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not writer_process.is_alive():
+                error = writer_error()
+                break
+    if error is not None:
+        writer_calls.cancel_join_thread()
+    writer_process.join()
+    writer_process = None
+    if error is not None:
+        raise RuntimeError("Unable to write the workbook - " + error)
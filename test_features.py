@@ -0,0 +1,234 @@
+"""
+
+Quantum Desktop Playback - feature tests
+
+Each analysis and sheet added to the extraction is checked against what is known to be in the small report
+test_report.txt: the gap and clock reset in the middle of it, the inputs switched on and off, the brake application,
+the headlight, vigilance and EIE exceptions and the TMC spike on its last pages. The extraction is run once with all
+the analyses turned on, and again for the cases needing other settings (output profiles, the dataset and query tool).
+
+    python -m pytest -q test_features.py
+
+"""
+
+import os
+import pytest
+import quantum_regression
+import quantum_dataset
+import quantum_events
+import quantum_lines
+import quantum_writer
+import quantum_extraction_cfg as cfg
+
+pytest.importorskip("openpyxl")
+import openpyxl
+
+test_report = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_report.txt")
+
+all_analyses = ["sampling_anomaly_detection_enabled=True", "flag_transition_analysis_enabled=True",
+                "charts_enabled=True", "logger_event_summary_enabled=True", "logger_event_sample_join_enabled=True",
+                "brake_analysis_enabled=True", "compliance_enabled=True", "tmc_anomaly_detection_enabled=True"]
+
+
+def sheet_rows(workbook, sheet_name):
+    """
+        Return the rows of a sheet, below its title and headings, as tuples of values
+    """
+    return [row for row in workbook[sheet_name].iter_rows(min_row=3, values_only=True)
+            if any(value is not None for value in row)]
+
+
+def rows_after(rows, first_heading):
+    """
+        Return the rows of a sheet after the heading row of its second table, which starts with the first heading
+    """
+    headings = [row[0] for row in rows].index(first_heading)
+    return rows[headings + 1:]
+
+
+@pytest.fixture(scope="module")
+def workbook(tmp_path_factory):
+    """
+        The workbook of a run with all the analyses turned on
+    """
+    path = str(tmp_path_factory.mktemp("features") / "features.xlsx")
+    result = quantum_regression.run_extraction(test_report, path,
+                                               quantum_regression.common_overrides + all_analyses)
+    assert result.returncode == 0, result.stdout
+    return openpyxl.load_workbook(path)
+
+
+def test_sampling_anomalies(workbook):
+    anomalies = [row[:3] for row in sheet_rows(workbook, "Sampling Anomalies")]
+    assert anomalies == [("Gap", 261, 262), ("Odometer jump", 261, 262), ("Time reversal", 302, 303),
+                         ("Gap", 322, 323)]
+
+
+def test_flag_transitions(workbook):
+    rows = sheet_rows(workbook, "Flag Events")
+    statistics = dict((row[0], (row[1], row[3], row[4])) for row in rows[:11])
+    assert statistics["EIE"] == (1, 1, 1)
+    assert statistics["Light (S)"][1:] == (1, 1)
+    edges = [row[:4] for row in rows_after(rows, "Date/Time")]
+    assert ("2025/07/09 08:28:58", 436, "EIE", "On") in edges
+    assert ("2025/07/09 08:28:59", 437, "EIE", "Off") in edges
+
+
+def test_event_summary(workbook):
+    rows = sheet_rows(workbook, "Event Summary")
+    kinds = dict((row[0], row[1]) for row in rows_after(rows, "Kind"))
+    assert kinds == {"power_on": 1, "suppression": 20, "bp_transition": 1}
+
+
+def test_event_sample_join(workbook):
+    power_on = sheet_rows(workbook, "Logger Events")[0]
+    assert power_on[2] == "Power On"
+    assert power_on[6:] == (None, None, "5", "2025/07/09 07:59:01")
+
+
+def test_event_intervals_across_daylight_saving():
+    # Adelaide clocks went forward at 02:00 on 2025/10/05, so these local times are 11 hours apart in epoch seconds
+    quantum_events.clear_catalog()
+    quantum_events.add_event(1759573800, "2025/10/04", "20:00:00", "Power On")
+    quantum_events.add_event(1759613400, "2025/10/05", "08:00:00", "Power On")
+    assert quantum_events.event_intervals("power_on").tolist() == [12 * 3600]
+    quantum_events.clear_catalog()
+
+
+def test_brake_applications(workbook):
+    rows = sheet_rows(workbook, "Brake Applications")
+    applications = rows_after(rows, "Application")
+    assert [row[:6] for row in applications] == [("Automatic", "2025/07/09 08:29:30", "2025/07/09 08:29:47", 17,
+                                                  12, 35)]
+    assert applications[0][9:] == (468, 3)
+
+
+def test_compliance_exceptions(workbook):
+    rows = sheet_rows(workbook, "Compliance")
+    exceptions = [row[:4] for row in rows_after(rows, "Exception")]
+    assert exceptions == [("Headlight off while moving", "2025/07/09 08:28:08", "2025/07/09 08:28:19", 11),
+                          ("EIE occurrence", "2025/07/09 08:28:58", "2025/07/09 08:28:58", 0),
+                          ("Vigilance not acknowledged", "2025/07/09 08:29:09", "2025/07/09 08:30:07", 58)]
+
+
+def test_tmc_anomalies(workbook):
+    rows = sheet_rows(workbook, "TMC Anomalies")
+    anomalies = rows[:[row[0] for row in rows].index("Throttle")]
+    notch_5 = [row for row in anomalies if row[1] == 5]
+    assert len(notch_5) == 1
+    time, throttle, speed, tmc, expected, deviation, score, data_row = notch_5[0]
+    assert (time, tmc, data_row) == ("08:29:18- 07/09/2025", 1900, 456)
+    assert score == pytest.approx((tmc - expected) / deviation, abs=0.05)
+    assert score > 40
+
+
+def test_charts(workbook):
+    assert "Charts" in workbook.sheetnames
+    assert workbook["Chart Data"].sheet_state == "hidden"
+    assert workbook["Chart Data"].max_row <= 501
+
+
+def test_profile_with_no_records(tmp_path):
+    path = str(tmp_path / "profiles.xlsx")
+    result = quantum_regression.run_extraction(
+        test_report, path, quantum_regression.common_overrides + all_analyses,
+        ["-P", "day:", "-P", "empty:start_timestamp=2025/07/10 11:00:00,end_timestamp=2025/07/10 13:00:00",
+         "-P", "after:"])
+    assert result.returncode == 0, result.stdout
+    assert "No records written - none are in the window of output profile empty" in result.stdout
+    for profile, samples in (("day", 480), ("empty", 0), ("after", 480)):
+        workbook = openpyxl.load_workbook(str(tmp_path / ("profiles " + profile + ".xlsx")))
+        assert sum(1 for row in sheet_rows(workbook, "Data Extract") if row[3] is not None) == samples
+
+
+def test_query(tmp_path, capsys):
+    datasets = str(tmp_path / "datasets")
+    result = quantum_regression.run_extraction(test_report, str(tmp_path / "query.xlsx"),
+                                               ["progress_display=False", "dataset_directory=" + repr(datasets)],
+                                               ["-d"])
+    assert result.returncode == 0, result.stdout
+    capsys.readouterr()
+    quantum_dataset.query_main(["-d", datasets, "-l", "844", "-w", "eie == 1", "-a", "count,max(tmc)"])
+    assert capsys.readouterr().out.splitlines() == ["count = 1", "max(tmc) = 600"]
+    quantum_dataset.query_main(["-d", datasets, "-b", "2025/07/09 08:29:30", "-e", "2025/07/09 08:29:47",
+                                "-a", "min(bp),max(bc)"])
+    assert capsys.readouterr().out.splitlines()[-2:] == ["min(bp) = 78", "max(bc) = 35"]
+
+
+def test_incident_outside_the_data(tmp_path):
+    incidents = tmp_path / "incidents.csv"
+    incidents.write_text("timestamp,incident\n"
+                         "2025/07/09 08:28:00,Rough handling\n"
+                         "2025/07/10 12:00:00,Not in the report\n"
+                         "2025/07/09 08:02:00,Late start\n")
+    path = str(tmp_path / "incidents.xlsx")
+    result = quantum_regression.run_extraction(test_report, path,
+                                               quantum_regression.common_overrides + ["incident_window_minutes=1"],
+                                               ["-I", str(incidents)])
+    assert result.returncode == 0, result.stdout
+    assert "none are in the window of output profile incident_2_Not_in_the_report" in result.stdout
+    for incident, first, last in (("incident_1_Rough_handling", "08:27:08", "08:29:00"),
+                                  ("incident_2_Not_in_the_report", None, None),
+                                  ("incident_3_Late_start", "08:01:00", "08:03:00")):
+        workbook = openpyxl.load_workbook(str(tmp_path / ("incidents " + incident + ".xlsx")))
+        times = [row[1] for row in sheet_rows(workbook, "Data Extract")
+                 if row[3] is not None and not row[0].startswith("1990")]
+        assert (times[0] if times else None, times[-1] if times else None) == (first, last)
+
+
+def test_query_invalid_timestamp(capsys):
+    with pytest.raises(SystemExit):
+        quantum_dataset.query_main(["-b", "notadate"])
+    assert capsys.readouterr().out.startswith("Error: Invalid timestamp notadate")
+
+
+def test_datasets_saved_in_the_same_second(tmp_path):
+    columns = {"epoch_seconds": [1752012000, 1752012001]}
+    paths = [quantum_dataset.save_dataset(columns, {"loco_number": "844"}, str(tmp_path)) for _ in range(3)]
+    assert len(set(paths)) == 3
+    assert quantum_dataset.find_datasets(str(tmp_path), "844") == sorted(paths)
+
+
+@pytest.mark.parametrize("policy", ["abort", "tolerant"])
+def test_unreadable_wheel_diameter_is_fatal(tmp_path, policy):
+    with open(test_report) as file:
+        report = file.read()
+    source = tmp_path / "report.txt"
+    source.write_text(report.replace("Diameter = 40.0", "Diameter = 4O.0"))
+    result = quantum_regression.run_extraction(str(source), str(tmp_path / "wheel.xlsx"),
+                                               ["progress_display=False", "parse_error_policy=" + repr(policy)])
+    assert result.returncode == 1
+    assert "Unable to read the wheel diameter" in result.stdout
+
+
+@pytest.mark.parametrize("line, kind", [
+    ("Quantum Desktop Playback Page 3     Report Date 10/10/2025", quantum_lines.PAGE_HEADER),
+    ("   Quantum Desktop Playback Page 3     Report Date 10/10/2025", quantum_lines.PAGE_HEADER),
+    ("  Locomotive Number is         -      844", quantum_lines.LOCO_NUMBER),
+    ("    Circumference = 125.6 Diameter = 40.0", quantum_lines.WHEEL_SIZE),
+    ("  TIME      DATE         MILES SPD TMC  BP  BC TP", quantum_lines.COLUMN_HEADER),
+    ("  Report Date 10/10/2025", quantum_lines.SKIPPED),
+    ("07:59:01- 07/09/2025   12.00   0   0   0   0 ID 0 0 1 1 1 0 1 0 0 1 0", quantum_lines.SAMPLE),
+    ("  07:59:01- 07/09/2025   12.00   0   0   0   0 ID 0 0 1 1 1 0 1 0 0 1 0", quantum_lines.ANNOTATION),
+    ("Power On 07:59:00- 07/09/2025", quantum_lines.ANNOTATION),
+    ("Laptop connected to Page 2 07:59:00- 07/09/2025", quantum_lines.ANNOTATION)])
+def test_line_classifier(line, kind):
+    classify_line = quantum_lines.compile_line_classifier(cfg.skip_list_words, cfg.layout_header_word)
+    assert classify_line(line) == kind
+
+
+def test_writer_error_stops_the_parse(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "background_writer_enabled", True)
+    monkeypatch.setattr(cfg, "background_writer_min_cpus", 1)
+    monkeypatch.setattr(cfg, "writer_batch_calls", 1)
+    monkeypatch.setattr(cfg, "writer_queue_batches", 1)
+    monkeypatch.setattr(quantum_writer, "writer_process", None)
+    monkeypatch.setattr(quantum_writer, "writer_batch", list())
+    quantum_writer.start_writer()
+    worksheet = quantum_writer.new_workbook(str(tmp_path / "writer.xlsx")).add_worksheet("Data")
+    worksheet.write(0, 0, "Time")
+    worksheet.write_nothing(1, 0)
+    with pytest.raises(RuntimeError, match="write_nothing"):
+        for row in range(2, 1000):
+            worksheet.write(row, 0, row)
+    assert quantum_writer.writer_process.exitcode == 0
@@ -0,0 +1,40 @@
+"""
+
+Quantum Desktop Playback - regression tests
+
+The regression harness (quantum_regression.py) as a pytest suite: the extraction is run over a small report,
+test_report.txt, in the reference mode and in each alternative mode, and the workbook of each mode must be identical
+to that of the reference mode.
+
+    python -m pytest -q test_regression.py
+
+"""
+
+import os
+import pytest
+import quantum_regression
+
+pytest.importorskip("openpyxl")
+
+test_report = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_report.txt")
+
+
+@pytest.fixture(scope="module")
+def reference_workbook(tmp_path_factory):
+    """
+        The workbook of the reference mode
+    """
+    workbook, elapsed, status = quantum_regression.run_mode(test_report, quantum_regression.reference_mode,
+                                                            str(tmp_path_factory.mktemp("reference")))
+    assert status == 0
+    return workbook
+
+
+@pytest.mark.parametrize("mode", [mode for mode in quantum_regression.modes
+                                  if mode != quantum_regression.reference_mode])
+def test_mode_matches_reference(mode, reference_workbook, tmp_path):
+    workbook, elapsed, status = quantum_regression.run_mode(test_report, mode, str(tmp_path))
+    assert status == 0
+    differences = [(sheet, listed) for sheet, count, listed in
+                   quantum_regression.compare_workbooks(reference_workbook, workbook, 10) if count]
+    assert differences == []